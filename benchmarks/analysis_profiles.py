@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Compare per-frame face analysis cost of the analysis profiles.
+
+    python benchmarks/analysis_profiles.py --frames frames_raw --execution-provider cpu
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+
+import modules.globals
+from modules.face_analyser import ANALYSIS_PROFILES, get_face_analyser, get_many_faces
+
+
+def main() -> None:
+    program = argparse.ArgumentParser()
+    program.add_argument('--frames', help='directory of sample frames', default='frames_raw')
+    program.add_argument('--repeat', help='passes over the sample frames per profile', type=int, default=3)
+    program.add_argument('--execution-provider', help='onnxruntime execution provider', default='CPUExecutionProvider')
+    args = program.parse_args()
+
+    modules.globals.execution_providers = [args.execution_provider]
+    frames = [cv2.imread(path) for path in sorted(glob.glob(os.path.join(args.frames, '*.jpg')) + glob.glob(os.path.join(args.frames, '*.png')))]
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        sys.exit(f'No frames found in {args.frames}')
+    get_face_analyser()
+    # warm up every model once so session initialisation is not measured
+    get_many_faces(frames[0], 'full')
+
+    timings = {}
+    for profile in ANALYSIS_PROFILES:
+        faces = 0
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for frame in frames:
+                faces += len(get_many_faces(frame, profile))
+        timings[profile] = (time.perf_counter() - start) * 1000 / (args.repeat * len(frames))
+        print(f'{profile:<14} {timings[profile]:8.2f} ms/frame  {faces / args.repeat / len(frames):.2f} faces/frame')
+    for profile, milliseconds in timings.items():
+        if profile != 'full':
+            print(f'{profile} saves {timings["full"] - milliseconds:.2f} ms/frame ({1 - milliseconds / timings["full"]:.0%}) over full')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Time the map faces clustering methods on synthetic face embeddings.
+
+    python benchmarks/clustering.py --sizes 10000 100000 1000000 --identities 12
+
+Each identity is a random direction in embedding space and its faces are that direction plus
+noise, with a few identities taking most of the faces as in real videos. For every method the
+table shows the time to find the centroids and to assign every face to one, the number of
+identities found and the purity of the assignment (the share of faces whose cluster is mostly
+of their own identity). One million 512 dimensional embeddings take 2 GB.
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+import modules.globals
+from modules.cluster_analysis import CLUSTER_METHODS, find_cluster_centroids
+
+# buffalo_l's recognition model
+FACE_EMBEDDING_SIZE = 512
+CHUNK_SIZE = 65536
+
+
+def make_embeddings(size: int, identities: int, noise: float, seed: int) -> Tuple[np.ndarray, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    directions = rng.standard_normal((identities, FACE_EMBEDDING_SIZE)).astype(np.float32)
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    # a handful of main characters and a long tail of extras
+    weights = 1.0 / np.arange(1, identities + 1)
+    labels = rng.choice(identities, size, p=weights / weights.sum()).astype(np.int32)
+    embeddings = np.empty((size, FACE_EMBEDDING_SIZE), dtype=np.float32)
+    for start in range(0, size, CHUNK_SIZE):
+        chunk = directions[labels[start:start + CHUNK_SIZE]]
+        chunk += rng.standard_normal(chunk.shape, dtype=np.float32) * noise / np.sqrt(FACE_EMBEDDING_SIZE)
+        embeddings[start:start + CHUNK_SIZE] = chunk / np.linalg.norm(chunk, axis=1, keepdims=True)
+    return embeddings, labels
+
+
+def assign(embeddings: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(embeddings), dtype=np.int32)
+    for start in range(0, len(embeddings), CHUNK_SIZE):
+        assignments[start:start + CHUNK_SIZE] = np.argmax(embeddings[start:start + CHUNK_SIZE] @ centroids.T, axis=1)
+    return assignments
+
+
+def get_purity(assignments: np.ndarray, labels: np.ndarray, identities: int) -> float:
+    counts = np.zeros((assignments.max() + 1, identities), dtype=np.int64)
+    np.add.at(counts, (assignments, labels), 1)
+    return counts.max(axis=1).sum() / len(labels)
+
+
+def main() -> None:
+    program = argparse.ArgumentParser()
+    program.add_argument('--sizes', help='faces per synthetic set', type=int, nargs='+', default=[10000, 100000, 1000000])
+    program.add_argument('--identities', help='identities per set', type=int, default=12)
+    program.add_argument('--noise', help='spread of the faces around their identity, 1.0 is about 0.7 cosine similarity', type=float, default=1.0)
+    program.add_argument('--methods', help='clustering methods to time', nargs='+', default=CLUSTER_METHODS, choices=CLUSTER_METHODS)
+    program.add_argument('--sample-size', help='faces the centroids are fitted on, 0 fits on all of them', type=int, default=modules.globals.cluster_sample_size)
+    program.add_argument('--max-k', help='most identities looked for, 0 looks for up to 10', type=int, default=0)
+    program.add_argument('--execution-threads', help='k values fitted in parallel', type=int, default=os.cpu_count() or 1)
+    program.add_argument('--seed', type=int, default=0)
+    args = program.parse_args()
+
+    modules.globals.execution_threads = args.execution_threads
+    print(f'{"faces":>9}  {"method":<10}{"fit s":>9}{"assign s":>10}{"found":>7}{"purity":>8}')
+    for size in args.sizes:
+        embeddings, labels = make_embeddings(size, args.identities, args.noise, args.seed)
+        for method in args.methods:
+            start = time.perf_counter()
+            try:
+                centroids = np.asarray(find_cluster_centroids(embeddings, args.max_k, method, args.sample_size), dtype=np.float32)
+            except ImportError as exception:
+                print(f'{size:>9}  {method:<10}skipped, {exception}')
+                continue
+            fit_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            assignments = assign(embeddings, centroids)
+            assign_seconds = time.perf_counter() - start
+            purity = get_purity(assignments, labels, args.identities)
+            print(f'{size:>9}  {method:<10}{fit_seconds:>9.2f}{assign_seconds:>10.2f}{len(centroids):>7}{purity:>8.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Compare the precision variants of the face swapper and buffalo_l models on the CPU.
+
+    python -m modules.model_converter inswapper --precision fp16 int8-dynamic int8-static
+    python -m modules.model_converter buffalo --precision fp16 int8-dynamic int8-static
+    python benchmarks/model_variants.py --samples frames_raw
+
+Faces found in the sample frames by the FP32 detector are aligned the way the face swapper
+and the recognizer see them. For every variant on disk the table shows the throughput and the
+deviation from the FP32 model: largest pixel difference of the swapped crops, 1 - cosine of
+the embeddings and largest difference of the detection scores.
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Any, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.model_converter import compare_outputs, create_session, get_blob, get_feeds, load_sample_crops, run_model
+from modules.utilities import MODEL_PRECISIONS, get_model_variant_path, resolve_relative_path
+
+MODELS = {
+    'inswapper': resolve_relative_path('../models/inswapper_128.onnx'),
+    'det_10g': resolve_relative_path('../models/buffalo_l/det_10g.onnx'),
+    'w600k_r50': resolve_relative_path('../models/buffalo_l/w600k_r50.onnx'),
+}
+DEVIATION_UNITS = {'inswapper': 'max px', 'det_10g': 'max score', 'w600k_r50': '1 - cos'}
+
+
+def load_aligned_faces(samples_path: str, size: int, count: int, detector_path: str) -> List[Any]:
+    from insightface.model_zoo import get_model
+    from insightface.utils import face_align
+
+    if not os.path.exists(detector_path):
+        print(f'{os.path.basename(detector_path)} not found, using centre crops.')
+        return load_sample_crops(samples_path, size, count)
+    detector = get_model(detector_path, providers=['CPUExecutionProvider'])
+    detector.prepare(ctx_id=-1, input_size=(640, 640))
+    faces: List[Any] = []
+    for frame in load_sample_crops(samples_path, 640, count):
+        _, kpss = detector.detect(frame, max_num=0)
+        faces.extend(face_align.norm_crop(frame, kps, size) for kps in (kpss if kpss is not None else []))
+    if not faces:
+        print(f'No faces found in {samples_path}, using centre crops.')
+        return load_sample_crops(samples_path, size, count)
+    return faces[:count]
+
+
+def measure_fps(model_name: str, session: Any, crops: List[Any], runs: int) -> float:
+    feeds = [get_feeds(model_name, session, get_blob(model_name, [crop])) for crop in crops]
+    session.run(None, feeds[0])
+    start = time.perf_counter()
+    for _ in range(runs):
+        for feed in feeds:
+            session.run(None, feed)
+    return runs * len(feeds) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    program = argparse.ArgumentParser()
+    program.add_argument('--samples', help='directory of sample frames', default=resolve_relative_path('../../frames_raw'))
+    program.add_argument('--sample-count', help='frames (and faces) per model', type=int, default=16)
+    program.add_argument('--models', help='models to measure', nargs='+', default=list(MODELS), choices=list(MODELS))
+    program.add_argument('--runs', help='passes over the samples per variant', type=int, default=3)
+    args = program.parse_args()
+
+    print(f'{"variant":<36}{"fps":>9}{"deviation":>11}  unit')
+    for model_name in args.models:
+        if not os.path.exists(MODELS[model_name]):
+            print(f'{os.path.basename(MODELS[model_name])} not found, skipping {model_name}.')
+            continue
+        if model_name == 'det_10g':
+            crops = load_sample_crops(args.samples, 640, args.sample_count)
+        else:
+            crops = load_aligned_faces(args.samples, 128 if model_name == 'inswapper' else 112, args.sample_count, MODELS['det_10g'])
+        reference = run_model(model_name, create_session(MODELS[model_name], ['CPUExecutionProvider']), crops)
+        for precision in MODEL_PRECISIONS:
+            variant_path = get_model_variant_path(MODELS[model_name], precision)
+            if not os.path.exists(variant_path):
+                continue
+            session = create_session(variant_path, ['CPUExecutionProvider'], 'basic')
+            deviation = compare_outputs(model_name, reference, run_model(model_name, session, crops))['deviation']
+            fps = measure_fps(model_name, session, crops, args.runs)
+            print(f'{os.path.basename(variant_path):<36}{fps:>9.1f}{deviation:>11.4f}  {DEVIATION_UNITS[model_name]}')
+
+
+if __name__ == '__main__':
+    main()
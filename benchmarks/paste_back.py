@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Compare the ROI paste back with the full frame paste back of insightface's INSwapper.get.
+
+    python benchmarks/paste_back.py --faces 1 2 4 8 --repeat 20
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Any, Callable, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+import numpy as np
+
+from modules.paste_back import get_feather_mask, paste_back
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4K': (3840, 2160)}
+CROP_SIZE = 128
+
+
+def stock_paste_back(frame: np.ndarray, crop: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+    # the blend of insightface.model_zoo.inswapper.INSwapper.get(paste_back=True), unused fake_diff left out
+    inverse_matrix = cv2.invertAffineTransform(matrix)
+    size = (frame.shape[1], frame.shape[0])
+    white = np.full(crop.shape[:2], 255, dtype=np.float32)
+    warped_crop = cv2.warpAffine(crop, inverse_matrix, size, borderValue=0.0)
+    mask = cv2.warpAffine(white, inverse_matrix, size, borderValue=0.0)
+    mask[mask > 20] = 255
+    mask_rows, mask_columns = np.where(mask == 255)
+    mask_size = int(np.sqrt((np.max(mask_rows) - np.min(mask_rows)) * (np.max(mask_columns) - np.min(mask_columns))))
+    erode = max(mask_size // 10, 10)
+    mask = cv2.erode(mask, np.ones((erode, erode), np.uint8), iterations=1)
+    blur = max(mask_size // 20, 5)
+    mask = cv2.GaussianBlur(mask, (blur * 2 + 1, blur * 2 + 1), 0)
+    mask = (mask / 255)[:, :, None]
+    return (mask * warped_crop + (1 - mask) * frame.astype(np.float32)).astype(np.uint8)
+
+
+def get_face_matrices(resolution: Tuple[int, int], count: int, rng: np.random.Generator) -> List[np.ndarray]:
+    width, height = resolution
+    columns = int(np.ceil(np.sqrt(count)))
+    rows = int(np.ceil(count / columns))
+    matrices = []
+    for index in range(count):
+        # faces spread over a grid, about a fifth of the frame height, slightly rotated
+        center_x = (index % columns + 0.5) * width / columns
+        center_y = (index // columns + 0.5) * height / rows
+        face_size = height / 5
+        angle = rng.uniform(-20, 20)
+        inverse_matrix = cv2.getRotationMatrix2D((CROP_SIZE / 2, CROP_SIZE / 2), angle, face_size / CROP_SIZE)
+        inverse_matrix[:, 2] += np.array([center_x - CROP_SIZE / 2, center_y - CROP_SIZE / 2])
+        matrices.append(cv2.invertAffineTransform(inverse_matrix))
+    return matrices
+
+
+def measure(function: Callable[[], Any], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def main() -> None:
+    program = argparse.ArgumentParser()
+    program.add_argument('--faces', help='face counts to measure', type=int, nargs='+', default=[1, 2, 4, 8])
+    program.add_argument('--resolutions', help='frame sizes to measure', nargs='+', default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    program.add_argument('--repeat', help='frames per measurement', type=int, default=10)
+    args = program.parse_args()
+
+    rng = np.random.default_rng(0)
+    crop = rng.integers(0, 256, (CROP_SIZE, CROP_SIZE, 3), dtype=np.uint8)
+    mask = get_feather_mask(CROP_SIZE)
+    print(f'{"resolution":<11}{"faces":>6}{"stock ms":>11}{"roi ms":>9}{"speedup":>9}{"mean diff":>11}')
+    for name in args.resolutions:
+        frame = rng.integers(0, 256, (RESOLUTIONS[name][1], RESOLUTIONS[name][0], 3), dtype=np.uint8)
+        for count in args.faces:
+            matrices = get_face_matrices(RESOLUTIONS[name], count, rng)
+
+            def run_stock() -> np.ndarray:
+                result = frame
+                for matrix in matrices:
+                    result = stock_paste_back(result, crop, matrix)
+                return result
+
+            def run_roi() -> np.ndarray:
+                result = frame
+                for matrix in matrices:
+                    result = paste_back(result.copy(), crop, matrix, mask)
+                return result
+
+            difference = np.abs(run_stock().astype(np.int16) - run_roi()).mean()
+            stock = measure(run_stock, args.repeat)
+            roi = measure(run_roi, args.repeat)
+            print(f'{name:<11}{count:>6}{stock:>11.2f}{roi:>9.2f}{stock / roi:>8.1f}x{difference:>11.3f}')
+
+
+if __name__ == '__main__':
+    main()
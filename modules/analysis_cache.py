@@ -0,0 +1,231 @@
+"""Face analysis of target video frames kept on disk between runs.
+
+Frames are addressed by a stream key (a content hash of the video, the resolution and start
+offset it was decoded at and the analysis models) and their number in that decode. Each frame
+row holds the faces as an .npz blob in SQLite, together with the analysis tasks that ran on
+them. Streams are evicted least recently used first once the cache outgrows its size limit.
+
+The cache is off unless --analysis-cache-size is set, --clear-analysis-cache deletes it. Writes
+are buffered and committed ANALYSIS_CACHE_BATCH_FRAMES frames at a time, processes flush what is
+left with flush_analysis_cache when they finish a video.
+"""
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+import modules.globals
+from modules.typing import Face
+from modules.utilities import resolve_relative_path
+from modules.utilities.status import update_status
+
+NAME = 'DLC.ANALYSIS-CACHE'
+THREAD_LOCK = threading.Lock()
+# models/ of the checkout, resolve_relative_path starts from modules/utilities
+ANALYSIS_CACHE_PATH = resolve_relative_path('../../models/analysis_cache.sqlite')
+ANALYSIS_CACHE = None
+# the video is hashed on its size and these many bytes from its start, middle and end
+VIDEO_HASH_CHUNK_SIZE = 4 << 20
+VIDEO_HASHES: Dict[Tuple[str, int, int], str] = {}
+# face attributes insightface's models write, everything a later run may read back
+CACHED_FACE_KEYS = ['bbox', 'kps', 'det_score', 'embedding', 'landmark_3d_68', 'pose', 'landmark_2d_106', 'gender', 'age']
+# face attribute an insightface task writes, when it is not named after the task
+ANALYSIS_TASK_KEYS = {
+    'detection': 'bbox',
+    'recognition': 'embedding',
+    'genderage': 'gender',
+}
+# frames buffered per write transaction
+ANALYSIS_CACHE_BATCH_FRAMES = 64
+
+
+def get_video_hash(target_path: str) -> str:
+    stat = os.stat(target_path)
+    key = (os.path.abspath(target_path), stat.st_size, stat.st_mtime_ns)
+    with THREAD_LOCK:
+        if key not in VIDEO_HASHES:
+            digest = hashlib.sha256(str(stat.st_size).encode())
+            with open(target_path, 'rb') as file:
+                for offset in sorted({0, max(0, stat.st_size // 2 - VIDEO_HASH_CHUNK_SIZE // 2), max(0, stat.st_size - VIDEO_HASH_CHUNK_SIZE)}):
+                    file.seek(offset)
+                    digest.update(file.read(VIDEO_HASH_CHUNK_SIZE))
+            VIDEO_HASHES[key] = digest.hexdigest()
+        return VIDEO_HASHES[key]
+
+
+def get_stream_key(target_path: str, resolution: Tuple[int, int], start: float = 0.0, source: str = 'stream') -> Optional[str]:
+    """Key of the frames of one decode of the target, None when the cache is disabled.
+
+    Temp frame files are numbered by ffmpeg's image muxer, which may drop or repeat frames
+    differently from a pipe decode, so they are cached under their own `source`.
+    """
+    if get_analysis_cache() is None or not target_path or not os.path.isfile(target_path):
+        return None
+    width, height = resolution
+    return f'{get_video_hash(target_path)[:32]}|{width}x{height}|{start:.3f}|{source}|{modules.globals.model_precision}'
+
+
+def get_temp_frame_number(temp_frame_path: str) -> int:
+    # extracted frames are named from 0001
+    stem = os.path.splitext(os.path.basename(temp_frame_path))[0]
+    return int(stem) - 1 if stem.isdigit() else -1
+
+
+def has_face_key(faces: List[Face], key: str) -> bool:
+    # a column is only stored when every face has it
+    return all(face.get(key) is not None for face in faces)
+
+
+def get_stored_tasks(faces: List[Face], tasks: Tuple[str, ...]) -> Tuple[str, ...]:
+    """The tasks whose results encode_faces stores for these faces, all of them without faces."""
+    return tuple(task for task in tasks if has_face_key(faces, ANALYSIS_TASK_KEYS.get(task, task)))
+
+
+def encode_faces(faces: List[Face]) -> bytes:
+    arrays: Dict[str, Any] = {'count': np.asarray(len(faces))}
+    for key in CACHED_FACE_KEYS:
+        if faces and has_face_key(faces, key):
+            arrays[key] = np.stack([np.asarray(face.get(key)) for face in faces])
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def decode_faces(data: bytes) -> List[Face]:
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        columns = {key: arrays[key] for key in CACHED_FACE_KEYS if key in arrays.files}
+        return [Face({key: values[index] for key, values in columns.items()}) for index in range(int(arrays['count']))]
+
+
+class AnalysisCache:
+    """SQLite store of analysed faces per stream and frame number, limited to `max_bytes`."""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # streams whose access time this process updated already, and those too large to keep writing
+        self.touched: Set[str] = set()
+        self.overflowed: Set[str] = set()
+        # frames put since the last flush
+        self.pending: Dict[Tuple[str, int], Tuple[List[Face], Tuple[str, ...]]] = {}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # segment and frame worker processes share the file, WAL lets them read while one writes
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS streams (stream_key TEXT PRIMARY KEY, last_access REAL NOT NULL, size INTEGER NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS frames (stream_key TEXT NOT NULL, frame_number INTEGER NOT NULL, tasks TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (stream_key, frame_number))')
+        self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM streams').fetchone()[0]
+
+    def touch(self, stream_key: str) -> None:
+        if stream_key not in self.touched:
+            self.touched.add(stream_key)
+            self.connection.execute('INSERT INTO streams VALUES (?, ?, 0) ON CONFLICT(stream_key) DO UPDATE SET last_access = excluded.last_access', (stream_key, time.time()))
+
+    def get(self, stream_key: str, frame_number: int) -> Optional[Tuple[List[Face], Tuple[str, ...]]]:
+        with self.lock:
+            pending = self.pending.get((stream_key, frame_number))
+            if pending is not None:
+                return pending
+            self.touch(stream_key)
+            row = self.connection.execute('SELECT tasks, data FROM frames WHERE stream_key = ? AND frame_number = ?', (stream_key, frame_number)).fetchone()
+        if row is None:
+            return None
+        return decode_faces(row[1]), tuple(row[0].split(','))
+
+    def put(self, stream_key: str, frame_number: int, faces: List[Face], tasks: Tuple[str, ...]) -> None:
+        """Buffer the faces of a frame, the row only claims the tasks whose results it stores."""
+        if stream_key in self.overflowed:
+            return
+        with self.lock:
+            self.pending[(stream_key, frame_number)] = (faces, get_stored_tasks(faces, tasks))
+            if len(self.pending) < ANALYSIS_CACHE_BATCH_FRAMES:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered frames in one transaction."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            rows = [(stream_key, frame_number, ','.join(tasks), encode_faces(faces)) for (stream_key, frame_number), (faces, tasks) in pending.items() if stream_key not in self.overflowed]
+            if not rows:
+                return
+            growths: Dict[str, int] = {}
+            with self.connection:
+                self.connection.execute('BEGIN IMMEDIATE')
+                for stream_key, frame_number, tasks, data in rows:
+                    previous = self.connection.execute('SELECT length(data) FROM frames WHERE stream_key = ? AND frame_number = ?', (stream_key, frame_number)).fetchone()
+                    growths[stream_key] = growths.get(stream_key, 0) + len(data) - (previous[0] if previous else 0)
+                    self.connection.execute('INSERT OR REPLACE INTO frames VALUES (?, ?, ?, ?)', (stream_key, frame_number, tasks, data))
+                # another process may have evicted a stream while this one was writing it
+                self.connection.executemany('INSERT INTO streams VALUES (?, ?, ?) ON CONFLICT(stream_key) DO UPDATE SET size = size + excluded.size', [(stream_key, time.time(), growth) for stream_key, growth in growths.items()])
+            self.size += sum(growths.values())
+            if self.size > self.max_bytes:
+                self.evict(set(growths))
+
+    def evict(self, current_stream_keys: Set[str]) -> None:
+        """Drop the least recently used streams until the cache fits, never the streams being written."""
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM streams').fetchone()[0]
+            streams = self.connection.execute('SELECT stream_key, size FROM streams ORDER BY last_access').fetchall()
+            for stream_key, size in streams:
+                if self.size <= self.max_bytes:
+                    break
+                if stream_key in current_stream_keys:
+                    continue
+                self.connection.execute('DELETE FROM frames WHERE stream_key = ?', (stream_key,))
+                self.connection.execute('DELETE FROM streams WHERE stream_key = ?', (stream_key,))
+                self.size -= size
+                update_status(f'Evicted cached analysis of {stream_key.split("|")[0][:12]} ({size / 1024 ** 2:.1f} MB).', NAME)
+        if self.size > self.max_bytes:
+            self.overflowed.update(current_stream_keys)
+            update_status('Analysis cache is full, the remaining frames of this video are not cached.', NAME)
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+
+def get_analysis_cache() -> Optional[AnalysisCache]:
+    global ANALYSIS_CACHE
+
+    if modules.globals.analysis_cache_size <= 0:
+        return None
+    with THREAD_LOCK:
+        if ANALYSIS_CACHE is None:
+            try:
+                ANALYSIS_CACHE = AnalysisCache(ANALYSIS_CACHE_PATH, modules.globals.analysis_cache_size * 1024 ** 2)
+            except sqlite3.Error as exception:
+                update_status(f'Analysis cache unavailable: {exception}', NAME)
+                modules.globals.analysis_cache_size = 0
+                return None
+        return ANALYSIS_CACHE
+
+
+def flush_analysis_cache() -> None:
+    # frame worker processes exit without running atexit handlers, so every analysis loop flushes
+    with THREAD_LOCK:
+        analysis_cache = ANALYSIS_CACHE
+    if analysis_cache is not None:
+        analysis_cache.flush()
+
+
+def clear_analysis_cache() -> None:
+    """Delete the cached analysis of every target video."""
+    global ANALYSIS_CACHE
+
+    with THREAD_LOCK:
+        if ANALYSIS_CACHE is not None:
+            ANALYSIS_CACHE.connection.close()
+            ANALYSIS_CACHE = None
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.isfile(ANALYSIS_CACHE_PATH + suffix):
+                os.remove(ANALYSIS_CACHE_PATH + suffix)
+    update_status('Cleared the analysis cache.', NAME)
@@ -0,0 +1,170 @@
+"""Pick the execution provider and thread counts that process frames fastest on this machine.
+
+--autotune times the face detector and face swapper (the models every frame runs) on a few
+frames of the target, or on frames_raw, for each available provider and split of the cores
+between frame workers and onnxruntime intra-op threads. The best configuration is stored per
+machine and applied to later runs that do not choose providers or threads themselves.
+"""
+import glob
+import json
+import os
+import platform
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import modules.globals
+from modules.model_converter import get_blob, get_feeds
+from modules.onnx_sessions import create_session
+from modules.thread_budget import get_available_cores
+from modules.utilities import is_image, is_video, resolve_relative_path
+from modules.utilities.status import update_status
+
+NAME = 'DLC.AUTOTUNE'
+# models/ of the checkout, resolve_relative_path starts from modules/utilities
+AUTOTUNE_CACHE_PATH = resolve_relative_path('../../models/autotune.json')
+AUTOTUNE_FRAMES_PATH = resolve_relative_path('../../frames_raw')
+AUTOTUNE_FRAME_COUNT = 8
+AUTOTUNE_SECONDS = 2.0
+# the models run on every frame, with the model converter's pre processing
+AUTOTUNE_MODELS = {
+    'det_10g': os.path.join(os.path.expanduser('~'), '.insightface', 'models', 'buffalo_l', 'det_10g.onnx'),
+    'inswapper': resolve_relative_path('../models/inswapper_128.onnx'),
+}
+# TensorRT and OpenVINO compile the graph per session, too slow to compare here; Azure runs remote models
+AUTOTUNE_SKIPPED_PROVIDERS = ('TensorrtExecutionProvider', 'OpenVINOExecutionProvider', 'AzureExecutionProvider')
+# frame workers feeding a GPU, its sessions leave the CPU alone
+GPU_WORKER_CANDIDATES = [1, 2, 4]
+
+
+def get_machine_key() -> str:
+    import onnxruntime
+
+    providers = ','.join(onnxruntime.get_available_providers())
+    return f'{platform.node()}|{platform.processor() or platform.machine()}|{len(get_available_cores())} cores|{providers}|ort{onnxruntime.__version__}'
+
+
+def load_autotune_cache() -> Dict[str, Any]:
+    if not os.path.isfile(AUTOTUNE_CACHE_PATH):
+        return {}
+    try:
+        with open(AUTOTUNE_CACHE_PATH, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def get_tuned_config() -> Optional[Dict[str, Any]]:
+    return load_autotune_cache().get(get_machine_key())
+
+
+def save_tuned_config(config: Dict[str, Any]) -> None:
+    cache = load_autotune_cache()
+    cache[get_machine_key()] = config
+    os.makedirs(os.path.dirname(AUTOTUNE_CACHE_PATH), exist_ok=True)
+    temp_path = f'{AUTOTUNE_CACHE_PATH}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(cache, file, indent=2)
+    os.replace(temp_path, AUTOTUNE_CACHE_PATH)
+
+
+def apply_tuned_config(config: Dict[str, Any]) -> bool:
+    import onnxruntime
+
+    providers = [provider for provider in config['providers'] if provider in onnxruntime.get_available_providers()]
+    if not providers:
+        return False
+    modules.globals.execution_providers = providers
+    modules.globals.execution_threads = config['execution_threads']
+    modules.globals.session_threads = config['session_threads']
+    update_status(f'Using tuned {", ".join(providers)} with {config["execution_threads"]} execution threads x {config["session_threads"]} session threads ({config["fps"]:.1f} fps when tuned).', NAME)
+    return True
+
+
+def load_autotune_frames(target_path: Optional[str], count: int) -> List[np.ndarray]:
+    frames = []
+    if target_path and is_video(target_path):
+        capture = cv2.VideoCapture(target_path)
+        frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        for frame_number in np.linspace(0, max(frame_total - 1, 0), count).astype(int):
+            capture.set(cv2.CAP_PROP_POS_FRAMES, int(frame_number))
+            has_frame, frame = capture.read()
+            if has_frame:
+                frames.append(frame)
+        capture.release()
+    elif target_path and is_image(target_path):
+        frames.append(cv2.imread(target_path))
+    if not frames:
+        paths = sorted(glob.glob(os.path.join(AUTOTUNE_FRAMES_PATH, '*.jpg')))[:count]
+        frames = [frame for frame in (cv2.imread(path) for path in paths) if frame is not None]
+    return frames
+
+
+def get_candidates(provider: str, cores: int) -> List[Tuple[int, int]]:
+    """(frame workers, intra-op threads) splits of the cores to time."""
+    if provider != 'CPUExecutionProvider':
+        return [(workers, 1) for workers in GPU_WORKER_CANDIDATES if workers <= cores]
+    workers_candidates = sorted({2 ** power for power in range(cores.bit_length()) if 2 ** power <= cores} | {cores})
+    return [(workers, max(1, cores // workers)) for workers in workers_candidates]
+
+
+def measure_fps(sessions: List[Tuple[str, Any]], feeds: List[List[Dict[str, np.ndarray]]], workers: int, seconds: float) -> float:
+    """Frames per second of `workers` threads sharing the sessions, like the frame workers do."""
+    counts = [0] * workers
+    deadline = 0.0
+
+    def work(index: int) -> None:
+        frame_index = index
+        while time.perf_counter() < deadline:
+            for (_, session), model_feeds in zip(sessions, feeds):
+                session.run(None, model_feeds[frame_index % len(model_feeds)])
+            counts[index] += 1
+            frame_index += workers
+
+    for (_, session), model_feeds in zip(sessions, feeds):
+        session.run(None, model_feeds[0])
+    start = time.perf_counter()
+    deadline = start + seconds
+    threads = [threading.Thread(target=work, args=(index,), daemon=True) for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time.perf_counter() - start)
+
+
+def autotune(target_path: Optional[str] = None, seconds: float = AUTOTUNE_SECONDS) -> Optional[Dict[str, Any]]:
+    import onnxruntime
+
+    models = {name: path for name, path in AUTOTUNE_MODELS.items() if os.path.isfile(path)}
+    frames = load_autotune_frames(target_path, AUTOTUNE_FRAME_COUNT)
+    if not models or not frames:
+        update_status('Autotune needs the face detector or face swapper model and sample frames, skipping.', NAME)
+        return None
+    cores = len(get_available_cores())
+    results: List[Dict[str, Any]] = []
+    for provider in onnxruntime.get_available_providers():
+        if provider in AUTOTUNE_SKIPPED_PROVIDERS:
+            continue
+        providers = [provider] if provider == 'CPUExecutionProvider' else [provider, 'CPUExecutionProvider']
+        for workers, intra_op_threads in get_candidates(provider, cores):
+            try:
+                sessions = [(name, create_session(path, providers, intra_op_threads)) for name, path in models.items()]
+                feeds = [[get_feeds(name, session, get_blob(name, [frame])) for frame in frames] for name, session in sessions]
+                fps = measure_fps(sessions, feeds, workers, seconds)
+            except Exception as exception:
+                update_status(f'{provider} failed: {exception}', NAME)
+                break
+            update_status(f'{provider:<28}{workers:>3} workers x {intra_op_threads:<3} threads {fps:>8.1f} fps', NAME)
+            results.append({'providers': providers, 'execution_threads': workers, 'session_threads': intra_op_threads, 'fps': fps})
+    if not results:
+        return None
+    config = dict(max(results, key=lambda result: result['fps']))
+    config['models'] = sorted(models)
+    config['results'] = results
+    save_tuned_config(config)
+    update_status(f'Best: {", ".join(config["providers"])} with {config["execution_threads"]} workers x {config["session_threads"]} threads, saved to {AUTOTUNE_CACHE_PATH}', NAME)
+    return config
@@ -1,34 +1,170 @@
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
+import modules.globals
 
-def find_cluster_centroids(embeddings, max_k=10) -> Any:
-    inertia = []
-    cluster_centroids = []
-    K = range(1, max_k+1)
+CLUSTER_METHODS = ['minibatch', 'kmeans', 'online']
+# cosine similarity to an identity's centroid above which a face joins it
+IDENTITY_SIMILARITY = 0.4
+# identities seen fewer times are dropped as misdetections, unless nothing else was found
+MIN_IDENTITY_FACES = 2
+# k values the k-means methods fit when --cluster-max-k is not set, every one is a full fit
+AUTO_MAX_K = 10
+MINIBATCH_SIZE = 4096
+RANDOM_STATE = 0
+# faces compared with the centroids per matrix product, bounds the similarity matrix
+SEARCH_CHUNK_SIZE = 65536
+# from this many centroids on an approximate index (faiss, when installed) beats the matrix product
+ANN_MIN_CENTROIDS = 2048
+ANN_HNSW_NEIGHBOURS = 32
+# a matrix of embeddings, or the embeddings of some faces
+Embeddings = Union[np.ndarray, Sequence[np.ndarray]]
 
-    for k in K:
-        kmeans = KMeans(n_clusters=k, random_state=0)
-        kmeans.fit(embeddings)
-        inertia.append(kmeans.inertia_)
-        cluster_centroids.append({"k": k, "centroids": kmeans.cluster_centers_})
+
+def get_max_k(count: int, max_k: int = 0) -> int:
+    return max(1, min(max_k or AUTO_MAX_K, count))
+
+
+def subsample_embeddings(embeddings: np.ndarray, sample_size: int) -> np.ndarray:
+    """Random subset the centroids are fitted on, every embedding is assigned to them afterwards."""
+    if not sample_size or len(embeddings) <= sample_size:
+        return embeddings
+    indices = np.random.default_rng(RANDOM_STATE).choice(len(embeddings), sample_size, replace=False)
+    return embeddings[np.sort(indices)]
+
+
+def fit_kmeans(embeddings: np.ndarray, k: int, method: str) -> Tuple[float, np.ndarray]:
+    # scikit-learn is only needed by map faces
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if method == 'kmeans':
+        kmeans = KMeans(n_clusters=k, random_state=RANDOM_STATE)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=k, random_state=RANDOM_STATE, batch_size=MINIBATCH_SIZE, n_init=3)
+    kmeans.fit(embeddings)
+    return kmeans.inertia_, kmeans.cluster_centers_
+
+
+def find_online_centroids(embeddings: np.ndarray, threshold: float = IDENTITY_SIMILARITY) -> np.ndarray:
+    clusters = OnlineClusters(threshold)
+    for normed_face_embedding in embeddings:
+        clusters.add(normed_face_embedding)
+    if not len(clusters):
+        return np.zeros((0, embeddings.shape[1] if embeddings.ndim == 2 else 0), dtype=np.float32)
+    return clusters.centroids[clusters.get_kept(MIN_IDENTITY_FACES)]
+
+
+def find_cluster_centroids(embeddings: Embeddings, max_k: int = 0, method: Optional[str] = None, sample_size: Optional[int] = None) -> Any:
+    """Centroids of the identities in the embeddings.
+
+    The k-means methods fit every k up to max_k in parallel and keep the k after the largest
+    drop in inertia. max_k, method and sample_size default to the --cluster-* settings.
+    """
+    method = method or modules.globals.cluster_method
+    sample_size = modules.globals.cluster_sample_size if sample_size is None else sample_size
+    embeddings = subsample_embeddings(np.asarray(embeddings, dtype=np.float32), sample_size)
+    if method == 'online':
+        return find_online_centroids(embeddings)
+
+    K = range(1, get_max_k(len(embeddings), max_k or modules.globals.cluster_max_k) + 1)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(K), modules.globals.execution_threads))) as executor:
+        fits = list(executor.map(lambda k: fit_kmeans(embeddings, k, method), K))
+    inertia = [fit[0] for fit in fits]
 
     diffs = [inertia[i] - inertia[i+1] for i in range(len(inertia)-1)]
     if not diffs:
         raise ValueError("Unable to determine optimal centroids due to empty inertia differences.")
-    optimal_centroids = cluster_centroids[diffs.index(max(diffs)) + 1]['centroids']
+    optimal_centroids = fits[diffs.index(max(diffs)) + 1][1]
 
     return optimal_centroids
 
-def find_closest_centroid(centroids: list, normed_face_embedding) -> list:
+
+def normalize_embeddings(embeddings: Embeddings) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1:
+        embeddings = embeddings.reshape(1, -1) if embeddings.size else embeddings.reshape(0, 0)
+    return np.ascontiguousarray(embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12))
+
+
+def build_ann_index(centroids: np.ndarray) -> Any:
     try:
-        centroids = np.array(centroids)
-        normed_face_embedding = np.array(normed_face_embedding)
-        similarities = np.dot(centroids, normed_face_embedding)
-        closest_centroid_index = np.argmax(similarities)
-        
-        return closest_centroid_index, centroids[closest_centroid_index]
-    except ValueError:
-        return None
\ No newline at end of file
+        import faiss
+    except ImportError:
+        return None
+    index = faiss.IndexHNSWFlat(centroids.shape[1], ANN_HNSW_NEIGHBOURS, faiss.METRIC_INNER_PRODUCT)
+    index.add(centroids)
+    return index
+
+
+class CentroidIndex:
+    """Normalised centroids in one contiguous matrix, searched for all faces of a frame or video at once."""
+
+    def __init__(self, centroids: Embeddings):
+        self.centroids = normalize_embeddings(centroids)
+        self.ann = build_ann_index(self.centroids) if len(self.centroids) >= ANN_MIN_CENTROIDS else None
+
+    def __len__(self) -> int:
+        return len(self.centroids)
+
+    def __getstate__(self) -> Dict[str, np.ndarray]:
+        # worker processes rebuild the approximate index, faiss indexes do not pickle
+        return {'centroids': self.centroids}
+
+    def __setstate__(self, state: Dict[str, np.ndarray]) -> None:
+        CentroidIndex.__init__(self, state['centroids'])
+
+    def search(self, normed_face_embeddings: Embeddings) -> Tuple[np.ndarray, np.ndarray]:
+        """Index of the closest centroid of every embedding (-1 without centroids) and its cosine similarity."""
+        if not len(self.centroids):
+            return np.full(len(normed_face_embeddings), -1, dtype=np.int64), np.zeros(len(normed_face_embeddings), dtype=np.float32)
+        embeddings = np.ascontiguousarray(normed_face_embeddings, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+        indices = np.zeros(len(embeddings), dtype=np.int64)
+        similarities = np.zeros(len(embeddings), dtype=np.float32)
+        for start in range(0, len(embeddings), SEARCH_CHUNK_SIZE):
+            chunk = slice(start, start + SEARCH_CHUNK_SIZE)
+            if self.ann is not None:
+                chunk_similarities, chunk_indices = self.ann.search(embeddings[chunk], 1)
+                indices[chunk], similarities[chunk] = chunk_indices[:, 0], chunk_similarities[:, 0]
+            else:
+                chunk_similarities = embeddings[chunk] @ self.centroids.T
+                indices[chunk] = np.argmax(chunk_similarities, axis=1)
+                similarities[chunk] = chunk_similarities[np.arange(len(chunk_similarities)), indices[chunk]]
+        return indices, similarities
+
+
+class OnlineClusters:
+    """Identities found one face at a time: a face joins the most similar centroid or starts a new one."""
+
+    def __init__(self, threshold: float = IDENTITY_SIMILARITY):
+        self.threshold = threshold
+        self.sums: Optional[np.ndarray] = None
+        self.centroids: Optional[np.ndarray] = None
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def add(self, normed_face_embedding: np.ndarray) -> Tuple[int, bool]:
+        """Cluster index of the embedding and whether it started a new cluster."""
+        normed_face_embedding = np.asarray(normed_face_embedding, dtype=np.float64)
+        if len(self.counts):
+            similarities = np.dot(self.centroids, normed_face_embedding)
+            index = int(np.argmax(similarities))
+            if similarities[index] >= self.threshold:
+                self.sums[index] += normed_face_embedding
+                self.centroids[index] = self.sums[index] / np.linalg.norm(self.sums[index])
+                self.counts[index] += 1
+                return index, False
+        if self.sums is None:
+            self.sums = normed_face_embedding[None].copy()
+            self.centroids = normed_face_embedding[None].copy()
+        else:
+            self.sums = np.vstack([self.sums, normed_face_embedding])
+            self.centroids = np.vstack([self.centroids, normed_face_embedding])
+        self.counts = np.append(self.counts, 1)
+        return len(self.counts) - 1, True
+
+    def get_kept(self, min_count: int = MIN_IDENTITY_FACES) -> List[int]:
+        """Clusters with at least min_count faces, or all of them when none has that many."""
+        return [index for index in range(len(self.counts)) if self.counts[index] >= min_count] or list(range(len(self.counts)))
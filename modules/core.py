@@ -1,8 +1,5 @@
 import os
 import sys
-# single thread doubles cuda performance - needs to be set before torch import
-if any(arg.startswith('--execution-provider') for arg in sys.argv):
-    os.environ['OMP_NUM_THREADS'] = '1'
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
@@ -11,20 +8,25 @@ import platform
 import signal
 import shutil
 import argparse
-import torch
-import onnxruntime
-import tensorflow
 from tqdm import tqdm
 
 import modules.globals
 import modules.metadata
-import modules.ui as ui
-from modules.processors.frame.core import get_frame_processors_modules, multi_process_frame
+import modules.startup_profile
+from modules.thread_budget import apply_thread_budget, plan_thread_budget
+from modules.autotune import apply_tuned_config, autotune, get_tuned_config
+from modules.analysis_cache import clear_analysis_cache
+from modules.processors.frame.core import get_frame_processors_modules, multi_process_frame, process_video_frames
+from modules.face_analyser import get_source_face
+from modules.cluster_analysis import CLUSTER_METHODS
+from modules.video_segments import process_video_segments
+from modules.job_manifest import JobManifest
 from modules.utilities import (
     has_image_extension,
     is_image,
     is_video,
     detect_fps,  # Ensure this is imported
+    detect_resolution,
     create_video,
     extract_frames,
     get_temp_frame_paths,
@@ -34,11 +36,15 @@ from modules.utilities import (
     clean_temp,
     normalize_output_path,
     get_temp_directory_path,  # Add this import
+    MODEL_PRECISIONS,
 )
 from modules.utilities.status import update_status  # Import update_status
 
-if 'ROCMExecutionProvider' in modules.globals.execution_providers:
-    del torch
+JOB_MANIFEST = None
+# manifest stage of temp frames that went through the whole processor chain
+JOB_FRAMES_STAGE = 'frames'
+# arguments a tuned configuration would override
+TUNED_ARGUMENTS = ('--execution-provider', '--execution-threads', '--session-threads', '--gpu-vendor', '--gpu-threads', '--cpu-cores')
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
@@ -50,13 +56,26 @@ def parse_args() -> None:
     program.add_argument('-s', '--source', help='select an source image', dest='source_path')
     program.add_argument('-t', '--target', help='select an target image or video', dest='target_path')
     program.add_argument('-o', '--output', help='select output file or directory', dest='output_path')
+    program.add_argument('--source-profile', help='load the source face from a saved profile (.npz), written from the source image when missing or outdated', dest='source_profile')
     program.add_argument('--frame-processor', help='pipeline of frame processors', dest='frame_processor', default=['face_swapper'], choices=['face_swapper', 'face_enhancer'], nargs='+')
     program.add_argument('--keep-fps', help='keep original fps', dest='keep_fps', action='store_true', default=False)
     program.add_argument('--keep-audio', help='keep original audio', dest='keep_audio', action='store_true', default=True)
     program.add_argument('--keep-frames', help='keep temporary frames', dest='keep_frames', action='store_true', default=False)
+    program.add_argument('--segments', help='split long videos at keyframes and process N segments in parallel processes', dest='segments', type=int, default=1)
+    program.add_argument('--resume', help='continue an interrupted video job, skipping finished frames or segments', dest='resume', action='store_true', default=False)
+    program.add_argument('--temp-frames', help='process videos through temporary frame files instead of streaming', dest='temp_frames', action='store_true', default=False)
     program.add_argument('--many-faces', help='process every face', dest='many_faces', action='store_true', default=False)
+    program.add_argument('--detect-interval', help='run face detection every N frames and track faces in between', dest='detect_interval', type=int, default=1)
+    program.add_argument('--dedup-frames', help='reuse the output of repeated frames instead of processing them again', dest='dedup_frames', action='store_true', default=False)
+    program.add_argument('--dedup-threshold', help='also reuse processed regions for frames differing by less than this mean pixel difference (0-255)', dest='dedup_threshold', type=float, default=0.0)
     program.add_argument('--nsfw-filter', help='filter the NSFW image or video', dest='nsfw_filter', action='store_true', default=False)
     program.add_argument('--map-faces', help='map source target faces', dest='map_faces', action='store_true', default=False)
+    program.add_argument('--map-analysis', help='find the target video identities on every extracted frame, or on sampled frames and match the faces while rendering', dest='map_analysis', default='full', choices=['full', 'sampled'])
+    program.add_argument('--cluster-method', help='clustering of the target identities of a full map faces analysis', dest='cluster_method', default='minibatch', choices=CLUSTER_METHODS)
+    program.add_argument('--cluster-max-k', help='most identities the k-means methods look for, 0 looks for up to 10', dest='cluster_max_k', type=int, default=0)
+    program.add_argument('--analysis-cache-size', help='megabytes of target video face analysis (embeddings, landmarks) kept between runs in models/analysis_cache.sqlite, off by default', dest='analysis_cache_size', type=int, default=0)
+    program.add_argument('--clear-analysis-cache', help='delete the face analysis kept by --analysis-cache-size', dest='clear_analysis_cache', action='store_true', default=False)
+    program.add_argument('--cluster-sample-size', help='fit the identities on this many random faces before every face is assigned, 0 fits on all of them', dest='cluster_sample_size', type=int, default=0)
     program.add_argument('--mouth-mask', help='mask the mouth region', dest='mouth_mask', action='store_true', default=False)
     program.add_argument('--video-encoder', help='adjust output video encoder', dest='video_encoder', default='libx264', choices=['libx264', 'libx265', 'libvpx-vp9'])
     program.add_argument('--video-quality', help='adjust output video quality', dest='video_quality', type=int, default=18, choices=range(52), metavar='[0-51]')
@@ -66,6 +85,16 @@ def parse_args() -> None:
     program.add_argument('--max-memory', help='maximum amount of RAM in GB', dest='max_memory', type=int, default=suggest_max_memory())
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
     program.add_argument('--execution-threads', help='number of execution threads', dest='execution_threads', type=int, default=suggest_execution_threads())
+    program.add_argument('--model-precision', help='face swapper and face analyser model variant written by modules.model_converter', dest='model_precision', default='fp32', choices=MODEL_PRECISIONS)
+    program.add_argument('--autotune', help='time the execution providers and thread counts on the target and keep the fastest for this machine', dest='autotune', action='store_true', default=False)
+    program.add_argument('--worker-backend', help='run frames on threads or in worker processes with their own models, auto uses processes on the CPU provider', dest='worker_backend', default='thread', choices=['thread', 'process', 'auto'])
+    program.add_argument('--pin-workers', help='pin each segment or frame worker process to its own share of the cores', dest='pin_workers', action='store_true', default=False)
+    program.add_argument('--session-threads', help='intra-op threads per onnxruntime session, 0 splits the cores between the execution threads', dest='session_threads', type=int, default=0)
+    program.add_argument('--swap-batch-size', help='faces per face swapper run, batched across faces and frames in flight, needs an inswapper written by model_converter inswapper --dynamic-batch', dest='swap_batch_size', type=int, default=1)
+    program.add_argument('--enhancer-backend', help='face enhancer runtime, auto prefers models/gfpgan.onnx when it exists', dest='enhancer_backend', default='auto', choices=['auto', 'onnx', 'torch'])
+    program.add_argument('--enhancer-batch-size', help='faces per ONNX face enhancer run, batched across faces and frames in flight', dest='enhancer_batch_size', type=int, default=1)
+    program.add_argument('--enhancer-sessions', help='ONNX face enhancer sessions that may run at the same time', dest='enhancer_sessions', type=int, default=1)
+    program.add_argument('--startup-profile', help='print import and startup timings', dest='startup_profile', action='store_true', default=False)
     program.add_argument('-v', '--version', action='version', version=f'{modules.metadata.name} {modules.metadata.version}')
 
     # register deprecated args
@@ -78,16 +107,39 @@ def parse_args() -> None:
 
     modules.globals.source_path = args.source_path
     modules.globals.target_path = args.target_path
-    modules.globals.output_path = normalize_output_path(modules.globals.source_path, modules.globals.target_path, args.output_path)
+    modules.globals.source_profile = args.source_profile
+    modules.globals.output_path = normalize_output_path(modules.globals.source_path or modules.globals.source_profile, modules.globals.target_path, args.output_path)
     modules.globals.frame_processors = args.frame_processor
-    modules.globals.headless = args.source_path or args.target_path or args.output_path
+    modules.globals.headless = args.source_path or args.source_profile or args.target_path or args.output_path
     modules.globals.keep_fps = args.keep_fps
     modules.globals.keep_audio = args.keep_audio
     modules.globals.keep_frames = args.keep_frames
+    modules.globals.temp_frames = args.temp_frames
+    modules.globals.segments = args.segments
+    modules.globals.resume = args.resume
     modules.globals.many_faces = args.many_faces
+    modules.globals.detect_interval = args.detect_interval
+    modules.globals.dedup_frames = args.dedup_frames or args.dedup_threshold > 0
+    modules.globals.dedup_threshold = args.dedup_threshold
+    modules.globals.model_precision = args.model_precision
+    modules.globals.session_threads = args.session_threads
+    modules.globals.pin_workers = args.pin_workers
+    modules.globals.worker_backend = args.worker_backend
+    modules.globals.autotune = args.autotune
+    modules.globals.swap_batch_size = args.swap_batch_size
+    modules.globals.enhancer_backend = args.enhancer_backend
+    modules.globals.enhancer_batch_size = args.enhancer_batch_size
+    modules.globals.enhancer_sessions = args.enhancer_sessions
     modules.globals.mouth_mask = args.mouth_mask
     modules.globals.nsfw_filter = args.nsfw_filter
     modules.globals.map_faces = args.map_faces
+    modules.globals.map_analysis = args.map_analysis
+    modules.globals.cluster_method = args.cluster_method
+    modules.globals.cluster_max_k = args.cluster_max_k
+    modules.globals.cluster_sample_size = args.cluster_sample_size
+    modules.globals.analysis_cache_size = args.analysis_cache_size
+    if args.clear_analysis_cache:
+        clear_analysis_cache()
     modules.globals.video_encoder = args.video_encoder
     modules.globals.video_quality = args.video_quality
     modules.globals.live_mirror = args.live_mirror
@@ -124,14 +176,24 @@ def parse_args() -> None:
         print('\033[33mArgument --gpu-threads is deprecated. Use --execution-threads instead.\033[0m')
         modules.globals.execution_threads = args.gpu_threads_deprecated
 
+    # a configuration tuned on this machine stands in for the providers and threads not given
+    if not args.autotune and not any(arg.startswith(TUNED_ARGUMENTS) for arg in sys.argv[1:]):
+        config = get_tuned_config()
+        if config:
+            apply_tuned_config(config)
+    apply_thread_budget(plan_thread_budget())
+
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
     return [execution_provider.replace('ExecutionProvider', '').lower() for execution_provider in execution_providers]
 
 
 def decode_execution_providers(execution_providers: List[str]) -> List[str]:
-    # Explicitly use DirectML (DmlExecutionProvider)
-    return ['DmlExecutionProvider']
+    import onnxruntime
+
+    available_providers = onnxruntime.get_available_providers()
+    return [provider for provider, encoded_provider in zip(available_providers, encode_execution_providers(available_providers))
+            if any(execution_provider in encoded_provider for execution_provider in execution_providers)]
 
 
 def suggest_max_memory() -> int:
@@ -141,6 +203,8 @@ def suggest_max_memory() -> int:
 
 
 def suggest_execution_providers() -> List[str]:
+    import onnxruntime
+
     return encode_execution_providers(onnxruntime.get_available_providers())
 
 
@@ -153,10 +217,6 @@ def suggest_execution_threads() -> int:
 
 
 def limit_resources() -> None:
-    # prevent tensorflow memory leak
-    gpus = tensorflow.config.experimental.list_physical_devices('GPU')
-    for gpu in gpus:
-        tensorflow.config.experimental.set_memory_growth(gpu, True)
     # limit memory usage
     if modules.globals.max_memory:
         memory = modules.globals.max_memory * 1024 ** 3
@@ -172,7 +232,9 @@ def limit_resources() -> None:
 
 
 def release_resources() -> None:
-    if 'CUDAExecutionProvider' in modules.globals.execution_providers:
+    # only the torch face enhancer allocates through torch, a run that never imported it has nothing to free
+    torch = sys.modules.get('torch')
+    if torch and 'CUDAExecutionProvider' in modules.globals.execution_providers:
         torch.cuda.empty_cache()
 
 
@@ -187,13 +249,15 @@ def pre_check() -> bool:
 
 
 def start() -> None:
+    global JOB_MANIFEST
+
     for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
         if not frame_processor.pre_start():
             return
     update_status('Processing...')
     # process image to image
     if has_image_extension(modules.globals.target_path):
-        if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
+        if modules.globals.nsfw_filter and check_and_ignore_nsfw(modules.globals.target_path):
             return
         try:
             shutil.copy2(modules.globals.target_path, modules.globals.output_path)
@@ -209,14 +273,31 @@ def start() -> None:
             update_status('Processing to image failed!')
         return
     # process image to videos
-    if modules.globals.nsfw_filter and ui.check_and_ignore_nsfw(modules.globals.target_path, destroy):
+    if modules.globals.nsfw_filter and check_and_ignore_nsfw(modules.globals.target_path):
         return
+    JOB_MANIFEST = JobManifest.open(modules.globals.target_path, modules.globals.resume)
+    if JOB_MANIFEST.has_progress():
+        update_status('Resuming previous job...')
+    if can_stream_video():
+        if stream_video():
+            return
+        if modules.globals.resume or JOB_MANIFEST.count_done('segments'):
+            # temp frames would start the video over, the finished segments wait for --resume
+            JOB_MANIFEST.save()
+            update_status('Processing to video failed, run again with --resume to continue.')
+            return
+        update_status('Streaming failed, falling back to temp frames...')
     try:
-        if not modules.globals.map_faces:
-            update_status('Creating temp resources...')
-            create_temp(modules.globals.target_path)
-            update_status('Extracting frames...')
-            extract_frames(modules.globals.target_path, get_temp_directory_path(modules.globals.target_path))
+        # a full map faces analysis extracted the frames already
+        if not uses_target_face_index():
+            if JOB_MANIFEST.get('frames_extracted') and get_temp_frame_paths(modules.globals.target_path):
+                update_status('Reusing extracted frames...')
+            else:
+                update_status('Creating temp resources...')
+                create_temp(modules.globals.target_path)
+                update_status('Extracting frames...')
+                extract_frames(modules.globals.target_path, get_temp_directory_path(modules.globals.target_path))
+                JOB_MANIFEST.set('frames_extracted', True)
     except Exception as e:
         update_status(f"Error during frame extraction: {e}", "DLC.CORE")
         return
@@ -225,13 +306,23 @@ def start() -> None:
     if not temp_frame_paths:
         update_status("No frames were extracted. Please check the input video.", "DLC.CORE")
         return
-    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
-        update_status('Progressing...', frame_processor.NAME)
-        if not hasattr(frame_processor, 'process_video') or not callable(frame_processor.process_video):
-            update_status(f"Error: Frame processor {frame_processor.NAME} does not have a callable process_video method.", "DLC.CORE")
-            continue
-        frame_processor.process_video(modules.globals.source_path, temp_frame_paths, frame_processor.process_frames)  # Pass the correct callable
+    # every processor runs on the frame in memory, so each temp frame is read and written once
+    pending_frame_paths = JOB_MANIFEST.pending(temp_frame_paths, JOB_FRAMES_STAGE)
+    if pending_frame_paths:
+        update_status('Progressing...')
+        source_face = None if modules.globals.map_faces else get_source_face()
+        try:
+            process_video_frames(source_face, pending_frame_paths, lambda frame_path, frame: JOB_MANIFEST.write_frame(frame_path, frame, JOB_FRAMES_STAGE))
+        except Exception as e:
+            # the frames finished so far stay recorded for --resume
+            JOB_MANIFEST.save()
+            update_status(f"Error during frame processing: {e}", "DLC.CORE")
+            update_status('Processing to video failed!')
+            return
+        JOB_MANIFEST.save()
         release_resources()
+    else:
+        update_status('All frames already processed, skipping.')
     # handles fps
     if modules.globals.keep_fps:
         update_status('Detecting fps...')
@@ -251,6 +342,8 @@ def start() -> None:
     else:
         move_temp(modules.globals.target_path, modules.globals.output_path)
     # clean and validate
+    JOB_MANIFEST.remove()
+    JOB_MANIFEST = None
     clean_temp(modules.globals.target_path)
     if is_video(modules.globals.target_path):
         update_status('Processing to video succeed!')
@@ -258,22 +351,80 @@ def start() -> None:
         update_status('Processing to video failed!')
 
 
+def check_and_ignore_nsfw(target_path: str) -> bool:
+    import modules.ui as ui
+
+    return ui.check_and_ignore_nsfw(target_path, destroy)
+
+
+def uses_target_face_index() -> bool:
+    return modules.globals.map_faces and modules.globals.target_face_index is not None
+
+
+def can_stream_video() -> bool:
+    # the map faces index resolves target faces by temp frame path and keep frames needs the files on disk
+    return not (modules.globals.temp_frames or modules.globals.keep_frames or uses_target_face_index())
+
+
+def stream_video() -> bool:
+    global JOB_MANIFEST
+
+    try:
+        resolution = detect_resolution(modules.globals.target_path)
+    except Exception as e:
+        update_status(f"Error detecting resolution: {e}", "DLC.CORE")
+        return False
+    fps = 30.0
+    if modules.globals.keep_fps:
+        update_status('Detecting fps...')
+        fps = detect_fps(modules.globals.target_path)
+    source_face = get_source_face()
+    update_status(f'Streaming video with {fps} fps...')
+    # every job runs in segments recorded in the manifest, so a crash only costs the unfinished ones
+    if not process_video_segments(source_face, modules.globals.target_path, modules.globals.output_path, fps, resolution, JOB_MANIFEST):
+        if not (modules.globals.resume or JOB_MANIFEST.count_done('segments')):
+            clean_temp(modules.globals.target_path)
+        return False
+    JOB_MANIFEST.remove()
+    JOB_MANIFEST = None
+    clean_temp(modules.globals.target_path)
+    release_resources()
+    if is_video(modules.globals.output_path):
+        update_status('Processing to video succeed!')
+        return True
+    return False
+
+
 def destroy(to_quit=True) -> None:
-    if modules.globals.target_path:
+    if JOB_MANIFEST and JOB_MANIFEST.has_progress():
+        # keep the finished work on disk for a later --resume
+        JOB_MANIFEST.save()
+        update_status('Job interrupted, run again with --resume to continue.')
+    elif modules.globals.target_path:
         clean_temp(modules.globals.target_path)
     if to_quit: quit()
 
 
 def run() -> None:
+    modules.startup_profile.mark('imports')
     parse_args()
+    modules.startup_profile.mark('arguments')
     if not pre_check():
         return
     for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
         if not frame_processor.pre_check():
             return
+    modules.startup_profile.mark('frame processors')
+    if modules.globals.autotune:
+        config = autotune(modules.globals.target_path)
+        if config and apply_tuned_config(config):
+            apply_thread_budget(plan_thread_budget())
     limit_resources()
+    modules.startup_profile.report()
     if modules.globals.headless:
         start()
     else:
+        import modules.ui as ui
+
         window = ui.init(start, destroy, modules.globals.lang)
         window.mainloop()
@@ -1,44 +1,357 @@
+import glob
 import os
 import shutil
-from typing import Any
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 import insightface
+from insightface.utils.storage import ensure_available
 
 import cv2
 import numpy as np
 import modules.globals
 from tqdm import tqdm
-from modules.typing import Frame
-from modules.cluster_analysis import find_cluster_centroids, find_closest_centroid
-from modules.utilities import get_temp_directory_path, create_temp, extract_frames, clean_temp, get_temp_frame_paths
-from modules.utilities.ffmpeg_utils import run_ffmpeg  # Update import
+from modules.typing import Face, Frame
+from modules.analysis_cache import ANALYSIS_TASK_KEYS, flush_analysis_cache, get_analysis_cache, get_stream_key, get_temp_frame_number
+from modules.onnx_sessions import get_insightface_model
+from modules.cluster_analysis import IDENTITY_SIMILARITY, CentroidIndex, OnlineClusters, find_cluster_centroids
+from modules.utilities import get_model_variant_path, resolve_relative_path, get_temp_directory_path, create_temp, extract_frames, clean_temp, get_temp_frame_paths, detect_fps, detect_resolution
+from modules.utilities.ffmpeg_utils import FFmpegFrameReader, run_ffmpeg  # Update import
+from modules.utilities.status import update_status
 from pathlib import Path
 
+NAME = 'DLC.FACE-ANALYSER'
 FACE_ANALYSER = None
+SOURCE_FACES: Dict[Tuple[str, int, int], Any] = {}
+SOURCE_FACES_LOCK = threading.Lock()
+# insightface task names of buffalo_l, each profile only runs the models its callers read from
+ANALYSIS_PROFILES: Dict[str, Tuple[str, ...]] = {
+    'detect': ('detection',),
+    'detect+embed': ('detection', 'recognition'),
+    'full': ('detection', 'landmark_3d_68', 'landmark_2d_106', 'genderage', 'recognition'),
+}
+# buffalo_l models modules.model_converter writes precision variants of
+ANALYSIS_MODEL_VARIANTS = ('det_10g.onnx', 'w600k_r50.onnx')
+TRACK_THUMBNAIL_SIZE = (64, 36)
+# mean absolute difference of the thumbnails (0-255) above which a frame counts as a scene cut
+TRACK_SCENE_THRESHOLD = 30.0
+TRACK_MAX_ERROR = 1.5
+TRACK_MIN_POINTS = 4
+TRACK_FLOW_PARAMS: Dict[str, Any] = {
+    'winSize': (21, 21),
+    'maxLevel': 3,
+    'criteria': (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+}
+SOURCE_PROFILE_KEYS = ['bbox', 'kps', 'det_score', 'embedding', 'gender', 'age']
+# output size of buffalo_l's recognition model
+FACE_EMBEDDING_SIZE = 512
+# sampled map faces analysis decodes frames at most this wide, plenty for the 640 pixel detector
+MAP_SAMPLE_WIDTH = 1280
+# frames between samples right after a scene cut, the stride then doubles up to a sample every few seconds
+MAP_SAMPLE_MIN_STRIDE = 2
+MAP_SAMPLE_MAX_SECONDS = 2.0
+
+
+class FaceAnalyser(insightface.app.FaceAnalysis):
+    """insightface's FaceAnalysis with its models loaded through modules.onnx_sessions.
+
+    Precision variants written by modules.model_converter replace the models they were derived from.
+    """
+
+    def __init__(self, name: str = 'buffalo_l', root: str = '~/.insightface', providers: Optional[List[str]] = None, precision: str = 'fp32'):
+        self.models: Dict[str, Any] = {}
+        self.model_dir = ensure_available('models', name, root=root)
+        for model_path in sorted(glob.glob(os.path.join(self.model_dir, '*.onnx'))):
+            model = get_insightface_model(get_analysis_model_path(model_path, precision), providers, model_path)
+            if model is None:
+                update_status(f'Model not recognized: {model_path}', NAME)
+            elif model.taskname not in self.models:
+                self.models[model.taskname] = model
+        if 'detection' not in self.models:
+            raise FileNotFoundError(f'No face detection model in {self.model_dir}')
+        self.det_model = self.models['detection']
+
+
+def get_analysis_model_path(model_path: str, precision: str) -> str:
+    # variants live outside the insightface model directory, its models are all loaded by globbing it
+    if precision == 'fp32' or os.path.basename(model_path) not in ANALYSIS_MODEL_VARIANTS:
+        return model_path
+    variant_path = get_model_variant_path(os.path.join(resolve_relative_path('../models/buffalo_l'), os.path.basename(model_path)), precision)
+    if not os.path.exists(variant_path):
+        update_status(f'{os.path.basename(variant_path)} not found, run \'python -m modules.model_converter buffalo\'. Loading the FP32 model.', NAME)
+        return model_path
+    return variant_path
 
 
 def get_face_analyser() -> Any:
     global FACE_ANALYSER
 
     if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.globals.execution_providers)
+        FACE_ANALYSER = FaceAnalyser(name='buffalo_l', providers=modules.globals.execution_providers, precision=modules.globals.model_precision)
         FACE_ANALYSER.prepare(ctx_id=-1, det_size=(640, 640))
     return FACE_ANALYSER
 
 
-def get_one_face(frame: Frame) -> Any:
-    face = get_face_analyser().get(frame)
+def get_file_key(path: str) -> Tuple[str, int, int]:
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+def get_cached_face(path: str, analyse: Any) -> Any:
+    key = get_file_key(path)
+    with SOURCE_FACES_LOCK:
+        if key not in SOURCE_FACES:
+            SOURCE_FACES[key] = analyse(path)
+        return SOURCE_FACES[key]
+
+
+def analyse_source_image(source_path: str) -> Any:
+    source_image = cv2.imread(source_path)
+    if source_image is None:
+        return None
+    return get_one_face(source_image, 'detect+embed')
+
+
+def save_source_profile(face: Face, profile_path: str, source_path: str = None) -> None:
+    profile: Dict[str, Any] = {name: np.asarray(face[name]) for name in SOURCE_PROFILE_KEYS if face.get(name) is not None}
+    if source_path:
+        _, size, mtime_ns = get_file_key(source_path)
+        profile['source_size'] = np.asarray(size)
+        profile['source_mtime_ns'] = np.asarray(mtime_ns)
+    with open(profile_path, 'wb') as file:
+        np.savez(file, **profile)
+
+
+def load_source_profile(profile_path: str) -> Any:
+    with np.load(profile_path, allow_pickle=False) as profile:
+        return Face({name: profile[name] for name in SOURCE_PROFILE_KEYS if name in profile.files})
+
+
+def is_source_profile_stale(profile_path: str, source_path: str) -> bool:
+    _, size, mtime_ns = get_file_key(source_path)
+    with np.load(profile_path, allow_pickle=False) as profile:
+        if 'source_size' not in profile.files:
+            return False
+        return int(profile['source_size']) != size or int(profile['source_mtime_ns']) != mtime_ns
+
+
+def get_source_face() -> Any:
+    profile_path = modules.globals.source_profile
+    source_path = modules.globals.source_path
+    has_source = bool(source_path) and os.path.isfile(source_path)
+    if profile_path and os.path.isfile(profile_path) and not (has_source and is_source_profile_stale(profile_path, source_path)):
+        return get_cached_face(profile_path, load_source_profile)
+    if not has_source:
+        return None
+    source_face = get_cached_face(source_path, analyse_source_image)
+    if source_face is not None and profile_path:
+        save_source_profile(source_face, profile_path, source_path)
+    return source_face
+
+
+def analyse_faces(frame: Frame, faces: List[Face], profile: str = 'full') -> List[Face]:
+    """Run the models of a profile on already detected faces, skipping work done before."""
+    tasks = ANALYSIS_PROFILES[profile]
+    for taskname, model in get_face_analyser().models.items():
+        if taskname == 'detection' or taskname not in tasks:
+            continue
+        for face in faces:
+            if face.get(ANALYSIS_TASK_KEYS.get(taskname, taskname)) is None:
+                model.get(frame, face)
+    return faces
+
+
+def detect_faces(frame: Frame, profile: str = 'full', frame_key: Optional[Tuple[str, int]] = None) -> List[Face]:
+    """Faces of a frame, read from the analysis cache when `frame_key` (stream key, frame number) is in it."""
+    stream_key, frame_number = frame_key or ('', -1)
+    analysis_cache = get_analysis_cache() if stream_key and frame_number >= 0 else None
+    cached = analysis_cache.get(stream_key, frame_number) if analysis_cache else None
+    if cached is not None:
+        faces, tasks = cached
+        if set(ANALYSIS_PROFILES[profile]) <= set(tasks):
+            return faces
+    else:
+        bboxes, kpss = get_face_analyser().det_model.detect(frame, max_num=0, metric='default')
+        faces = []
+        for index in range(bboxes.shape[0]):
+            kps = kpss[index] if kpss is not None else None
+            faces.append(Face(bbox=bboxes[index, 0:4], kps=kps, det_score=bboxes[index, 4]))
+        tasks = ('detection',)
+    faces = analyse_faces(frame, faces, profile)
+    if analysis_cache:
+        analysis_cache.put(stream_key, frame_number, faces, tuple(sorted(set(tasks) | set(ANALYSIS_PROFILES[profile]))))
+    return faces
+
+
+def select_one_face(faces: List[Face]) -> Any:
     try:
-        return min(face, key=lambda x: x.bbox[0])
+        return min(faces, key=lambda x: x.bbox[0])
     except ValueError:
         return None
 
 
-def get_many_faces(frame: Frame) -> Any:
+def get_one_face(frame: Frame, profile: str = 'full') -> Any:
+    return select_one_face(detect_faces(frame, profile))
+
+
+def get_many_faces(frame: Frame, profile: str = 'full', frame_key: Optional[Tuple[str, int]] = None) -> Any:
     try:
-        return get_face_analyser().get(frame)
+        return detect_faces(frame, profile, frame_key)
     except IndexError:
         return None
 
+class FaceTracker:
+    """Run the detector every few frames and follow the faces with optical flow in between.
+
+    Frames must be passed in display order. Keypoints are tracked with pyramidal Lucas-Kanade
+    and verified by a forward-backward check; the detector runs again once the interval is
+    reached, on a scene change or as soon as a face can no longer be tracked reliably.
+    """
+
+    def __init__(self, detect_interval: int, profile: str = 'detect'):
+        self.detect_interval = max(1, detect_interval)
+        self.profile = profile
+        self.faces: List[Face] = []
+        self.previous_gray: Optional[Frame] = None
+        self.previous_thumbnail: Optional[Frame] = None
+        self.frames_since_detection = 0
+        self.frame_count = 0
+        self.detector_calls = 0
+
+    def track(self, frame: Frame) -> List[Face]:
+        self.frame_count += 1
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, TRACK_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+        faces = None
+        if self.can_propagate(gray, thumbnail):
+            faces = self.propagate(gray)
+        if faces is None:
+            faces = detect_faces(frame, self.profile)
+            self.detector_calls += 1
+            self.frames_since_detection = 0
+        self.frames_since_detection += 1
+        self.faces = faces
+        self.previous_gray = gray
+        self.previous_thumbnail = thumbnail
+        return faces
+
+    def can_propagate(self, gray: Frame, thumbnail: Frame) -> bool:
+        if self.previous_gray is None or self.previous_gray.shape != gray.shape:
+            return False
+        if self.frames_since_detection >= self.detect_interval:
+            return False
+        scene_difference = cv2.absdiff(thumbnail, self.previous_thumbnail).mean()
+        return scene_difference < TRACK_SCENE_THRESHOLD
+
+    def propagate(self, gray: Frame) -> Any:
+        previous_gray = self.previous_gray
+        if previous_gray is None or not self.faces:
+            return []
+        points = np.concatenate([face.kps for face in self.faces]).astype(np.float32).reshape(-1, 1, 2)
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, gray, points, np.empty_like(points), **TRACK_FLOW_PARAMS)
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, previous_gray, next_points, np.empty_like(points), **TRACK_FLOW_PARAMS)
+        error = np.linalg.norm(points - back_points, axis=2).reshape(-1)
+        valid = (status.reshape(-1) == 1) & (back_status.reshape(-1) == 1) & (error < TRACK_MAX_ERROR)
+
+        faces = []
+        for index, face in enumerate(self.faces):
+            rows = slice(index * 5, index * 5 + 5)
+            face_valid = valid[rows]
+            if face_valid.sum() < TRACK_MIN_POINTS:
+                return None
+            old_points = points[rows].reshape(-1, 2)
+            new_points = next_points[rows].reshape(-1, 2)
+            matrix, _ = cv2.estimateAffinePartial2D(old_points[face_valid], new_points[face_valid])
+            if matrix is None:
+                return None
+            x_min, y_min, x_max, y_max = face.bbox
+            box_corners = np.array([[x_min, y_min], [x_max, y_min], [x_min, y_max], [x_max, y_max]], dtype=np.float32)
+            corners = cv2.transform(box_corners.reshape(-1, 1, 2), matrix).reshape(-1, 2)
+            kps = cv2.transform(old_points.reshape(-1, 1, 2), matrix).reshape(-1, 2)
+            bbox = np.concatenate([corners.min(axis=0), corners.max(axis=0)])
+            faces.append(Face(dict(face), bbox=bbox, kps=kps))
+        return faces
+
+    def report(self, scope: str = NAME) -> None:
+        if self.frame_count:
+            update_status(f'Face tracker ran the detector on {self.detector_calls} of {self.frame_count} frames', scope)
+
+
+class FaceIndex:
+    """Faces of every frame of a video, stored column-wise in NumPy arrays.
+
+    Rows are grouped by frame: the faces of frame `n` are rows `offsets[n]:offsets[n + 1]`, so
+    looking up a frame costs a dictionary access and a slice whatever the length of the video.
+    Faces are added frame by frame and packed into contiguous arrays by `finish`.
+    """
+
+    def __init__(self) -> None:
+        self.frame_paths: List[str] = []
+        self.frame_numbers: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.bboxes = np.zeros((0, 4), dtype=np.float32)
+        self.kpss = np.zeros((0, 5, 2), dtype=np.float32)
+        self.embeddings = np.zeros((0, FACE_EMBEDDING_SIZE), dtype=np.float32)
+        self.det_scores = np.zeros(0, dtype=np.float32)
+        self.cluster_ids = np.zeros(0, dtype=np.int32)
+        self.pending: List[Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]] = []
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1]) + sum(len(scores) for *_, scores in self.pending)
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.frame_paths)
+
+    @property
+    def nbytes(self) -> int:
+        return self.offsets.nbytes + self.bboxes.nbytes + self.kpss.nbytes + self.embeddings.nbytes + self.det_scores.nbytes + self.cluster_ids.nbytes
+
+    def add_frame(self, frame_path: str, faces: List[Face]) -> int:
+        frame_number = len(self.frame_paths)
+        self.frame_paths.append(frame_path)
+        self.frame_numbers[os.path.normpath(frame_path)] = frame_number
+        faces = faces or []
+        self.pending.append((
+            np.array([face.bbox for face in faces], dtype=np.float32).reshape(-1, 4),
+            np.array([face.kps if face.kps is not None else np.zeros((5, 2)) for face in faces], dtype=np.float32).reshape(-1, 5, 2),
+            np.array([face.normed_embedding for face in faces], dtype=np.float32).reshape(-1, self.embeddings.shape[1]),
+            np.array([face.det_score for face in faces], dtype=np.float32).reshape(-1),
+        ))
+        return frame_number
+
+    def finish(self) -> 'FaceIndex':
+        if not self.pending:
+            return self
+        counts = [len(scores) for *_, scores in self.pending]
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(counts, dtype=np.int64)])
+        bboxes, kpss, embeddings, det_scores = zip(*self.pending)
+        self.bboxes = np.concatenate([self.bboxes, *bboxes])
+        self.kpss = np.concatenate([self.kpss, *kpss])
+        self.embeddings = np.concatenate([self.embeddings, *embeddings])
+        self.det_scores = np.concatenate([self.det_scores, *det_scores])
+        self.cluster_ids = np.concatenate([self.cluster_ids, np.full(sum(counts), -1, dtype=np.int32)])
+        self.pending = []
+        return self
+
+    def get_frame_number(self, frame_path: str) -> int:
+        return self.frame_numbers.get(os.path.normpath(frame_path), -1)
+
+    def get_rows(self, frame_number: int) -> slice:
+        if frame_number < 0 or frame_number >= len(self.offsets) - 1:
+            return slice(0, 0)
+        return slice(int(self.offsets[frame_number]), int(self.offsets[frame_number + 1]))
+
+    def get_frame_of_row(self, row: int) -> int:
+        return int(np.searchsorted(self.offsets, row, side='right')) - 1
+
+    def get_face(self, row: int) -> Face:
+        return Face(bbox=self.bboxes[row], kps=self.kpss[row], det_score=self.det_scores[row], embedding=self.embeddings[row], target_centroid=int(self.cluster_ids[row]))
+
+    def get_faces(self, frame_path: str, cluster_id: Optional[int] = None) -> List[Face]:
+        rows = self.get_rows(self.get_frame_number(frame_path))
+        return [self.get_face(row) for row in range(rows.start, rows.stop) if cluster_id is None or self.cluster_ids[row] == cluster_id]
+
+
 def has_valid_map() -> bool:
     for map in modules.globals.source_target_map:
         if "source" in map and "target" in map:
@@ -59,9 +372,28 @@ def simplify_maps() -> Any:
             centroids.append(map['target']['face'].normed_embedding)
             faces.append(map['source']['face'])
 
-    modules.globals.simple_map = {'source_faces': faces, 'target_embeddings': centroids}
+    # built once, the live loop matches all faces of a frame with one matrix product
+    target_index = CentroidIndex(centroids)
+    modules.globals.simple_map = {'source_faces': faces, 'target_embeddings': target_index.centroids, 'target_index': target_index}
     return None
 
+def match_target_faces(faces: List[Face]) -> List[Tuple[Dict[str, Any], Face]]:
+    """Map entry of the nearest target identity of every face, for targets analysed without a face index.
+
+    Faces too far from every identity, people the analysis dropped or never saw, are left out.
+    """
+    map_entries = [map for map in modules.globals.source_target_map if "target" in map]
+    if not map_entries or not faces:
+        return []
+    # a handful of identities, stacking them per frame costs less than keeping a cache in step with the map
+    target_index = CentroidIndex([map['target'].get('centroid', map['target']['face'].normed_embedding) for map in map_entries])
+    closest_centroid_indices, similarities = target_index.search([face.normed_embedding for face in faces])
+    return [
+        (map_entries[closest_centroid_index], face)
+        for closest_centroid_index, similarity, face in zip(closest_centroid_indices, similarities, faces)
+        if similarity >= IDENTITY_SIMILARITY
+    ]
+
 def add_blank_map() -> Any:
     try:
         max_id = -1
@@ -77,8 +409,9 @@ def add_blank_map() -> Any:
 def get_unique_faces_from_target_image() -> Any:
     try:
         modules.globals.source_target_map = []
+        modules.globals.target_face_index = None
         target_frame = cv2.imread(modules.globals.target_path)
-        many_faces = get_many_faces(target_frame)
+        many_faces = get_many_faces(target_frame, 'detect+embed')
         i = 0
 
         for face in many_faces:
@@ -96,10 +429,12 @@ def get_unique_faces_from_target_image() -> Any:
     
     
 def get_unique_faces_from_target_video() -> Any:
+    if modules.globals.map_analysis == 'sampled':
+        return sample_unique_faces_from_target_video()
     try:
         modules.globals.source_target_map = []
-        frame_face_embeddings = []
-        face_embeddings = []
+        modules.globals.target_face_index = None
+        face_index = FaceIndex()
     
         print('Creating temp resources...')
         clean_temp(modules.globals.target_path)
@@ -108,83 +443,142 @@ def get_unique_faces_from_target_video() -> Any:
         extract_frames(modules.globals.target_path)
 
         temp_frame_paths = get_temp_frame_paths(modules.globals.target_path)
+        # known once the first frame is read, empty when the analysis cache is off
+        stream_key = None
 
-        i = 0
         for temp_frame_path in tqdm(temp_frame_paths, desc="Extracting face embeddings from frames"):
             temp_frame = cv2.imread(temp_frame_path)
-            many_faces = get_many_faces(temp_frame)
+            if stream_key is None and temp_frame is not None:
+                stream_key = get_stream_key(modules.globals.target_path, (temp_frame.shape[1], temp_frame.shape[0]), source='frames') or ''
+            face_index.add_frame(temp_frame_path, get_many_faces(temp_frame, 'detect+embed', (stream_key, get_temp_frame_number(temp_frame_path))))
+        face_index.finish()
+        flush_analysis_cache()
 
-            for face in many_faces:
-                face_embeddings.append(face.normed_embedding)
-            
-            frame_face_embeddings.append({'frame': i, 'faces': many_faces, 'location': temp_frame_path})
-            i += 1
+        centroids = find_cluster_centroids(face_index.embeddings)
 
-        centroids = find_cluster_centroids(face_embeddings)
-
-        for frame in frame_face_embeddings:
-            for face in frame['faces']:
-                closest_centroid_index, _ = find_closest_centroid(centroids, face.normed_embedding)
-                face['target_centroid'] = closest_centroid_index
+        # every face of the video against every centroid, in chunked matrix products
+        face_index.cluster_ids = CentroidIndex(centroids).search(face_index.embeddings)[0].astype(np.int32)
 
         for i in range(len(centroids)):
             modules.globals.source_target_map.append({
                 'id' : i
             })
+        modules.globals.target_face_index = face_index
+        update_status(f'Indexed {len(face_index)} faces in {face_index.frame_count} frames ({face_index.nbytes / 1024 ** 2:.1f} MB).', NAME)
 
-            temp = []
-            for frame in tqdm(frame_face_embeddings, desc=f"Mapping frame embeddings to centroids-{i}"):
-                temp.append({'frame': frame['frame'], 'faces': [face for face in frame['faces'] if face['target_centroid'] == i], 'location': frame['location']})
-
-            modules.globals.source_target_map[i]['target_faces_in_frame'] = temp
-
-        # dump_faces(centroids, frame_face_embeddings)
+        # dump_faces(face_index)
         default_target_face()
     except ValueError:
         return None
     
 
-def default_target_face():
+def get_sample_resolution(resolution: Tuple[int, int]) -> Tuple[int, int]:
+    width, height = resolution
+    if width <= MAP_SAMPLE_WIDTH:
+        return width, height
+    # even sizes, as the decoder's scaler produces them
+    return MAP_SAMPLE_WIDTH, max(2, round(height * MAP_SAMPLE_WIDTH / width / 2) * 2)
+
+
+def sample_unique_faces_from_target_video() -> Any:
+    """Find the identities of the target video on sampled frames streamed from ffmpeg.
+
+    Frames are sampled densely after scene cuts and further apart while the shot goes on, up
+    to the end of the video so people who only appear late are found too. Every face joins an
+    identity as soon as it is seen. The faces of each frame are assigned to the identities while
+    the video is rendered, see match_target_faces.
+    """
+    modules.globals.source_target_map = []
+    modules.globals.target_face_index = None
+    target_path = modules.globals.target_path
+    resolution = detect_resolution(target_path)
+    sample_resolution = get_sample_resolution(resolution)
+    output_args = ['-vf', f'scale={sample_resolution[0]}:{sample_resolution[1]}'] if sample_resolution != resolution else []
+    max_stride = max(MAP_SAMPLE_MIN_STRIDE, round(detect_fps(target_path) * MAP_SAMPLE_MAX_SECONDS))
+    stream_key = get_stream_key(target_path, sample_resolution)
+    identities = OnlineClusters()
+    best_faces: Dict[int, Tuple[float, Face, Frame]] = {}
+    stride = MAP_SAMPLE_MIN_STRIDE
+    next_sample = 0
+    sample_count = 0
+    previous_thumbnail = None
+    reader = FFmpegFrameReader(target_path, sample_resolution, output_args=output_args)
+    try:
+        for frame_number, frame in enumerate(tqdm(reader, desc='Sampling faces', unit='frame')):
+            thumbnail = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), TRACK_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+            if previous_thumbnail is not None and cv2.absdiff(thumbnail, previous_thumbnail).mean() >= TRACK_SCENE_THRESHOLD:
+                # a new shot may bring new people
+                stride = MAP_SAMPLE_MIN_STRIDE
+                next_sample = frame_number
+            previous_thumbnail = thumbnail
+            if frame_number < next_sample:
+                continue
+            for face in get_many_faces(frame, 'detect+embed', (stream_key, frame_number)) or []:
+                identity, _ = identities.add(face.normed_embedding)
+                if identity not in best_faces or face.det_score > best_faces[identity][0]:
+                    x_min, y_min, x_max, y_max = face.bbox
+                    best_faces[identity] = (face.det_score, face, frame[max(0, int(y_min)):int(y_max), max(0, int(x_min)):int(x_max)].copy())
+            sample_count += 1
+            stride = min(stride * 2, max_stride)
+            next_sample = frame_number + stride
+    finally:
+        reader.close()
+        flush_analysis_cache()
+    if not len(identities):
+        return None
+
+    kept = identities.get_kept()
+    centroids = identities.centroids
+    for i, identity in enumerate(kept):
+        _, face, crop = best_faces[identity]
+        modules.globals.source_target_map.append({
+            'id' : i,
+            'target' : {
+                        'cv2' : crop,
+                        'face' : face,
+                        'centroid' : centroids[identity]
+                        }
+            })
+    update_status(f'Found {len(kept)} identities on {sample_count} sampled frames of {frame_number + 1}.', NAME)
+    return None
+
+
+def default_target_face() -> None:
+    face_index: FaceIndex = modules.globals.target_face_index
     for map in modules.globals.source_target_map:
-        best_face = None
-        best_frame = None
-        for frame in map['target_faces_in_frame']:
-            if len(frame['faces']) > 0:
-                best_face = frame['faces'][0]
-                best_frame = frame
-                break
-
-        for frame in map['target_faces_in_frame']:
-            for face in frame['faces']:
-                if face['det_score'] > best_face['det_score']:
-                    best_face = face
-                    best_frame = frame
+        rows = np.flatnonzero(face_index.cluster_ids == map['id'])
+        if len(rows) == 0:
+            continue
+        # the first of the faces with the highest detection score, in frame order
+        best_row = int(rows[np.argmax(face_index.det_scores[rows])])
+        best_face = face_index.get_face(best_row)
 
         x_min, y_min, x_max, y_max = best_face['bbox']
 
-        target_frame = cv2.imread(best_frame['location'])
+        target_frame = cv2.imread(face_index.frame_paths[face_index.get_frame_of_row(best_row)])
         map['target'] = {
                         'cv2' : target_frame[int(y_min):int(y_max), int(x_min):int(x_max)],
                         'face' : best_face
                         }
 
 
-def dump_faces(centroids: Any, frame_face_embeddings: list):
+def dump_faces(face_index: FaceIndex) -> None:
     temp_directory_path = get_temp_directory_path(modules.globals.target_path)
 
-    for i in range(len(centroids)):
+    for i in range(int(face_index.cluster_ids.max(initial=-1)) + 1):
         if os.path.exists(temp_directory_path + f"/{i}") and os.path.isdir(temp_directory_path + f"/{i}"):
             shutil.rmtree(temp_directory_path + f"/{i}")
         Path(temp_directory_path + f"/{i}").mkdir(parents=True, exist_ok=True)
 
-        for frame in tqdm(frame_face_embeddings, desc=f"Copying faces to temp/./{i}"):
-            temp_frame = cv2.imread(frame['location'])
+        for frame_number, frame_path in enumerate(tqdm(face_index.frame_paths, desc=f"Copying faces to temp/./{i}")):
+            rows = face_index.get_rows(frame_number)
+            if not np.any(face_index.cluster_ids[rows] == i):
+                continue
+            temp_frame = cv2.imread(frame_path)
 
-            j = 0
-            for face in frame['faces']:
-                if face['target_centroid'] == i:
-                    x_min, y_min, x_max, y_max = face['bbox']
+            for j, row in enumerate(range(rows.start, rows.stop)):
+                if face_index.cluster_ids[row] == i:
+                    x_min, y_min, x_max, y_max = face_index.bboxes[row]
 
                     if temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)].size > 0:
-                        cv2.imwrite(temp_directory_path + f"/{i}/{frame['frame']}_{j}.png", temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)])
-                j += 1
\ No newline at end of file
+                        cv2.imwrite(temp_directory_path + f"/{i}/{frame_number}_{j}.png", temp_frame[int(y_min):int(y_max), int(x_min):int(x_max)])
@@ -0,0 +1,64 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from modules.face_analyser import analyse_faces, detect_faces, select_one_face
+from modules.typing import Face, Frame
+
+# five point templates (eyes, nose, mouth corners) and the crop size they are defined for
+ALIGNMENT_TEMPLATES: Dict[str, Tuple[np.ndarray, int]] = {
+    'ffhq_512': (np.array([
+        [192.98138, 239.94708],
+        [318.90277, 240.19360],
+        [256.63416, 314.01935],
+        [201.26117, 371.41043],
+        [313.08905, 371.15118],
+    ], dtype=np.float32), 512),
+}
+
+
+class FrameContext:
+    """Analysis of one frame shared by the frame processors of a chain.
+
+    Faces are detected by the first processor that asks for them (or handed in by a face
+    tracker); later processors reuse the detections together with the affine matrices and
+    aligned crops computed for them. Matrices stay valid while the faces do not move, crops
+    are recomputed once a processor returns a new frame.
+    """
+
+    def __init__(self, faces: Optional[List[Face]] = None, frame_path: str = '', frame_key: Optional[Tuple[str, int]] = None):
+        self.faces = faces
+        self.frame_path = frame_path
+        # (stream key, frame number) of the frame in the analysis cache
+        self.frame_key = frame_key
+        self.matrices: Dict[Tuple[int, str, int], np.ndarray] = {}
+        self.crops: Dict[Tuple[int, str, int], Tuple[Frame, Frame]] = {}
+
+    def get_faces(self, frame: Frame, profile: str = 'detect') -> List[Face]:
+        if self.faces is None:
+            self.faces = detect_faces(frame, profile, self.frame_key)
+        else:
+            analyse_faces(frame, self.faces, profile)
+        return self.faces
+
+    def get_one_face(self, frame: Frame, profile: str = 'detect') -> Any:
+        return select_one_face(self.get_faces(frame, profile))
+
+    def get_affine_matrix(self, face_index: int, template: str, size: int = 0) -> np.ndarray:
+        points, template_size = ALIGNMENT_TEMPLATES[template]
+        size = size or template_size
+        key = (face_index, template, size)
+        if key not in self.matrices:
+            self.matrices[key] = cv2.estimateAffinePartial2D(self.faces[face_index].kps, points * size / template_size, method=cv2.LMEDS)[0]
+        return self.matrices[key]
+
+    def get_aligned_face(self, frame: Frame, face_index: int, template: str, size: int = 0) -> Tuple[Frame, np.ndarray]:
+        size = size or ALIGNMENT_TEMPLATES[template][1]
+        matrix = self.get_affine_matrix(face_index, template, size)
+        key = (face_index, template, size)
+        cached = self.crops.get(key)
+        if cached is None or cached[0] is not frame:
+            cached = (frame, cv2.warpAffine(frame, matrix, (size, size), borderMode=cv2.BORDER_CONSTANT))
+            self.crops[key] = cached
+        return cached[1], matrix
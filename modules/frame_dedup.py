@@ -0,0 +1,82 @@
+from collections import deque
+from typing import Any, Deque, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from modules.typing import Frame
+from modules.utilities.status import update_status
+
+NAME = 'DLC.FRAME-DEDUP'
+UNIQUE = 'unique'
+DUPLICATE = 'duplicate'
+SIMILAR = 'similar'
+DEDUP_THUMBNAIL_SIZE = (64, 36)
+# dilation around the pixels the processors changed, so reused regions include the blended border
+DEDUP_REGION_PADDING = 15
+
+
+class FrameDeduplicator:
+    """Reuse processed output for repeated frames of a stream.
+
+    `check()` runs in display order while decoding and compares every frame to the last unique
+    one: exact copies are reused as they are, frames whose thumbnail differs by less than
+    `threshold` (mean absolute difference, 0-255) get the processed regions of the reference
+    pasted in. `resolve()` runs in display order on the results.
+    """
+
+    def __init__(self, threshold: float = 0.0):
+        self.threshold = threshold
+        self.reference_frame: Optional[Frame] = None
+        self.reference_thumbnail: Optional[Frame] = None
+        self.pending_references: Deque[Frame] = deque()
+        self.reference_input: Optional[Frame] = None
+        self.reference_output: Optional[Frame] = None
+        self.reference_regions: Optional[List[Tuple[int, int, int, int]]] = None
+        self.counts = {UNIQUE: 0, DUPLICATE: 0, SIMILAR: 0}
+
+    def check(self, frame: Frame) -> str:
+        thumbnail = cv2.resize(frame, DEDUP_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+        kind = UNIQUE
+        if self.reference_thumbnail is not None and self.reference_frame.shape == frame.shape:
+            difference = cv2.absdiff(thumbnail, self.reference_thumbnail).mean()
+            if difference == 0 and np.array_equal(frame, self.reference_frame):
+                kind = DUPLICATE
+            elif difference < self.threshold:
+                kind = SIMILAR
+        if kind == UNIQUE:
+            # processors may write into their input, keep an untouched copy as reference
+            self.reference_frame = frame.copy()
+            self.reference_thumbnail = thumbnail
+            self.pending_references.append(self.reference_frame)
+        self.counts[kind] += 1
+        return kind
+
+    def resolve(self, kind: str, frame: Frame) -> Frame:
+        """Return the output for `frame`, the processed frame if unique and the decoded one otherwise."""
+        if kind == UNIQUE:
+            self.reference_input = self.pending_references.popleft()
+            self.reference_output = frame
+            self.reference_regions = None
+            return frame
+        if kind == DUPLICATE:
+            return self.reference_output
+        result = frame.copy()
+        for x, y, width, height in self.get_reference_regions():
+            result[y:y + height, x:x + width] = self.reference_output[y:y + height, x:x + width]
+        return result
+
+    def get_reference_regions(self) -> List[Tuple[int, int, int, int]]:
+        if self.reference_regions is None:
+            mask = (cv2.absdiff(self.reference_input, self.reference_output).max(axis=2) > 0).astype(np.uint8)
+            kernel = np.ones((DEDUP_REGION_PADDING * 2 + 1, DEDUP_REGION_PADDING * 2 + 1), np.uint8)
+            mask = cv2.dilate(mask, kernel)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            self.reference_regions = [(x, y, width, height) for x, y, width, height in map(cv2.boundingRect, contours)]
+        return self.reference_regions
+
+    def report(self, scope: str = NAME) -> None:
+        total = sum(self.counts.values())
+        if total:
+            reused = self.counts[DUPLICATE] + self.counts[SIMILAR]
+            update_status(f'Reused {reused} of {total} frames ({reused / total:.1%}): {self.counts[DUPLICATE]} exact duplicates, {self.counts[SIMILAR]} near duplicates', scope)
@@ -1,5 +1,5 @@
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 WORKFLOW_DIR = os.path.join(ROOT_DIR, "workflow")
@@ -11,16 +11,40 @@ file_types = [
 
 source_target_map = []
 simple_map = {}
+# faces of every target video frame for map faces, a modules.face_analyser.FaceIndex
+target_face_index: Optional[Any] = None
 
 source_path = None
+source_profile = None
 target_path = None
 output_path = None
 frame_processors: List[str] = []
 keep_fps = True
 keep_audio = True
 keep_frames = False
+temp_frames = False
+segments = 1
+resume = False
 many_faces = False
+detect_interval = 1
+dedup_frames = False
+dedup_threshold = 0.0
+model_precision = 'fp32'
+session_threads = 0
+pin_workers = False
+autotune = False
+worker_backend = 'thread'
+swap_batch_size = 1
+enhancer_backend = 'auto'
+enhancer_batch_size = 1
+enhancer_sessions = 1
 map_faces = False
+map_analysis = 'full'
+cluster_method = 'minibatch'
+cluster_max_k = 0
+cluster_sample_size = 0
+# megabytes of target video face analysis kept between runs, 0 disables the cache
+analysis_cache_size = 0
 color_correction = False  # New global variable for color correction toggle
 nsfw_filter = False
 video_encoder = None
@@ -30,7 +54,7 @@ live_resizable = True
 max_memory = None
 execution_providers: List[str] = []
 execution_threads = os.cpu_count() or 1
-headless = None
+headless: Optional[bool] = None
 log_level = "error"
 fp_ui: Dict[str, bool] = {"face_enhancer": False}
 camera_input_combobox = None
@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import cv2
+
+import modules.globals
+from modules.face_analyser import get_file_key
+from modules.utilities import get_temp_directory_path
+
+MANIFEST_VERSION = 1
+# seconds between manifest writes while frames are being recorded
+MANIFEST_SAVE_INTERVAL = 2.0
+# processed frames wait here until the manifest marking them done is on disk
+STAGED_DIRECTORY_NAME = 'processed'
+# settings that change the rendered pixels, anything else may differ between a run and its resume
+JOB_SETTING_NAMES = [
+    'frame_processors',
+    'many_faces',
+    'map_faces',
+    'mouth_mask',
+    'detect_interval',
+    'dedup_frames',
+    'dedup_threshold',
+    'keep_fps',
+    'keep_audio',
+    'video_encoder',
+    'video_quality',
+    'model_precision',
+    'enhancer_backend',
+    'map_analysis',
+    'color_correction',
+]
+
+
+def get_manifest_path(target_path: str) -> str:
+    temp_directory_path = get_temp_directory_path(target_path)
+    # lives next to the temp directory so cleaning the frames never removes it by accident
+    return temp_directory_path + '.job.json'
+
+
+def get_staged_path(frame_path: str) -> str:
+    return os.path.join(os.path.dirname(frame_path), STAGED_DIRECTORY_NAME, os.path.basename(frame_path))
+
+
+def get_job_settings_hash() -> str:
+    settings: Dict[str, Any] = {name: getattr(modules.globals, name) for name in JOB_SETTING_NAMES}
+    for name in ['source_path', 'source_profile', 'target_path']:
+        path = getattr(modules.globals, name)
+        settings[name] = list(get_file_key(path)) if path and os.path.isfile(path) else None
+    return hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class JobManifest:
+    """Record of the finished work of a video job so an interrupted run can pick up where it stopped."""
+
+    def __init__(self, path: str, settings_hash: str, data: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.settings_hash = settings_hash
+        data = data or {}
+        self.done: Dict[str, Set[str]] = {stage: set(keys) for stage, keys in data.get('done', {}).items()}
+        self.values: Dict[str, Any] = data.get('values', {})
+        self.lock = threading.Lock()
+        self.saved_at = 0.0
+        # processed frames marked done since the last save, as (staged path, frame path)
+        self.staged: List[Tuple[str, str]] = []
+
+    @classmethod
+    def open(cls, target_path: str, resume: bool) -> 'JobManifest':
+        path = get_manifest_path(target_path)
+        settings_hash = get_job_settings_hash()
+        if resume and os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+                if data.get('version') == MANIFEST_VERSION and data.get('settings_hash') == settings_hash:
+                    return cls(path, settings_hash, data)
+            except (OSError, ValueError):
+                pass
+        return cls(path, settings_hash)
+
+    def has_progress(self) -> bool:
+        return bool(self.done or self.values)
+
+    def get(self, name: str, default: Any = None) -> Any:
+        return self.values.get(name, default)
+
+    def set(self, name: str, value: Any) -> None:
+        with self.lock:
+            self.values[name] = value
+        self.save()
+
+    def count_done(self, stage: str) -> int:
+        return len(self.done.get(stage, ()))
+
+    def is_done(self, stage: str, key: str) -> bool:
+        return key in self.done.get(stage, ())
+
+    def mark_done(self, stage: str, key: str, force_save: bool = True) -> None:
+        with self.lock:
+            self.done.setdefault(stage, set()).add(key)
+        if force_save or time.monotonic() - self.saved_at >= MANIFEST_SAVE_INTERVAL:
+            self.save()
+
+    def write_frame(self, frame_path: str, frame: Any, stage: str) -> None:
+        """Write a processed frame and mark it done.
+
+        The frame is staged next to the original and only replaces it once the manifest with its
+        done mark is saved, so after a crash a frame is either marked done and processed or
+        neither, whatever was written last.
+        """
+        staged_path = get_staged_path(frame_path)
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        cv2.imwrite(staged_path, frame)
+        with self.lock:
+            self.staged.append((staged_path, frame_path))
+        self.mark_done(stage, os.path.basename(frame_path), force_save=False)
+
+    def pending(self, frame_paths: List[str], stage: str) -> List[str]:
+        """Frames still to process, after finishing the replacements a crash interrupted."""
+        for frame_path in frame_paths:
+            staged_path = get_staged_path(frame_path)
+            if os.path.isfile(staged_path):
+                if self.is_done(stage, os.path.basename(frame_path)):
+                    os.replace(staged_path, frame_path)
+                else:
+                    os.remove(staged_path)
+        return [frame_path for frame_path in frame_paths if not self.is_done(stage, os.path.basename(frame_path))]
+
+    def save(self) -> None:
+        with self.lock:
+            data = {
+                'version': MANIFEST_VERSION,
+                'settings_hash': self.settings_hash,
+                'values': self.values,
+                'done': {stage: sorted(keys) for stage, keys in self.done.items()},
+            }
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(data, file)
+            os.replace(temp_path, self.path)
+            self.saved_at = time.monotonic()
+            for staged_path, frame_path in self.staged:
+                os.replace(staged_path, frame_path)
+            self.staged = []
+
+    def remove(self) -> None:
+        with self.lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
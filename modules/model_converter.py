@@ -0,0 +1,401 @@
+"""Convert the face models to ONNX variants and check them against their reference.
+
+    python -m modules.model_converter gfpgan --precision fp32 fp16
+    python -m modules.model_converter inswapper --precision fp16 int8-static --dynamic-batch
+    python -m modules.model_converter buffalo --precision int8-dynamic int8-static
+
+Every variant is compared with the reference output on sample crops (max error and PSNR of
+8 bit images, embedding or detection score deviation) and timed with ONNX Runtime. Static
+INT8 variants are calibrated on the same samples. Variants are written next to the output as
+`<name>.<precision>.onnx`, the table as `<name>.conversion.json`.
+
+The inswapper command needs the FP32 `inswapper_128.onnx` of the insightface release in
+modules/models (or --model), the face swapper only downloads the released FP16 model. The
+release has a fixed batch of one, --dynamic-batch writes it and its variants with a batch axis
+for --swap-batch-size, and checks that batched runs match the runs of one face.
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import cv2
+import numpy as np
+
+import modules.globals
+from modules.utilities import MODEL_PRECISIONS, get_model_variant_path, resolve_relative_path
+from modules.utilities.status import update_status
+
+NAME = 'DLC.MODEL-CONVERTER'
+OPTIMIZATION_LEVELS = ['none', 'basic', 'extended']
+# input size, pixel normalisation and output kind of the converted models
+MODEL_SPECS: Dict[str, Dict[str, Any]] = {
+    'gfpgan': {'size': 512, 'scale': 1.0 / 127.5, 'mean': 127.5, 'output': 'image', 'output_scale': 127.5, 'output_offset': 1.0},
+    'inswapper': {'size': 128, 'scale': 1.0 / 255.0, 'mean': 0.0, 'output': 'image', 'output_scale': 255.0, 'output_offset': 0.0},
+    'det_10g': {'size': 640, 'scale': 1.0 / 128.0, 'mean': 127.5, 'output': 'scores'},
+    'w600k_r50': {'size': 112, 'scale': 1.0 / 127.5, 'mean': 127.5, 'output': 'embedding'},
+}
+# resolve_relative_path is relative to modules/utilities: the face swapper and face analyser
+# load from modules/models, the face enhancer from the models directory of the checkout
+ENHANCER_MODELS_DIRECTORY = resolve_relative_path('../../models')
+# the buffalo_l models the face analyser runs on every frame
+BUFFALO_MODELS = ['det_10g', 'w600k_r50']
+# SCRFD returns scores, boxes and keypoints for each of its three strides
+DETECTOR_SCORE_OUTPUTS = 3
+# hyper parameters GFPGANer uses for the v1.4 'clean' architecture
+GFPGAN_ARCH = {
+    'out_size': 512,
+    'num_style_feat': 512,
+    'channel_multiplier': 2,
+    'decoder_load_path': None,
+    'fix_decoder': False,
+    'num_mlp': 8,
+    'input_is_latent': True,
+    'different_w': True,
+    'narrow': 1,
+    'sft_half': True,
+}
+
+
+def load_sample_crops(samples_path: str, size: int, count: int) -> List[np.ndarray]:
+    paths = sorted(glob.glob(os.path.join(samples_path, '*.jpg')) + glob.glob(os.path.join(samples_path, '*.png')))
+    crops = []
+    for path in paths[:count]:
+        image = cv2.imread(path)
+        if image is None:
+            continue
+        # centre square, the check needs natural image statistics rather than aligned faces
+        height, width = image.shape[:2]
+        side = min(height, width)
+        top, left = (height - side) // 2, (width - side) // 2
+        crops.append(cv2.resize(image[top:top + side, left:left + side], (size, size), interpolation=cv2.INTER_AREA))
+    if not crops:
+        update_status(f'No sample images in {samples_path}, using synthetic crops.', NAME)
+        rng = np.random.default_rng(0)
+        crops = [cv2.GaussianBlur(rng.integers(0, 256, (size, size, 3), dtype=np.uint8), (0, 0), 3) for _ in range(count)]
+    return crops
+
+
+def get_blob(model_name: str, crops: List[np.ndarray]) -> np.ndarray:
+    spec = MODEL_SPECS[model_name]
+    return cv2.dnn.blobFromImages(crops, spec['scale'], (spec['size'], spec['size']), (spec['mean'], spec['mean'], spec['mean']), swapRB=True)
+
+
+def get_feeds(model_name: str, session: Any, blob: np.ndarray, first_crop: int = 0) -> Dict[str, np.ndarray]:
+    inputs = session.get_inputs()
+    feeds = {inputs[0].name: blob}
+    if model_name == 'inswapper':
+        # any unit length latent works for a parity check, fixed per crop so variants and batches see the same ones
+        latent = np.stack([np.random.default_rng(1 + first_crop + index).standard_normal(512) for index in range(blob.shape[0])]).astype(np.float32)
+        feeds[inputs[1].name] = latent / np.linalg.norm(latent, axis=1, keepdims=True)
+    return feeds
+
+
+class CalibrationReader:
+    """Feeds for onnxruntime's static quantisation, one per sample crop."""
+
+    def __init__(self, model_name: str, session: Any, crops: List[np.ndarray]):
+        self.feeds = iter([get_feeds(model_name, session, get_blob(model_name, [crop])) for crop in crops])
+
+    def get_next(self) -> Optional[Dict[str, np.ndarray]]:
+        return next(self.feeds, None)
+
+
+def to_images(model_name: str, output: np.ndarray) -> np.ndarray:
+    spec = MODEL_SPECS[model_name]
+    images = (output.astype(np.float32) + spec['output_offset']) * spec['output_scale']
+    return images.clip(0, 255).round().astype(np.uint8)
+
+
+def compare_outputs(model_name: str, reference: List[List[np.ndarray]], outputs: List[List[np.ndarray]]) -> Dict[str, float]:
+    """Deviation of a variant's outputs from the reference, per sample crop lists of model outputs."""
+    kind = MODEL_SPECS[model_name]['output']
+    if kind == 'image':
+        difference = np.concatenate([to_images(model_name, expected[0]).astype(np.float32) - to_images(model_name, actual[0]) for expected, actual in zip(reference, outputs)])
+        mse = float(np.mean(difference ** 2))
+        max_error = float(np.abs(difference).max())
+        return {'deviation': max_error, 'max_error': max_error, 'psnr': 20 * math.log10(255.0 / math.sqrt(mse)) if mse > 0 else float('inf')}
+    if kind == 'embedding':
+        expected = np.concatenate([output[0] for output in reference])
+        actual = np.concatenate([output[0] for output in outputs])
+        cosine = np.sum(expected * actual, axis=1) / (np.linalg.norm(expected, axis=1) * np.linalg.norm(actual, axis=1))
+        return {'deviation': float(1 - cosine.min())}
+    # detection scores are probabilities, boxes and keypoints follow them
+    return {'deviation': max(float(np.abs(expected[index] - actual[index]).max()) for expected, actual in zip(reference, outputs) for index in range(DETECTOR_SCORE_OUTPUTS))}
+
+
+def get_tensor(model: Any, name: str) -> Any:
+    for initializer in model.graph.initializer:
+        if initializer.name == name:
+            return initializer
+    for node in model.graph.node:
+        if node.op_type == 'Constant' and node.output[0] == name:
+            return node.attribute[0].t
+    return None
+
+
+def make_batch_dynamic(model_path: str, output_path: str) -> None:
+    """Write the model with a symbolic batch axis, rewriting the reshapes that hardcode a batch of one."""
+    import onnx
+    from onnx import numpy_helper
+
+    model = onnx.load(model_path)
+    initializer_names = {initializer.name for initializer in model.graph.initializer}
+    for value in list(model.graph.input) + list(model.graph.output):
+        if value.name not in initializer_names:
+            value.type.tensor_type.shape.dim[0].dim_param = 'batch'
+    rewritten = True
+    while rewritten:
+        # shape inference follows the batch axis up to the next reshape that drops it
+        del model.graph.value_info[:]
+        inferred = onnx.shape_inference.infer_shapes(model)
+        batched = {
+            value.name for value in list(inferred.graph.input) + list(inferred.graph.value_info)
+            if value.type.tensor_type.shape.dim and value.type.tensor_type.shape.dim[0].dim_param == 'batch'
+        }
+        rewritten = False
+        for index, node in enumerate(model.graph.node):
+            if node.op_type != 'Reshape' or node.input[0] not in batched or node.output[0] in batched:
+                continue
+            if any(attribute.name == 'allowzero' and attribute.i for attribute in node.attribute):
+                continue
+            tensor = get_tensor(model, node.input[1])
+            shape = numpy_helper.to_array(tensor).copy() if tensor is not None else None
+            if shape is None or not len(shape) or shape[0] != 1:
+                continue
+            # 0 copies the batch of the input, in a new tensor in case another reshape shares it
+            shape[0] = 0
+            name = f'{node.input[1]}_batch_{index}'
+            model.graph.initializer.append(numpy_helper.from_array(shape, name))
+            node.input[1] = name
+            rewritten = True
+    # shapes no reshape reads anymore
+    used_names = {name for node in model.graph.node for name in node.input} | {value.name for value in model.graph.input}
+    for initializer in [initializer for initializer in model.graph.initializer if initializer.name not in used_names]:
+        model.graph.initializer.remove(initializer)
+    del model.graph.value_info[:]
+    onnx.checker.check_model(model)
+    onnx.save(model, output_path)
+
+
+def create_session(model_path: str, providers: List[str], optimization: str = 'none', optimized_path: Optional[str] = None) -> Any:
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = {
+        'none': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    }[optimization]
+    if optimized_path:
+        options.optimized_model_filepath = optimized_path
+    return onnxruntime.InferenceSession(model_path, options, providers=providers)
+
+
+def convert_to_fp16(model_path: str, output_path: str) -> None:
+    import onnx
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+
+    # float32 inputs and outputs keep the pre and post processing of the callers unchanged
+    model = convert_float_to_float16(onnx.load(model_path), keep_io_types=True)
+    onnx.save(model, output_path)
+
+
+def quantize_model(model_name: str, model_path: str, output_path: str, precision: str, crops: List[np.ndarray]) -> None:
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+    if precision == 'int8-dynamic':
+        # weights only, activations are quantised on the fly at run time
+        quantize_dynamic(model_path, output_path, weight_type=QuantType.QInt8)
+        return
+    reader = CalibrationReader(model_name, create_session(model_path, ['CPUExecutionProvider']), crops)
+    quantize_static(model_path, output_path, reader, quant_format=QuantFormat.QDQ, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8, per_channel=True)
+
+
+def write_variant(model_name: str, model_path: str, precision: str, crops: List[np.ndarray]) -> str:
+    variant_path = get_model_variant_path(model_path, precision)
+    if precision == 'fp16':
+        convert_to_fp16(model_path, variant_path)
+    elif precision.startswith('int8'):
+        quantize_model(model_name, model_path, variant_path, precision, crops)
+    return variant_path
+
+
+def optimize_model(model_path: str, optimization: str) -> str:
+    # offline graph optimisation on the CPU provider, extended fusions are only valid there
+    optimized_path = os.path.splitext(model_path)[0] + '.opt.onnx'
+    create_session(model_path, ['CPUExecutionProvider'], optimization, optimized_path)
+    return optimized_path
+
+
+def run_model(model_name: str, session: Any, crops: List[np.ndarray]) -> List[List[np.ndarray]]:
+    # crops run one at a time so models with a fixed batch of one are compared too
+    return [session.run(None, get_feeds(model_name, session, get_blob(model_name, [crop]), index)) for index, crop in enumerate(crops)]
+
+
+def run_model_batched(model_name: str, session: Any, crops: List[np.ndarray]) -> List[List[np.ndarray]]:
+    # every crop in one run, split back into per crop outputs like run_model's
+    outputs = session.run(None, get_feeds(model_name, session, get_blob(model_name, crops)))
+    return [[output[index:index + 1] for output in outputs] for index in range(len(crops))]
+
+
+def measure_latency(model_name: str, session: Any, crop: np.ndarray, batch_size: int, runs: int) -> float:
+    feeds = get_feeds(model_name, session, get_blob(model_name, [crop] * batch_size))
+    session.run(None, feeds)
+    start = time.perf_counter()
+    for _ in range(runs):
+        session.run(None, feeds)
+    return (time.perf_counter() - start) * 1000 / runs
+
+
+def load_gfpgan(checkpoint_path: str) -> Any:
+    import torch
+    from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
+
+    class GFPGANExport(torch.nn.Module):
+        # only the restored image, with the fixed noise buffers so the graph is deterministic
+        def __init__(self, model: Any):
+            super().__init__()
+            self.model = model
+
+        def forward(self, x: Any) -> Any:
+            return self.model(x, return_rgb=False, randomize_noise=False)[0]
+
+    model = GFPGANv1Clean(**GFPGAN_ARCH)
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    # strict loading, a mismatched architecture must fail here instead of exporting random weights
+    model.load_state_dict(checkpoint['params_ema'] if 'params_ema' in checkpoint else checkpoint['params'], strict=True)
+    return GFPGANExport(model).eval()
+
+
+def export_gfpgan(model_name: str, model_path: str, output_path: str, crops: List[np.ndarray], args: argparse.Namespace) -> List[List[np.ndarray]]:
+    import torch
+
+    model = load_gfpgan(model_path)
+    update_status(f'Exporting {model_path} to {output_path}...', NAME)
+    torch.onnx.export(
+        model,
+        torch.zeros(1, 3, 512, 512),
+        output_path,
+        input_names=['input'],
+        output_names=['output'],
+        opset_version=args.opset,
+        do_constant_folding=True,
+        dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+    )
+    with torch.no_grad():
+        return [[model(torch.from_numpy(get_blob(model_name, [crop]))).numpy()] for crop in crops]
+
+
+def copy_onnx_model(model_name: str, model_path: str, output_path: str, crops: List[np.ndarray], args: argparse.Namespace) -> List[List[np.ndarray]]:
+    # models released only as ONNX, their FP32 graph is the reference
+    reference = run_model(model_name, create_session(model_path, ['CPUExecutionProvider']), crops)
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    if getattr(args, 'dynamic_batch', False):
+        update_status(f'Writing {os.path.basename(output_path)} with a dynamic batch axis...', NAME)
+        make_batch_dynamic(model_path, output_path)
+    elif os.path.abspath(model_path) != os.path.abspath(output_path):
+        shutil.copyfile(model_path, output_path)
+    return reference
+
+
+def convert(model_name: str, model_path: str, output_path: str, args: argparse.Namespace, export: Callable[..., List[List[np.ndarray]]]) -> List[Dict[str, Any]]:
+    crops = load_sample_crops(args.samples, MODEL_SPECS[model_name]['size'], args.sample_count)
+    reference = export(model_name, model_path, output_path, crops, args)
+    variants = []
+    for precision in args.precision:
+        if precision != 'fp32':
+            update_status(f'Writing {precision} variant of {os.path.basename(output_path)}...', NAME)
+        variant_path = write_variant(model_name, output_path, precision, crops)
+        variants.append((precision, False, variant_path))
+        if args.optimization != 'none':
+            variants.append((precision, True, optimize_model(variant_path, args.optimization)))
+
+    rows = []
+    for precision, optimized, variant_path in variants:
+        session = create_session(variant_path, args.execution_provider)
+        row: Dict[str, Any] = {'variant': os.path.basename(variant_path), 'precision': precision, 'optimized': optimized}
+        outputs = run_model(model_name, session, crops)
+        row.update(compare_outputs(model_name, reference, outputs))
+        row['latency_ms'] = measure_latency(model_name, session, crops[0], args.batch_size, args.runs)
+        if MODEL_SPECS[model_name]['output'] == 'image':
+            row['within_tolerance'] = row['max_error'] <= args.max_error and row['psnr'] >= args.min_psnr
+        else:
+            row['within_tolerance'] = row['deviation'] <= args.max_deviation
+        if getattr(args, 'dynamic_batch', False):
+            # a reshape the batch axis was not carried through mixes the faces of a batch
+            row['batch_deviation'] = compare_outputs(model_name, outputs, run_model_batched(model_name, session, crops))['deviation']
+            row['within_tolerance'] = row['within_tolerance'] and row['batch_deviation'] <= (args.max_error if MODEL_SPECS[model_name]['output'] == 'image' else args.max_deviation)
+        rows.append(row)
+    return rows
+
+
+def print_report(rows: List[Dict[str, Any]], report_path: str) -> None:
+    print(f'{"variant":<36}{"deviation":>10}{"psnr dB":>9}{"ms":>10}  ok')
+    for row in rows:
+        psnr = f'{row["psnr"]:>9.2f}' if 'psnr' in row else f'{"-":>9}'
+        print(f'{row["variant"]:<36}{row["deviation"]:>10.4f}{psnr}{row["latency_ms"]:>10.2f}  {"yes" if row["within_tolerance"] else "no"}')
+    accepted = [row for row in rows if row['within_tolerance']]
+    if accepted:
+        fastest = min(accepted, key=lambda row: row['latency_ms'])
+        print(f'Fastest within tolerance: {fastest["variant"]}')
+    with open(report_path, 'w', encoding='utf-8') as file:
+        json.dump(rows, file, indent=2)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    program = argparse.ArgumentParser(prog='python -m modules.model_converter')
+    commands = program.add_subparsers(dest='command', required=True)
+    gfpgan = commands.add_parser('gfpgan', help='export GFPGANv1.4 from its PyTorch checkpoint')
+    gfpgan.add_argument('--checkpoint', help='GFPGAN checkpoint', default=os.path.join(ENHANCER_MODELS_DIRECTORY, 'GFPGANv1.4.pth'))
+    gfpgan.add_argument('--output', help='FP32 model path, other variants are written next to it', default=os.path.join(ENHANCER_MODELS_DIRECTORY, 'gfpgan.onnx'))
+    gfpgan.add_argument('--opset', help='ONNX opset of the export', type=int, default=17)
+    inswapper = commands.add_parser('inswapper', help='derive variants of the inswapper ONNX model')
+    inswapper.add_argument('--model', help='FP32 inswapper model of the insightface release, not downloaded by the face swapper', default=resolve_relative_path('../models/inswapper_128.onnx'))
+    inswapper.add_argument('--output', help='FP32 model path, other variants are written next to it', default=resolve_relative_path('../models/inswapper_128.onnx'))
+    inswapper.add_argument('--dynamic-batch', help='write the model and its variants with a dynamic batch axis, needed by --swap-batch-size', dest='dynamic_batch', action='store_true', default=False)
+    buffalo = commands.add_parser('buffalo', help='derive variants of the buffalo_l detector and recognizer')
+    buffalo.add_argument('--model-dir', help='insightface buffalo_l directory', default=os.path.join(os.path.expanduser('~'), '.insightface', 'models', 'buffalo_l'))
+    buffalo.add_argument('--output-dir', help='directory the face analyser loads variants from', default=resolve_relative_path('../models/buffalo_l'))
+    for command in [gfpgan, inswapper, buffalo]:
+        command.add_argument('--precision', help='variants to write', nargs='+', default=['fp32', 'fp16'], choices=MODEL_PRECISIONS)
+        command.add_argument('--optimization', help='also write graph optimised variants', default='basic', choices=OPTIMIZATION_LEVELS)
+        command.add_argument('--samples', help='directory of sample images for the parity check and INT8 calibration', default=resolve_relative_path('../../frames_raw'))
+        command.add_argument('--sample-count', help='sample crops compared per variant', type=int, default=16)
+        command.add_argument('--max-error', help='largest accepted pixel difference to the reference', type=float, default=10.0)
+        command.add_argument('--min-psnr', help='lowest accepted PSNR to the reference', type=float, default=40.0)
+        command.add_argument('--max-deviation', help='largest accepted embedding (1 - cosine) or detection score deviation', type=float, default=0.02)
+        command.add_argument('--execution-provider', help='onnxruntime execution providers for the timing', nargs='+', default=['CPUExecutionProvider'])
+        command.add_argument('--batch-size', help='batch size of the timed runs', type=int, default=1)
+        command.add_argument('--runs', help='timed runs per variant', type=int, default=20)
+    args = program.parse_args(argv)
+    modules.globals.headless = True
+
+    if 'fp32' not in args.precision:
+        # every variant is derived from the FP32 model
+        args.precision.insert(0, 'fp32')
+    if args.command == 'gfpgan':
+        jobs = [('gfpgan', args.checkpoint, args.output, export_gfpgan)]
+    elif args.command == 'inswapper':
+        jobs = [('inswapper', args.model, args.output, copy_onnx_model)]
+    else:
+        jobs = [(name, os.path.join(args.model_dir, name + '.onnx'), os.path.join(args.output_dir, name + '.onnx'), copy_onnx_model) for name in BUFFALO_MODELS]
+    missing_paths = [model_path for _, model_path, _, _ in jobs if not os.path.isfile(model_path)]
+    if missing_paths:
+        update_status(f'Reference model not found: {", ".join(missing_paths)}', NAME)
+        return 2
+    accepted = True
+    for model_name, model_path, output_path, export in jobs:
+        rows = convert(model_name, model_path, output_path, args, export)
+        print_report(rows, os.path.splitext(output_path)[0] + '.conversion.json')
+        accepted = accepted and any(row['within_tolerance'] for row in rows)
+    return 0 if accepted else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import onnxruntime
+
+import modules.globals
+from modules.thread_budget import get_thread_budget
+from modules.utilities import resolve_relative_path
+from modules.utilities.status import update_status
+
+NAME = 'DLC.ONNX-SESSIONS'
+THREAD_LOCK = threading.Lock()
+ROUTER_LOCK = threading.Lock()
+# optimised graphs, one per model content, execution provider and onnxruntime version
+SESSION_CACHE_DIRECTORY = resolve_relative_path('../models/onnx_cache')
+SESSION_CACHE_INDEX = 'hashes.json'
+# extended fusions are saved with the graph, the layout transforms of ORT_ENABLE_ALL are not portable
+SESSION_OPTIMIZATION_LEVEL = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+MODEL_HASHES: Optional[Dict[str, str]] = None
+
+
+def get_model_hash(model_path: str) -> str:
+    """Content hash of a model, remembered per path, size and modification time."""
+    global MODEL_HASHES
+
+    stat = os.stat(model_path)
+    key = f'{os.path.abspath(model_path)}|{stat.st_size}|{stat.st_mtime_ns}'
+    index_path = os.path.join(SESSION_CACHE_DIRECTORY, SESSION_CACHE_INDEX)
+    with THREAD_LOCK:
+        if MODEL_HASHES is None:
+            MODEL_HASHES = {}
+            if os.path.isfile(index_path):
+                try:
+                    with open(index_path, encoding='utf-8') as file:
+                        MODEL_HASHES = json.load(file)
+                except (OSError, ValueError):
+                    pass
+        if key not in MODEL_HASHES:
+            digest = hashlib.sha256()
+            with open(model_path, 'rb') as file:
+                for chunk in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(chunk)
+            # the hash of an earlier version of the file is never asked for again
+            path_prefix = key.rsplit('|', 2)[0] + '|'
+            MODEL_HASHES = {name: value for name, value in MODEL_HASHES.items() if not name.startswith(path_prefix)}
+            MODEL_HASHES[key] = digest.hexdigest()
+            os.makedirs(SESSION_CACHE_DIRECTORY, exist_ok=True)
+            temp_path = f'{index_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                json.dump(MODEL_HASHES, file, indent=2)
+            os.replace(temp_path, index_path)
+        return MODEL_HASHES[key]
+
+
+def get_cache_names(model_path: str, providers: List[str]) -> Tuple[str, str]:
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    provider = providers[0].replace('ExecutionProvider', '').lower() if providers else 'cpu'
+    return stem, provider
+
+
+def get_cached_model_path(model_path: str, providers: List[str]) -> str:
+    stem, provider = get_cache_names(model_path, providers)
+    return os.path.join(SESSION_CACHE_DIRECTORY, f'{stem}.{get_model_hash(model_path)[:16]}.{provider}.ort{onnxruntime.__version__}.onnx')
+
+
+def remove_stale_graphs(model_path: str, providers: List[str], cached_path: str) -> None:
+    """Remove the graphs of the model and provider cached for other model contents or onnxruntime versions."""
+    stem, provider = get_cache_names(model_path, providers)
+    pattern = re.compile(re.escape(stem) + r'\.[0-9a-f]{16}\.' + re.escape(provider) + r'\.ort.+\.onnx')
+    for file_name in os.listdir(SESSION_CACHE_DIRECTORY):
+        if pattern.fullmatch(file_name) and file_name != os.path.basename(cached_path):
+            try:
+                os.remove(os.path.join(SESSION_CACHE_DIRECTORY, file_name))
+            except OSError:
+                pass
+
+
+def get_session_options(providers: List[str], intra_op_threads: int = 0) -> onnxruntime.SessionOptions:
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = SESSION_OPTIMIZATION_LEVEL
+    # frames run in parallel on the execution threads, each session keeps its operators sequential
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = intra_op_threads or get_thread_budget().intra_op_threads
+    options.inter_op_num_threads = 1
+    options.enable_cpu_mem_arena = True
+    # DirectML rejects memory patterns, the other providers reuse them across same sized runs
+    options.enable_mem_pattern = 'DmlExecutionProvider' not in providers
+    options.log_severity_level = 3
+    return options
+
+
+def load_session(model_path: str, providers: List[str], intra_op_threads: int = 0) -> Tuple[onnxruntime.InferenceSession, str]:
+    options = get_session_options(providers, intra_op_threads)
+    cached_path = get_cached_model_path(model_path, providers)
+    if os.path.isfile(cached_path):
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return onnxruntime.InferenceSession(cached_path, options, providers=providers), 'cached'
+        except Exception as exception:
+            update_status(f'Discarding unreadable optimised graph {os.path.basename(cached_path)}: {exception}', NAME)
+            os.remove(cached_path)
+            options = get_session_options(providers, intra_op_threads)
+    os.makedirs(SESSION_CACHE_DIRECTORY, exist_ok=True)
+    temp_path = f'{cached_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    options.optimized_model_filepath = temp_path
+    try:
+        session = onnxruntime.InferenceSession(model_path, options, providers=providers)
+    except Exception as exception:
+        # providers that compile their nodes (TensorRT, CoreML, OpenVINO) cannot save the graph
+        update_status(f'Not caching {os.path.basename(model_path)} for {providers[0] if providers else "cpu"}: {exception}', NAME)
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+        return onnxruntime.InferenceSession(model_path, get_session_options(providers, intra_op_threads), providers=providers), 'uncached'
+    os.replace(temp_path, cached_path)
+    remove_stale_graphs(model_path, providers, cached_path)
+    return session, 'optimised'
+
+
+class CachedSession:
+    """Inference session created from the optimised graph cache, with the repo's session options.
+
+    Everything but the provider switch is forwarded to the wrapped onnxruntime.InferenceSession.
+    insightface models switch providers from `prepare`, the switch goes through the cache as well.
+    """
+
+    def __init__(self, model_path: str, providers: Optional[List[str]] = None, intra_op_threads: int = 0):
+        self.model_path = model_path
+        self.intra_op_threads = intra_op_threads
+        self.load(list(providers or modules.globals.execution_providers))
+
+    def load(self, providers: List[str]) -> None:
+        start = time.perf_counter()
+        self.session, source = load_session(self.model_path, providers, self.intra_op_threads)
+        update_status(f'Loaded {os.path.basename(self.model_path)} on {", ".join(self.session.get_providers())} in {(time.perf_counter() - start) * 1000:.0f} ms ({source})', NAME)
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for names the wrapper does not have, an unpickled wrapper has no session yet
+        if name == 'session':
+            raise AttributeError(name)
+        return getattr(self.session, name)
+
+    def set_providers(self, providers: Optional[List[str]] = None, provider_options: Optional[List[Dict[str, Any]]] = None) -> None:
+        if providers and list(providers) != self.session.get_providers():
+            self.load(list(providers))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {'model_path': self.model_path, 'providers': self.session.get_providers(), 'intra_op_threads': self.intra_op_threads}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        CachedSession.__init__(self, state['model_path'], state['providers'], state['intra_op_threads'])
+
+
+def create_session(model_path: str, providers: Optional[List[str]] = None, intra_op_threads: int = 0) -> CachedSession:
+    """Session on the cached optimised graph, `intra_op_threads` defaults to the thread budget."""
+    return CachedSession(model_path, providers, intra_op_threads)
+
+
+def get_insightface_model(model_path: str, providers: Optional[List[str]] = None, model_file: str = '') -> Any:
+    """insightface.model_zoo.get_model on a cached session.
+
+    `model_file` is read by the model classes for their normalisation (and the inswapper's emap),
+    it stays the original FP32 model when `model_path` is one of its precision variants.
+    """
+    from insightface.model_zoo import model_zoo
+
+    session = create_session(model_path, providers)
+    # insightface's ModelRouter picks the model class, it is handed the cached session instead of creating one
+    with ROUTER_LOCK:
+        pickable_inference_session = model_zoo.PickableInferenceSession
+        model_zoo.PickableInferenceSession = lambda *args, **kwargs: session
+        try:
+            return model_zoo.ModelRouter(model_file or model_path).get_model()
+        finally:
+            model_zoo.PickableInferenceSession = pickable_inference_session
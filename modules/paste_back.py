@@ -0,0 +1,53 @@
+from functools import lru_cache
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+from modules.typing import Frame
+
+# erosion and blur of the blend mask relative to the crop size, the values insightface and
+# GFPGAN apply to the full frame mask after warping it back
+MASK_ERODE_RATIO = 0.1
+MASK_BLUR_RATIO = 0.05
+# pixels added around the warped crop so bilinear edges are not cut off
+PASTE_PADDING = 2
+
+
+@lru_cache(maxsize=None)
+def get_feather_mask(size: int, erode_ratio: float = MASK_ERODE_RATIO, blur_ratio: float = MASK_BLUR_RATIO) -> np.ndarray:
+    """Feathered blend mask in crop space, shared by every face pasted from a crop of this size."""
+    # a zero border makes the erosion eat into the crop edges like the warped mask does
+    mask = np.pad(np.ones((size, size), np.float32), 1)
+    erode = max(int(size * erode_ratio), 1)
+    mask = cv2.erode(mask, np.ones((erode, erode), np.uint8)).astype(np.float32, copy=False)
+    blur = max(int(size * blur_ratio), 1)
+    mask = cv2.GaussianBlur(mask, (blur * 2 + 1, blur * 2 + 1), 0)[1:-1, 1:-1].astype(np.float32, copy=False)
+    mask.setflags(write=False)
+    return mask
+
+
+def get_paste_region(matrix: np.ndarray, crop_size: Tuple[int, int], frame_shape: Tuple[int, ...]) -> Tuple[int, int, int, int]:
+    """Bounding box (x1, y1, x2, y2) in the frame covered by a crop aligned with `matrix`."""
+    crop_height, crop_width = crop_size
+    corners = np.array([[0, 0], [crop_width, 0], [0, crop_height], [crop_width, crop_height]], dtype=np.float32)
+    inverse_matrix = cv2.invertAffineTransform(matrix)
+    points = corners @ inverse_matrix[:, :2].T + inverse_matrix[:, 2]
+    x1, y1 = np.floor(points.min(axis=0)).astype(int) - PASTE_PADDING
+    x2, y2 = np.ceil(points.max(axis=0)).astype(int) + PASTE_PADDING
+    return max(x1, 0), max(y1, 0), min(x2, frame_shape[1]), min(y2, frame_shape[0])
+
+
+def paste_back(frame: Frame, crop: Frame, matrix: np.ndarray, mask: np.ndarray) -> Frame:
+    """Blend an aligned crop into `frame` in place, warping only the region the crop covers."""
+    x1, y1, x2, y2 = get_paste_region(matrix, crop.shape[:2], frame.shape)
+    if x2 <= x1 or y2 <= y1:
+        return frame
+    inverse_matrix = cv2.invertAffineTransform(matrix)
+    inverse_matrix[:, 2] -= (x1, y1)
+    size = (x2 - x1, y2 - y1)
+    warped_crop = cv2.warpAffine(crop, inverse_matrix, size, borderMode=cv2.BORDER_REPLICATE)
+    warped_mask = cv2.warpAffine(mask, inverse_matrix, size)[:, :, None]
+    region = frame[y1:y2, x1:x2]
+    region[:] = (warped_mask * warped_crop + (1 - warped_mask) * region).astype(np.uint8)
+    return frame
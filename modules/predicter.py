@@ -1,5 +1,5 @@
+from typing import Any
 import numpy
-import opennsfw2
 from PIL import Image
 import cv2  # Add OpenCV import
 import modules.globals  # Import globals to access the color correction toggle
@@ -10,12 +10,29 @@ MAX_PROBABILITY = 0.85
 
 # Preload the model once for efficiency
 model = None
+OPENNSFW2 = None
+
+
+def get_opennsfw2() -> Any:
+    global OPENNSFW2
+
+    if OPENNSFW2 is None:
+        # opennsfw2 brings in tensorflow, only runs with the NSFW filter pay for it
+        import opennsfw2
+        import tensorflow
+
+        # prevent tensorflow memory leak
+        for gpu in tensorflow.config.experimental.list_physical_devices('GPU'):
+            tensorflow.config.experimental.set_memory_growth(gpu, True)
+        OPENNSFW2 = opennsfw2
+    return OPENNSFW2
 
 def predict_frame(target_frame: Frame) -> bool:
     # Convert the frame to RGB before processing if color correction is enabled
     if modules.globals.color_correction:
         target_frame = cv2.cvtColor(target_frame, cv2.COLOR_BGR2RGB)
         
+    opennsfw2 = get_opennsfw2()
     image = Image.fromarray(target_frame)
     image = opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
     global model
@@ -28,9 +45,9 @@ def predict_frame(target_frame: Frame) -> bool:
 
 
 def predict_image(target_path: str) -> bool:
-    return opennsfw2.predict_image(target_path) > MAX_PROBABILITY
+    return get_opennsfw2().predict_image(target_path) > MAX_PROBABILITY
 
 
 def predict_video(target_path: str) -> bool:
-    _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=100)
+    _, probabilities = get_opennsfw2().predict_video_frames(video_path=target_path, frame_interval=100)
     return any(probability > MAX_PROBABILITY for probability in probabilities)
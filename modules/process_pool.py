@@ -0,0 +1,167 @@
+import multiprocessing
+import queue
+import threading
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import modules.globals
+from modules.analysis_cache import flush_analysis_cache
+from modules.frame_context import FrameContext
+from modules.typing import Face, Frame
+from modules.utilities.status import update_status
+from modules.video_segments import get_worker_settings, init_segment_worker
+
+NAME = 'DLC.PROCESS-POOL'
+# frames in flight per worker process, one being processed while the next is copied in
+SLOTS_PER_PROCESS = 2
+# seconds between checks that the worker processes are still alive
+WORKER_POLL_SECONDS = 1.0
+
+
+def get_worker_backend() -> str:
+    backend = modules.globals.worker_backend
+    if backend == 'auto':
+        # GPU providers keep their models on the device once, thread workers feed them best
+        backend = 'process' if modules.globals.execution_providers[:1] == ['CPUExecutionProvider'] else 'thread'
+    return backend
+
+
+class SharedFrameRing:
+    """Fixed size frame slots in shared memory, handed out to one frame at a time."""
+
+    def __init__(self, slots: int, shape: Tuple[int, ...]):
+        self.shape = shape
+        self.memory = SharedMemory(create=True, size=slots * int(np.prod(shape)))
+        self.frames = np.ndarray((slots, *shape), dtype=np.uint8, buffer=self.memory.buf)
+        self.free: queue.Queue[int] = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+
+    def acquire(self) -> int:
+        return self.free.get()
+
+    def release(self, slot: int) -> None:
+        self.free.put(slot)
+
+    def close(self) -> None:
+        del self.frames
+        self.memory.close()
+        self.memory.unlink()
+
+
+def attach_shared_memory(name: str) -> SharedMemory:
+    # the parent owns the ring; before Python 3.13 attaching registers it again with the resource
+    # tracker spawned workers share with the parent, which the parent's unlink clears
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        return SharedMemory(name=name)
+
+
+def run_frame_worker(settings: Dict[str, Any], worker_counter: Any, processes: int, memory_name: str, slots: int, shape: Tuple[int, ...], source_face: Any, tasks: Any, results: Any) -> None:
+    from modules.processors.frame.core import get_frame_processors_modules, process_frame_chain
+
+    init_segment_worker(settings, worker_counter, processes)
+    memory = attach_shared_memory(memory_name)
+    frames = np.ndarray((slots, *shape), dtype=np.uint8, buffer=memory.buf)
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    try:
+        for slot, faces, frame_path, frame_key in iter(tasks.get, None):
+            # the chain copies the frame before changing it, so the slot is the input and the output
+            slot_frame = frames[slot]
+            try:
+                temp_frame = process_frame_chain(frame_processors, source_face, slot_frame, FrameContext(faces, frame_path, frame_key))
+                if temp_frame is not slot_frame:
+                    slot_frame[:] = temp_frame
+            except Exception as exception:
+                # one bad frame must not take the worker and the frames queued behind it down
+                update_status(f'Error processing frame {frame_path}: {exception}', NAME)
+                results.put((slot, False))
+            else:
+                results.put((slot, True))
+    finally:
+        flush_analysis_cache()
+        del frames
+        memory.close()
+
+
+class ProcessFramePool:
+    """Frame processor chains running in worker processes, each with its own models.
+
+    Frames go through a shared memory ring instead of being pickled. `process` is called by the
+    frame scheduler's threads, which keep the order and bound the frames in flight.
+    """
+
+    def __init__(self, processes: int, shape: Tuple[int, ...], source_face: Any):
+        self.processes = max(1, processes)
+        self.slots = self.processes * SLOTS_PER_PROCESS
+        self.ring = SharedFrameRing(self.slots, shape)
+        self.done = [threading.Event() for _ in range(self.slots)]
+        self.processed = [False] * self.slots
+        self.error: Optional[BaseException] = None
+        context = multiprocessing.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        settings = get_worker_settings()
+        # every worker process runs one frame at a time with the cores the thread budget gives it
+        settings['execution_threads'] = 1
+        settings['worker_backend'] = 'thread'
+        # held by the pool, the workers' semaphores are unlinked once it is collected
+        self.worker_counter = context.Value('i', 0)
+        self.workers = [
+            context.Process(target=run_frame_worker, args=(settings, self.worker_counter, self.processes, self.ring.memory.name, self.slots, shape, source_face, self.tasks, self.results), daemon=True)
+            for _ in range(self.processes)
+        ]
+        for worker in self.workers:
+            worker.start()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+        update_status(f'Processing frames in {self.processes} worker processes.', NAME)
+
+    def collect(self) -> None:
+        while True:
+            try:
+                result = self.results.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                if self.error is None and not all(worker.is_alive() for worker in self.workers):
+                    self.fail(ChildProcessError('A frame worker process exited unexpectedly.'))
+                if self.error is not None:
+                    return
+                continue
+            if result is None:
+                return
+            slot, self.processed[slot] = result
+            self.done[slot].set()
+
+    def fail(self, error: BaseException) -> None:
+        self.error = error
+        for event in self.done:
+            event.set()
+
+    def process(self, temp_frame: Frame, faces: Optional[List[Face]] = None, frame_path: str = '', frame_key: Optional[Tuple[str, int]] = None) -> Optional[Frame]:
+        """The processed frame, None when its chain raised. Raises when a worker process died."""
+        slot = self.ring.acquire()
+        try:
+            self.ring.frames[slot] = temp_frame
+            self.done[slot].clear()
+            self.tasks.put((slot, faces, frame_path, frame_key))
+            while not self.done[slot].wait(WORKER_POLL_SECONDS) and self.error is None:
+                pass
+            if self.error is not None:
+                raise self.error
+            return self.ring.frames[slot].copy() if self.processed[slot] else None
+        finally:
+            self.ring.release(slot)
+
+    def close(self) -> None:
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.results.put(None)
+        self.collector.join(timeout=WORKER_POLL_SECONDS * 2)
+        self.ring.close()
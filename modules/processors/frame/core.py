@@ -1,8 +1,7 @@
 import sys
 import importlib
-from concurrent.futures import ThreadPoolExecutor
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, Iterable, Iterator, List, Callable, Optional, Tuple
 from tqdm import tqdm
 import os
 import glob
@@ -10,10 +9,18 @@ import shutil
 from pathlib import Path
 import subprocess
 
+import cv2
+
 import modules
 import modules.globals
 from modules.utilities.status import update_status  # Import update_status
-from modules.utilities.ffmpeg_utils import run_ffmpeg  # Update import
+from modules.scheduler import FrameScheduler
+from modules.face_analyser import FaceTracker
+from modules.frame_context import FrameContext
+from modules.frame_dedup import FrameDeduplicator, UNIQUE
+from modules.analysis_cache import flush_analysis_cache, get_stream_key, get_temp_frame_number
+from modules.typing import Frame
+from modules.utilities.ffmpeg_utils import run_ffmpeg, FFmpegFrameReader, FFmpegFrameWriter  # Update import
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
@@ -66,25 +73,17 @@ def set_frame_processors_modules_from_ui(frame_processors: List[str]) -> None:
             except:
                 pass
 
-def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], progress: Any = None) -> None:
+def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, Iterable[str], Any], None], progress: Any = None) -> None:
     update_status(f"Starting multi-threaded processing for {len(temp_frame_paths)} frames.", "DLC.CORE")
     if not callable(process_frames):
         update_status(f"Error: process_frames is not callable. Value: {process_frames}", "DLC.CORE")
         return
-    with ThreadPoolExecutor(max_workers=modules.globals.execution_threads) as executor:
-        futures = []
-        for path in temp_frame_paths:
-            update_status(f"Submitting frame {path} for processing.", "DLC.CORE")
-            future = executor.submit(process_frames, source_path, [path], progress)
-            futures.append(future)
-        for future in futures:
-            try:
-                future.result()
-            except Exception as e:
-                update_status(f"Error in thread: {e}", "DLC.CORE")
-
+    scheduler = FrameScheduler(modules.globals.execution_threads)
+    # each worker runs process_frames once over a stream of paths, so its setup is paid once per thread
+    scheduler.consume(temp_frame_paths, lambda frame_paths: process_frames(source_path, frame_paths, progress))
+    scheduler.report("DLC.CORE")
 
-def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, List[str], Any], None]) -> None:
+def process_video(source_path: str, frame_paths: list[str], process_frames: Callable[[str, Iterable[str], Any], None]) -> None:
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     total = len(frame_paths)
     with tqdm(total=total, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
@@ -92,6 +91,162 @@ def process_video(source_path: str, frame_paths: list[str], process_frames: Call
         multi_process_frame(source_path, frame_paths, process_frames, progress)
 
 
+def get_process_pool(shape: Tuple[int, ...], source_face: Any) -> Any:
+    """Worker processes for the frames of a job when the process backend is selected."""
+    from modules.process_pool import ProcessFramePool, get_worker_backend
+
+    if get_worker_backend() != 'process':
+        return None
+    return ProcessFramePool(modules.globals.execution_threads, shape, source_face)
+
+
+def process_frame_chain(frame_processors: List[ModuleType], source_face: Any, temp_frame: Any, context: FrameContext = None) -> Any:
+    # one context per frame, so the first processor's analysis is reused by the rest of the chain
+    context = context or FrameContext()
+    for frame_processor in frame_processors:
+        if modules.globals.map_faces and hasattr(frame_processor, 'process_frame_v2'):
+            temp_frame = frame_processor.process_frame_v2(temp_frame, context.frame_path, context)
+        else:
+            temp_frame = frame_processor.process_frame(source_face, temp_frame, context)
+    return temp_frame
+
+
+def process_stream_frame(frame_processors: List[ModuleType], source_face: Any, temp_frame: Any, context: FrameContext = None) -> Any:
+    try:
+        return process_frame_chain(frame_processors, source_face, temp_frame, context)
+    except Exception as exception:
+        # keep the stream aligned by writing the untouched frame
+        update_status(f"Error processing frame: {exception}", "DLC.CORE")
+        return temp_frame
+
+
+def process_video_frames(source_face: Any, temp_frame_paths: List[str], write_frame: Optional[Callable[[str, Frame], Any]] = None) -> None:
+    """Run the whole processor chain on every temp frame, reading and writing each file once.
+
+    Processed frames are written with `write_frame(path, frame)`, cv2.imwrite by default. A frame
+    whose chain raised is left untouched on disk and never written.
+    """
+    write_frame = write_frame or cv2.imwrite
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    first_frame = cv2.imread(temp_frame_paths[0]) if temp_frame_paths else None
+    pool = get_process_pool(first_frame.shape, source_face) if first_frame is not None else None
+    stream_key = get_stream_key(modules.globals.target_path, (first_frame.shape[1], first_frame.shape[0]), source='frames') if first_frame is not None else None
+    scheduler = FrameScheduler(pool.slots if pool else modules.globals.execution_threads)
+    with tqdm(total=len(temp_frame_paths), desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
+        progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
+
+        def process_frame_files(frame_paths: Iterable[str]) -> None:
+            for temp_frame_path in frame_paths:
+                temp_frame = cv2.imread(temp_frame_path)
+                frame_key = (stream_key, get_temp_frame_number(temp_frame_path)) if stream_key else None
+                if temp_frame is None:
+                    update_status(f"Warning: Could not read frame {temp_frame_path}", "DLC.CORE")
+                elif pool and temp_frame.shape == pool.ring.shape:
+                    # a dead worker process raises and fails the job, a frame whose chain raised stays untouched
+                    temp_frame = pool.process(temp_frame, frame_path=temp_frame_path, frame_key=frame_key)
+                    if temp_frame is not None:
+                        write_frame(temp_frame_path, temp_frame)
+                else:
+                    try:
+                        temp_frame = process_frame_chain(frame_processors, source_face, temp_frame, FrameContext(frame_path=temp_frame_path, frame_key=frame_key))
+                    except Exception as exception:
+                        update_status(f"Error processing frame {temp_frame_path}: {exception}", "DLC.CORE")
+                    else:
+                        write_frame(temp_frame_path, temp_frame)
+                progress.update(1)
+
+        try:
+            scheduler.consume(temp_frame_paths, process_frame_files)
+        finally:
+            if pool:
+                pool.close()
+            flush_analysis_cache()
+    scheduler.report("DLC.CORE")
+
+
+def process_video_stream(source_face: Any, target_path: str, output_path: str, fps: float, resolution: Tuple[int, int], frame_total: int = 0, segment: Tuple[float, Optional[float]] = None, source_fps: float = 0.0) -> bool:
+    frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
+    audio_path = target_path if modules.globals.keep_audio else None
+    input_args: List[str] = []
+    output_args: List[str] = []
+    if segment:
+        # segments start on a keyframe and stop just before the next one, audio is muxed after stitching
+        start, end = segment
+        audio_path = None
+        if start > 0:
+            input_args = ['-ss', f'{start:.6f}']
+        if end is not None:
+            # half a frame of the source, the output fps differs from it without --keep-fps
+            output_args = ['-t', f'{end - start - 0.5 / (source_fps or detect_fps(target_path)):.6f}']
+    reader = FFmpegFrameReader(target_path, resolution, input_args, output_args)
+    writer = FFmpegFrameWriter(output_path, resolution, fps, audio_path)
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+    pool = get_process_pool((resolution[1], resolution[0], 3), source_face)
+    # with worker processes the scheduler threads only move frames in and out of the ring
+    scheduler = FrameScheduler(pool.slots if pool else modules.globals.execution_threads)
+    tracker = None
+    if modules.globals.detect_interval > 1:
+        # tracking needs frames in display order, so it runs in the sequential decode stage
+        tracker = FaceTracker(modules.globals.detect_interval)
+    deduplicator = None
+    if modules.globals.dedup_frames:
+        deduplicator = FrameDeduplicator(modules.globals.dedup_threshold)
+
+    # frames are numbered from the start of this decode, segments get their own stream key
+    stream_key = get_stream_key(target_path, resolution, segment[0] if segment else 0.0)
+
+    def decode_frames() -> Iterator[Tuple[Frame, FrameContext, str]]:
+        for frame_number, temp_frame in enumerate(reader):
+            kind = deduplicator.check(temp_frame) if deduplicator else UNIQUE
+            yield temp_frame, FrameContext(tracker.track(temp_frame) if tracker else None, frame_key=(stream_key, frame_number) if stream_key else None), kind
+
+    def process_decoded_frame(source_face: Any, frame: Tuple[Frame, FrameContext, str]) -> Tuple[str, Frame]:
+        temp_frame, context, kind = frame
+        if kind != UNIQUE:
+            # repeated frames reuse the output of their reference when they are written
+            return kind, temp_frame
+        if pool:
+            processed_frame = pool.process(temp_frame, context.faces, frame_key=context.frame_key)
+            # keep the stream aligned by writing the untouched frame
+            return kind, temp_frame if processed_frame is None else processed_frame
+        return kind, process_stream_frame(frame_processors, source_face, temp_frame, context)
+
+    frame_count = 0
+    streamed = False
+    try:
+        with tqdm(total=frame_total or None, desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format, disable=segment is not None and not frame_total) as progress:
+            progress.set_postfix({'execution_providers': modules.globals.execution_providers, 'execution_threads': modules.globals.execution_threads, 'max_memory': modules.globals.max_memory})
+            for kind, temp_frame in scheduler.run(decode_frames(), process_decoded_frame, lambda: source_face):
+                if deduplicator:
+                    temp_frame = deduplicator.resolve(kind, temp_frame)
+                writer.write(temp_frame)
+                frame_count += 1
+                progress.update(1)
+        streamed = True
+    except (BrokenPipeError, ChildProcessError, OSError) as e:
+        # ffmpeg or a frame worker process died, the caller falls back to temp frames
+        update_status(f"Error while streaming frames: {e}", "DLC.CORE")
+    finally:
+        # whatever stopped the stream, neither ffmpeg process may outlive it
+        if pool:
+            pool.close()
+        reader.close()
+        written = writer.close()
+        flush_analysis_cache()
+    if not streamed or not written:
+        return False
+    scheduler.report("DLC.CORE")
+    if tracker:
+        tracker.report()
+    if deduplicator:
+        deduplicator.report()
+    if frame_count == 0:
+        update_status("No frames were decoded. Please check the input video.", "DLC.CORE")
+        return False
+    return True
+
+
 # --- Integrated Utility Functions ---
 def detect_fps(target_path: str) -> float:
     command = [
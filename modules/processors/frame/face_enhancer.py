@@ -1,18 +1,20 @@
-from typing import Any, List, Callable
+from typing import Any, Iterable, List, Callable
 import cv2
+import numpy
+import queue
 import threading
-import gfpgan
 import os
 import importlib
-import torch
 
 import modules.globals
 import modules.processors.frame.core
 from modules.core import update_status
-from modules.face_analyser import get_one_face
+from modules.frame_context import FrameContext
+from modules.onnx_sessions import create_session
+from modules.paste_back import get_feather_mask, paste_back
+from modules.scheduler import BatchCollector
 from modules.typing import Frame, Face
 import platform
-import torch
 from modules.utilities import (
     conditional_download,
     is_image,
@@ -20,14 +22,20 @@ from modules.utilities import (
 )
 
 FACE_ENHANCER = None
+ENHANCER_BACKEND = None
+ENHANCER_SESSIONS = None
+ENHANCER_BATCHER = None
 THREAD_SEMAPHORE = threading.Semaphore()
 THREAD_LOCK = threading.Lock()
 NAME = "DLC.FACE-ENHANCER"
+ENHANCER_TEMPLATE = "ffhq_512"
+ENHANCER_SIZE = 512
 
 abs_dir = os.path.dirname(os.path.abspath(__file__))
 models_dir = os.path.join(
     os.path.dirname(os.path.dirname(os.path.dirname(abs_dir))), "models"
 )
+ENHANCER_ONNX_PATH = os.path.join(models_dir, "gfpgan.onnx")
 
 
 def pre_check() -> bool:
@@ -47,6 +55,9 @@ def pre_start() -> bool:
     ):
         update_status("Select an image or video for target path.", NAME)
         return False
+    if modules.globals.enhancer_backend == "onnx" and not os.path.isfile(ENHANCER_ONNX_PATH):
+        update_status(f"ONNX enhancer model not found at {ENHANCER_ONNX_PATH}, export it first.", NAME)
+        return False
     return True
 
 
@@ -55,6 +66,10 @@ def get_face_enhancer() -> Any:
 
     with THREAD_LOCK:
         if FACE_ENHANCER is None:
+            # torch and gfpgan are only imported by the torch backend
+            import gfpgan
+            import torch
+
             model_path = os.path.join(models_dir, "GFPGANv1.4.pth")
             
             try:
@@ -80,27 +95,102 @@ def get_face_enhancer() -> Any:
     return FACE_ENHANCER
 
 
-def enhance_face(temp_frame: Frame) -> Frame:
-    with THREAD_SEMAPHORE:
-        try:
-            _, _, temp_frame = get_face_enhancer().enhance(temp_frame, paste_back=True)
-        except Exception as e:
-            update_status(f"Error enhancing face: {e}", NAME)
-            raise e
-    return temp_frame
+def get_enhancer_backend() -> str:
+    global ENHANCER_BACKEND
+
+    with THREAD_LOCK:
+        if ENHANCER_BACKEND is None:
+            backend = modules.globals.enhancer_backend
+            if backend == "auto":
+                # the exported model runs without the torch semaphore, prefer it when it is there
+                backend = "onnx" if os.path.isfile(ENHANCER_ONNX_PATH) else "torch"
+            update_status(f"Using the {backend} enhancer backend.", NAME)
+            ENHANCER_BACKEND = backend
+    return ENHANCER_BACKEND
+
+
+def get_enhancer_sessions() -> queue.Queue[Any]:
+    global ENHANCER_SESSIONS
+
+    with THREAD_LOCK:
+        if ENHANCER_SESSIONS is None:
+            sessions: queue.Queue[Any] = queue.Queue()
+            for _ in range(max(1, modules.globals.enhancer_sessions)):
+                sessions.put(create_session(ENHANCER_ONNX_PATH, modules.globals.execution_providers))
+            ENHANCER_SESSIONS = sessions
+    return ENHANCER_SESSIONS
 
 
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
+def get_enhancer_batcher() -> Any:
+    global ENHANCER_BATCHER
+
+    with THREAD_LOCK:
+        if ENHANCER_BATCHER is None and modules.globals.enhancer_batch_size > 1:
+            ENHANCER_BATCHER = BatchCollector(run_onnx_enhancer, modules.globals.enhancer_batch_size)
+    return ENHANCER_BATCHER
+
+
+def run_onnx_enhancer(aligned_faces: List[Frame]) -> List[Frame]:
+    """Enhance aligned 512px faces in session calls of up to the enhancer batch size."""
+    # GFPGAN takes RGB scaled to [-1, 1]
+    blob = cv2.dnn.blobFromImages(aligned_faces, 1.0 / 127.5, (ENHANCER_SIZE, ENHANCER_SIZE), (127.5, 127.5, 127.5), swapRB=True)
+    batch_size = max(1, modules.globals.enhancer_batch_size)
+    sessions = get_enhancer_sessions()
+    session = sessions.get()
+    try:
+        model_input = session.get_inputs()[0]
+        if model_input.type == "tensor(float16)":
+            blob = blob.astype(numpy.float16)
+        outputs = [
+            session.run(None, {model_input.name: blob[start:start + batch_size]})[0]
+            for start in range(0, len(aligned_faces), batch_size)
+        ]
+    finally:
+        sessions.put(session)
+    enhanced_faces = (numpy.concatenate(outputs).astype(numpy.float32).transpose((0, 2, 3, 1)) + 1) * 127.5
+    return list(enhanced_faces.clip(0, 255).round().astype(numpy.uint8)[..., ::-1])
+
+
+def run_torch_enhancer(aligned_faces: List[Frame]) -> List[Frame]:
+    enhanced_faces = []
+    for aligned_face in aligned_faces:
+        with THREAD_SEMAPHORE:
+            try:
+                _, restored_faces, _ = get_face_enhancer().enhance(aligned_face, has_aligned=True, paste_back=False)
+            except Exception as e:
+                update_status(f"Error enhancing face: {e}", NAME)
+                raise e
+        enhanced_faces.append(restored_faces[0] if restored_faces else aligned_face)
+    return enhanced_faces
+
+
+def enhance_face(temp_frame: Frame, context: FrameContext = None) -> Frame:
+    # faces are aligned from the shared detections, GFPGAN does not run its own detector
+    context = context or FrameContext()
+    face_count = len(context.get_faces(temp_frame))
+    if not face_count:
+        return temp_frame
+    alignments = [context.get_aligned_face(temp_frame, face_index, ENHANCER_TEMPLATE) for face_index in range(face_count)]
+    aligned_faces = [aligned_face for aligned_face, _ in alignments]
+    if get_enhancer_backend() == "onnx":
+        enhancer_batcher = get_enhancer_batcher()
+        enhanced_faces = enhancer_batcher.run(aligned_faces) if enhancer_batcher else run_onnx_enhancer(aligned_faces)
+    else:
+        enhanced_faces = run_torch_enhancer(aligned_faces)
+    temp_frame = temp_frame.copy()
+    for enhanced_face, (_, matrix) in zip(enhanced_faces, alignments):
+        paste_back(temp_frame, enhanced_face, matrix, get_feather_mask(enhanced_face.shape[0]))
     return temp_frame
 
 
+def process_frame(source_face: Face, temp_frame: Frame, context: FrameContext = None) -> Frame:
+    return enhance_face(temp_frame, context)
+
+
 def process_frames(
-    source_path: str, temp_frame_paths: List[str], progress: Any = None
+    source_path: str, temp_frame_paths: Iterable[str], progress: Any = None
 ) -> None:
-    update_status(f"Starting frame processing for {len(temp_frame_paths)} frames.", NAME)
+    update_status("Starting frame processing.", NAME)
     for temp_frame_path in temp_frame_paths:
         update_status(f"Processing frame: {temp_frame_path}", NAME)
         temp_frame = cv2.imread(temp_frame_path)
@@ -126,16 +216,13 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
     cv2.imwrite(output_path, result)
 
 
-def process_video(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
+def process_video(source_path: str, temp_frame_paths: List[str], process_frames_callable: Callable[[str, Iterable[str], Any], None] = None) -> None:
     update_status(f"Processing video with {len(temp_frame_paths)} frames.", NAME)
     try:
-        process_frames(source_path, temp_frame_paths, progress)
+        modules.processors.frame.core.process_video(source_path, temp_frame_paths, process_frames_callable or process_frames)
     except Exception as e:
         update_status(f"Error during video processing: {e}", NAME)
 
 
-def process_frame_v2(temp_frame: Frame) -> Frame:
-    target_face = get_one_face(temp_frame)
-    if target_face:
-        temp_frame = enhance_face(temp_frame)
-    return temp_frame
+def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "", context: FrameContext = None) -> Frame:
+    return enhance_face(temp_frame, context)
@@ -1,20 +1,30 @@
 import os # <-- Added for os.path.exists
-from typing import Any, List, Callable
+from typing import Any, Callable, Dict, Iterable, List, Tuple
 import cv2
-import insightface
+import numpy
 import threading
+from insightface.utils import face_align
 from tqdm import tqdm  # Import tqdm for progress bar
 
 import modules.globals
 import modules.processors.frame.core
 from modules.processors.frame.core import multi_process_frame  # Import multi_process_frame
 from modules.utilities.status import update_status  # Import update_status
-from modules.face_analyser import get_one_face, get_many_faces, default_source_face
+from modules.face_analyser import get_source_face, default_source_face, match_target_faces
+from modules.frame_context import FrameContext
+from modules.onnx_sessions import get_insightface_model
+from modules.paste_back import get_feather_mask, paste_back
+from modules.scheduler import BatchCollector
 from modules.typing import Face, Frame
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
-from modules.cluster_analysis import find_closest_centroid
+from modules.utilities import conditional_download, get_model_variant_path, resolve_relative_path, is_image, is_video
+from modules.cluster_analysis import CentroidIndex
 
 FACE_SWAPPER = None
+SWAP_BATCHER = None
+SWAP_BATCH_SIZE = None
+# source latents by embedding, a job only ever uses a handful of source faces
+SOURCE_LATENTS: Dict[bytes, Any] = {}
+SOURCE_LATENT_CACHE_SIZE = 64
 THREAD_LOCK = threading.Lock()
 NAME = 'DLC.FACE-SWAPPER'
 
@@ -31,10 +41,10 @@ def pre_check() -> bool:
 
 def pre_start() -> bool:
     # --- No changes needed in pre_start ---
-    if not modules.globals.map_faces and not is_image(modules.globals.source_path):
+    if not modules.globals.map_faces and not is_image(modules.globals.source_path) and not has_source_profile():
         update_status('Select an image for source path.', NAME)
         return False
-    elif not modules.globals.map_faces and not get_one_face(cv2.imread(modules.globals.source_path)):
+    elif not modules.globals.map_faces and not get_source_face():
         update_status('No face in source path detected.', NAME)
         return False
     if not is_image(modules.globals.target_path) and not is_video(modules.globals.target_path):
@@ -43,6 +53,10 @@ def pre_start() -> bool:
     return True
 
 
+def has_source_profile() -> bool:
+    return bool(modules.globals.source_profile) and os.path.isfile(modules.globals.source_profile)
+
+
 def get_face_swapper() -> Any:
     global FACE_SWAPPER
 
@@ -53,10 +67,17 @@ def get_face_swapper() -> Any:
             model_dir = resolve_relative_path('../models')
             model_path_fp32 = os.path.join(model_dir, 'inswapper_128.onnx')
             model_path_fp16 = os.path.join(model_dir, 'inswapper_128_fp16.onnx')
+            model_path_variant = get_model_variant_path(model_path_fp32, modules.globals.model_precision)
             chosen_model_path = None
 
+            # A variant written by modules.model_converter for --model-precision comes first
+            if modules.globals.model_precision != 'fp32' and os.path.exists(model_path_variant):
+                chosen_model_path = model_path_variant
+                update_status(f"Loading {modules.globals.model_precision} model: {os.path.basename(chosen_model_path)}", NAME)
             # Prioritize FP32 model
-            if os.path.exists(model_path_fp32):
+            elif os.path.exists(model_path_fp32):
+                if modules.globals.model_precision != 'fp32':
+                    update_status(f"{os.path.basename(model_path_variant)} not found, run 'python -m modules.model_converter inswapper'. Loading FP32 model.", NAME)
                 chosen_model_path = model_path_fp32
                 update_status(f"Loading FP32 model: {os.path.basename(chosen_model_path)}", NAME)
             # Fallback to FP16 model
@@ -72,7 +93,9 @@ def get_face_swapper() -> Any:
             # Load the chosen model
             try:
                 update_status(f"Attempting to load model: {chosen_model_path}", NAME)
-                FACE_SWAPPER = insightface.model_zoo.get_model(chosen_model_path, providers=modules.globals.execution_providers)
+                # the emap of the swapper is read from the FP32 graph, variants reorder its initializers
+                model_file = model_path_fp32 if os.path.exists(model_path_fp32) else chosen_model_path
+                FACE_SWAPPER = get_insightface_model(chosen_model_path, modules.globals.execution_providers, model_file)
                 update_status(f"Model loaded successfully: {chosen_model_path}", NAME)
             except Exception as e:
                 update_status(f"Error loading Face Swapper model {os.path.basename(chosen_model_path)}: {e}", NAME)
@@ -81,17 +104,73 @@ def get_face_swapper() -> Any:
     return FACE_SWAPPER
 
 
-def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    # --- No changes needed in swap_face ---
+def get_swap_batcher(swapper: Any) -> Any:
+    global SWAP_BATCHER, SWAP_BATCH_SIZE
+
+    with THREAD_LOCK:
+        if SWAP_BATCH_SIZE is None:
+            SWAP_BATCH_SIZE = max(1, modules.globals.swap_batch_size)
+            batch_dimension = swapper.session.get_inputs()[0].shape[0]
+            if SWAP_BATCH_SIZE > 1 and isinstance(batch_dimension, int):
+                # the released inswapper models are exported with a fixed batch of one
+                update_status(f"Face swapper model has a fixed batch size of {batch_dimension}, swapping face by face. Write a batched one with 'python -m modules.model_converter inswapper --dynamic-batch'.", NAME)
+                SWAP_BATCH_SIZE = 1
+            if SWAP_BATCH_SIZE > 1:
+                SWAP_BATCHER = BatchCollector(lambda items: run_face_swapper(swapper, items), SWAP_BATCH_SIZE)
+    return SWAP_BATCHER
+
+
+def get_source_latent(swapper: Any, source_face: Face) -> Any:
+    key = source_face.normed_embedding.tobytes()
+    latent = SOURCE_LATENTS.get(key)
+    if latent is None:
+        latent = numpy.dot(source_face.normed_embedding.reshape((1, -1)), swapper.emap)
+        latent /= numpy.linalg.norm(latent)
+        if len(SOURCE_LATENTS) >= SOURCE_LATENT_CACHE_SIZE:
+            SOURCE_LATENTS.clear()
+        SOURCE_LATENTS[key] = latent
+    return latent
+
+
+def run_face_swapper(swapper: Any, items: List[Tuple[Any, Frame]]) -> List[Frame]:
+    """Swap (source latent, aligned face) pairs in session calls of up to SWAP_BATCH_SIZE."""
+    latents = numpy.concatenate([latent for latent, _ in items]).astype(numpy.float32)
+    blob = cv2.dnn.blobFromImages([aligned_face for _, aligned_face in items], 1.0 / swapper.input_std, swapper.input_size, (swapper.input_mean, swapper.input_mean, swapper.input_mean), swapRB=True)
+    batch_size = SWAP_BATCH_SIZE or 1
+    predictions = [
+        swapper.session.run(swapper.output_names, {swapper.input_names[0]: blob[start:start + batch_size], swapper.input_names[1]: latents[start:start + batch_size]})[0]
+        for start in range(0, len(items), batch_size)
+    ]
+    swapped_faces = numpy.clip(255 * numpy.concatenate(predictions).transpose((0, 2, 3, 1)), 0, 255).astype(numpy.uint8)[..., ::-1]
+    return list(swapped_faces)
+
+
+def swap_faces(face_pairs: List[Tuple[Face, Face]], temp_frame: Frame) -> Frame:
+    """Swap every (source face, target face) pair of a frame with batched model runs."""
     swapper = get_face_swapper()
     if swapper is None:
          # Handle case where model failed to load
          update_status("Face swapper model not loaded, skipping swap.", NAME)
          return temp_frame
-    return swapper.get(temp_frame, target_face, source_face, paste_back=True)
+    if not face_pairs:
+        return temp_frame
+    # run the model ourselves so the result is blended only around the face, not over the full frame
+    alignments = [face_align.norm_crop2(temp_frame, target_face.kps, swapper.input_size[0]) for _, target_face in face_pairs]
+    items = [(get_source_latent(swapper, source_face), aligned_face) for (source_face, _), (aligned_face, _) in zip(face_pairs, alignments)]
+    swap_batcher = get_swap_batcher(swapper)
+    # with batching enabled, faces of frames in flight on other workers share the session call
+    swapped_faces = swap_batcher.run(items) if swap_batcher else run_face_swapper(swapper, items)
+    temp_frame = temp_frame.copy()
+    for swapped_face, (_, matrix) in zip(swapped_faces, alignments):
+        paste_back(temp_frame, swapped_face, matrix, get_feather_mask(swapped_face.shape[0]))
+    return temp_frame
 
 
-def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
+def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
+    return swap_faces([(source_face, target_face)], temp_frame)
+
+
+def process_frame(source_face: Face, temp_frame: Frame, context: FrameContext = None) -> Frame:
     # --- No changes needed in process_frame ---
     # Ensure the frame is in RGB format if color correction is enabled
     # Note: InsightFace swapper often expects BGR by default. Double-check if color issues appear.
@@ -101,13 +180,14 @@ def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
     #     temp_frame = cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB)
     #     original_was_bgr = False # Now it's RGB
 
+    # faces come from the shared frame context, detected here only if nothing upstream did
+    context = context or FrameContext()
     if modules.globals.many_faces:
-        many_faces = get_many_faces(temp_frame)
+        many_faces = context.get_faces(temp_frame, 'detect')
         if many_faces:
-            for target_face in many_faces:
-                temp_frame = swap_face(source_face, target_face, temp_frame)
+            temp_frame = swap_faces([(source_face, target_face) for target_face in many_faces], temp_frame)
     else:
-        target_face = get_one_face(temp_frame)
+        target_face = context.get_one_face(temp_frame, 'detect')
         if target_face:
             temp_frame = swap_face(source_face, target_face, temp_frame)
 
@@ -118,75 +198,82 @@ def process_frame(source_face: Face, temp_frame: Frame) -> Frame:
     return temp_frame
 
 
-def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "") -> Frame:
+def process_frame_v2(temp_frame: Frame, temp_frame_path: str = "", context: FrameContext = None) -> Frame:
     # --- No changes needed in process_frame_v2 ---
     # (Assuming swap_face handles the potential None return from get_face_swapper)
+    # all faces of the frame are collected first so they are swapped in one batch
+    face_pairs = []
     if is_image(modules.globals.target_path):
         if modules.globals.many_faces:
             source_face = default_source_face()
             for map_entry in modules.globals.source_target_map: # Fixed typo here
                 target_face = map_entry['target']['face']
-                temp_frame = swap_face(source_face, target_face, temp_frame)
+                face_pairs.append((source_face, target_face))
 
         elif not modules.globals.many_faces:
             for map_entry in modules.globals.source_target_map: # Fixed typo here
                 if "source" in map_entry:
                     source_face = map_entry['source']['face']
                     target_face = map_entry['target']['face']
-                    temp_frame = swap_face(source_face, target_face, temp_frame)
+                    face_pairs.append((source_face, target_face))
 
     elif is_video(modules.globals.target_path):
-        if modules.globals.many_faces:
+        # faces of the frame found when the target was analysed, looked up by frame path
+        face_index = modules.globals.target_face_index
+        if face_index is None:
+            # sampled analysis only found the identities, this frame's faces are matched to them now
+            context = context or FrameContext()
+            for map_entry, target_face in match_target_faces(context.get_faces(temp_frame, 'detect+embed')):
+                if modules.globals.many_faces:
+                    face_pairs.append((default_source_face(), target_face))
+                elif "source" in map_entry:
+                    face_pairs.append((map_entry['source']['face'], target_face))
+
+        elif modules.globals.many_faces:
             source_face = default_source_face()
             for map_entry in modules.globals.source_target_map: # Fixed typo here
-                target_frame = [f for f in map_entry['target_faces_in_frame'] if f['location'] == temp_frame_path]
-
-                for frame in target_frame:
-                    for target_face in frame['faces']:
-                        temp_frame = swap_face(source_face, target_face, temp_frame)
+                for target_face in face_index.get_faces(temp_frame_path, map_entry['id']):
+                    face_pairs.append((source_face, target_face))
 
         elif not modules.globals.many_faces:
             for map_entry in modules.globals.source_target_map: # Fixed typo here
                 if "source" in map_entry:
-                    target_frame = [f for f in map_entry['target_faces_in_frame'] if f['location'] == temp_frame_path]
                     source_face = map_entry['source']['face']
 
-                    for frame in target_frame:
-                        for target_face in frame['faces']:
-                            temp_frame = swap_face(source_face, target_face, temp_frame)
+                    for target_face in face_index.get_faces(temp_frame_path, map_entry['id']):
+                        face_pairs.append((source_face, target_face))
     else: # Fallback for neither image nor video (e.g., live feed?)
-        detected_faces = get_many_faces(temp_frame)
+        # simple map assignment compares embeddings, many faces only needs the keypoints
+        context = context or FrameContext()
+        detected_faces = context.get_faces(temp_frame, 'detect' if modules.globals.many_faces else 'detect+embed')
         if modules.globals.many_faces:
             if detected_faces:
                 source_face = default_source_face()
                 for target_face in detected_faces:
-                    temp_frame = swap_face(source_face, target_face, temp_frame)
+                    face_pairs.append((source_face, target_face))
 
         elif not modules.globals.many_faces:
             if detected_faces and hasattr(modules.globals, 'simple_map') and modules.globals.simple_map: # Check simple_map exists
-                if len(detected_faces) <= len(modules.globals.simple_map['target_embeddings']):
-                    for detected_face in detected_faces:
-                        closest_centroid_index, _ = find_closest_centroid(modules.globals.simple_map['target_embeddings'], detected_face.normed_embedding)
-                        temp_frame = swap_face(modules.globals.simple_map['source_faces'][closest_centroid_index], detected_face, temp_frame)
+                source_faces = modules.globals.simple_map['source_faces']
+                target_index = modules.globals.simple_map['target_index']
+                detected_embeddings = [face.normed_embedding for face in detected_faces]
+                if len(detected_faces) <= len(target_index):
+                    closest_centroid_indices, _ = target_index.search(detected_embeddings)
+                    for detected_face, closest_centroid_index in zip(detected_faces, closest_centroid_indices):
+                        face_pairs.append((source_faces[closest_centroid_index], detected_face))
                 else:
-                    detected_faces_centroids = [face.normed_embedding for face in detected_faces]
-                    i = 0
-                    for target_embedding in modules.globals.simple_map['target_embeddings']:
-                        closest_centroid_index, _ = find_closest_centroid(detected_faces_centroids, target_embedding)
-                        # Ensure index is valid before accessing detected_faces
-                        if closest_centroid_index < len(detected_faces):
-                            temp_frame = swap_face(modules.globals.simple_map['source_faces'][i], detected_faces[closest_centroid_index], temp_frame)
-                        i += 1
-    return temp_frame
+                    # more faces than mapped targets, every target takes its closest face
+                    closest_face_indices, _ = CentroidIndex(detected_embeddings).search(target_index.centroids)
+                    for i, closest_face_index in enumerate(closest_face_indices):
+                        face_pairs.append((source_faces[i], detected_faces[closest_face_index]))
+    return swap_faces(face_pairs, temp_frame)
 
 
-def process_frames(source_path: str, temp_frame_paths: List[str], progress: Any = None) -> None:
-    update_status(f"Starting frame processing for {len(temp_frame_paths)} frames.", NAME)
+def process_frames(source_path: str, temp_frame_paths: Iterable[str], progress: Any = None) -> None:
+    update_status("Starting frame processing.", NAME)
     source_face = None
     if not modules.globals.map_faces:
-        source_img = cv2.imread(source_path)
-        if source_img is not None:
-            source_face = get_one_face(source_img)
+        source_face = get_source_face()
         if source_face is None:
             update_status(f"Could not find face in source image: {source_path}, skipping swap.", NAME)
 
@@ -226,11 +313,7 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
         return
 
     if not modules.globals.map_faces:
-        source_img = cv2.imread(source_path)
-        if source_img is None:
-             update_status(f"Error: Could not read source image: {source_path}", NAME)
-             return
-        source_face = get_one_face(source_img)
+        source_face = get_source_face()
         if source_face is None:
             update_status(f"Error: No face found in source image: {source_path}", NAME)
             return
@@ -249,7 +332,7 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
         update_status(f"Error: Failed to write output image to: {output_path}", NAME)
 
 
-def process_video(source_path: str, temp_frame_paths: List[str], process_frames_callable: Callable[[str, List[str], Any], None]) -> None:
+def process_video(source_path: str, temp_frame_paths: List[str], process_frames_callable: Callable[[str, Iterable[str], Any], None]) -> None:
     update_status(f"Processing video with {len(temp_frame_paths)} frames.", NAME)
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     with tqdm(total=len(temp_frame_paths), desc='Processing Frames', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress:
@@ -0,0 +1,263 @@
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from modules.utilities.status import update_status
+
+NAME = 'DLC.SCHEDULER'
+# frames kept in flight per worker, enough to hide decode/encode jitter without growing memory
+WINDOW_PER_THREAD = 4
+STOP = object()
+# how long a worker waits for others to fill a batch before running what it has
+BATCH_WAIT_SECONDS = 0.005
+
+
+class StageTimer:
+    def __init__(self, name: str, parallelism: int = 1):
+        self.name = name
+        self.parallelism = parallelism
+        self.count = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds: float, count: int = 1) -> None:
+        with self.lock:
+            self.seconds += seconds
+            self.count += count
+
+    def fps(self) -> float:
+        # busy time of parallel stages is summed over workers, normalise it back to wall time
+        wall_seconds = self.seconds / self.parallelism
+        return self.count / wall_seconds if wall_seconds > 0 else 0.0
+
+
+class BatchRequest:
+    __slots__ = ('items', 'results', 'error', 'done')
+
+    def __init__(self, items: List[Any]):
+        self.items = items
+        self.results: List[Any] = []
+        self.error: Optional[BaseException] = None
+        self.done = False
+
+
+class BatchCollector:
+    """Merge the requests of concurrent worker threads into shared batched calls.
+
+    A thread whose request fills the batch, or whose wait runs out, takes every pending request
+    and runs `process` once over all their items; the other threads wait for their share.
+    """
+
+    def __init__(self, process: Callable[[List[Any]], List[Any]], batch_size: int, wait: float = BATCH_WAIT_SECONDS):
+        self.process = process
+        self.batch_size = batch_size
+        self.wait = wait
+        self.pending: List[BatchRequest] = []
+        self.pending_count = 0
+        self.condition = threading.Condition()
+
+    def run(self, items: List[Any]) -> List[Any]:
+        request = BatchRequest(items)
+        with self.condition:
+            self.pending.append(request)
+            self.pending_count += len(items)
+            deadline = time.monotonic() + self.wait
+            while True:
+                if request.done:
+                    break
+                is_pending = any(pending is request for pending in self.pending)
+                remaining = deadline - time.monotonic()
+                if is_pending and (self.pending_count >= self.batch_size or remaining <= 0):
+                    batch, self.pending, self.pending_count = self.pending, [], 0
+                    break
+                # a request taken by another thread is finished by that thread, wait for it
+                self.condition.wait(remaining if is_pending else None)
+        if not request.done:
+            self.run_batch(batch)
+        if request.error is not None:
+            raise request.error
+        return request.results
+
+    def run_batch(self, batch: List[BatchRequest]) -> None:
+        results: List[Any] = []
+        error = None
+        try:
+            results = self.process([item for request in batch for item in request.items])
+        except BaseException as exception:
+            error = exception
+        with self.condition:
+            offset = 0
+            for request in batch:
+                request.results = results[offset:offset + len(request.items)]
+                request.error = error
+                request.done = True
+                offset += len(request.items)
+            self.condition.notify_all()
+
+
+class FrameScheduler:
+    """Bounded producer/consumer pipeline with long-lived workers.
+
+    At most `window` items are decoded but not yet handed back to the caller, so memory stays
+    flat regardless of the video length. `run()` yields results in input order which lets the
+    output feed an encoder directly.
+    """
+
+    def __init__(self, execution_threads: int, window: int = 0):
+        self.execution_threads = max(1, execution_threads)
+        self.window = max(window or self.execution_threads * WINDOW_PER_THREAD, self.execution_threads)
+        self.stages: Dict[str, StageTimer] = {
+            'decode': StageTimer('decode'),
+            'process': StageTimer('process', self.execution_threads),
+            'encode': StageTimer('encode'),
+        }
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def run(self, items: Iterable[Any], process: Callable[[Any, Any], Any], init_worker: Optional[Callable[[], Any]] = None) -> Iterator[Any]:
+        """Yield process(worker_state, item) for every item, in input order."""
+        slots = threading.Semaphore(self.window)
+        tasks: queue.Queue[Any] = queue.Queue()
+        results: Dict[int, Any] = {}
+        condition = threading.Condition()
+        stopped = threading.Event()
+        state: Dict[str, Any] = {'total': None, 'error': None}
+
+        def fail(error: BaseException) -> None:
+            with condition:
+                if state['error'] is None:
+                    state['error'] = error
+                condition.notify_all()
+
+        def produce() -> None:
+            index = 0
+            try:
+                iterator = iter(items)
+                while not stopped.is_set():
+                    start = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        break
+                    self.stages['decode'].add(time.perf_counter() - start)
+                    slots.acquire()
+                    if stopped.is_set():
+                        break
+                    tasks.put((index, item))
+                    index += 1
+            except BaseException as error:
+                fail(error)
+            finally:
+                for _ in range(self.execution_threads):
+                    tasks.put(STOP)
+                with condition:
+                    state['total'] = index
+                    condition.notify_all()
+
+        def work() -> None:
+            try:
+                worker_state = init_worker() if init_worker else None
+                while True:
+                    task = tasks.get()
+                    if task is STOP or stopped.is_set():
+                        return
+                    index, item = task
+                    start = time.perf_counter()
+                    result = process(worker_state, item)
+                    self.stages['process'].add(time.perf_counter() - start)
+                    with condition:
+                        results[index] = result
+                        condition.notify_all()
+            except BaseException as error:
+                fail(error)
+
+        threads = [threading.Thread(target=produce, daemon=True)]
+        threads.extend(threading.Thread(target=work, daemon=True) for _ in range(self.execution_threads))
+        self.started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            next_index = 0
+            while True:
+                with condition:
+                    while next_index not in results and state['error'] is None and state['total'] != next_index:
+                        condition.wait()
+                    if state['error'] is not None:
+                        raise state['error']
+                    if next_index not in results:
+                        break
+                    result = results.pop(next_index)
+                start = time.perf_counter()
+                yield result
+                self.stages['encode'].add(time.perf_counter() - start)
+                slots.release()
+                next_index += 1
+        finally:
+            stopped.set()
+            # unblock a producer waiting for a free slot so it can observe the stop flag
+            slots.release()
+            self.finished_at = time.perf_counter()
+
+    def consume(self, items: Iterable[Any], worker: Callable[[Iterator[Any]], None]) -> None:
+        """Feed items to long-lived workers through a bounded queue, order is not preserved.
+
+        Every worker is called exactly once with an iterator over its share of the items, so
+        per-call setup happens once per worker instead of once per item. The first exception of
+        a worker stops feeding the others and is raised once every worker has returned.
+        """
+        tasks: queue.Queue[Any] = queue.Queue(maxsize=self.window)
+        errors: List[BaseException] = []
+
+        def drain(drained: threading.Event) -> Iterator[Any]:
+            while True:
+                task = tasks.get()
+                if task is STOP:
+                    drained.set()
+                    return
+                start = time.perf_counter()
+                yield task
+                self.stages['process'].add(time.perf_counter() - start)
+
+        def work() -> None:
+            drained = threading.Event()
+            try:
+                worker(drain(drained))
+            except BaseException as error:
+                update_status(f"Error in thread: {error}", NAME)
+                errors.append(error)
+            if not drained.is_set():
+                # keep draining so the producer never blocks on a dead worker
+                for _ in iter(tasks.get, STOP):
+                    pass
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(self.execution_threads)]
+        self.started_at = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        iterator = iter(items)
+        # a failed worker leaves its share of the items undone, the job cannot succeed anymore
+        while not errors:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            self.stages['decode'].add(time.perf_counter() - start)
+            tasks.put(item)
+        for _ in threads:
+            tasks.put(STOP)
+        for thread in threads:
+            thread.join()
+        self.finished_at = time.perf_counter()
+        if errors:
+            raise errors[0]
+
+    def report(self, scope: str = NAME) -> None:
+        stages: List[str] = []
+        for stage in self.stages.values():
+            if stage.count:
+                stages.append(f'{stage.name} {stage.fps():.1f} fps ({stage.seconds:.1f}s busy)')
+        if self.started_at is not None and self.finished_at is not None:
+            stages.append(f'total {self.finished_at - self.started_at:.1f}s')
+        update_status(f'Throughput with {self.execution_threads} threads: ' + ', '.join(stages), scope)
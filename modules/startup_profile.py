@@ -0,0 +1,70 @@
+"""Import and startup timings printed with --startup-profile.
+
+run.py installs the import hook before modules.core is imported, core.run reports once the
+job is about to start. Import time is attributed to the top level package whose module
+statement ran it, nested imports of other packages are counted for those packages instead.
+"""
+import builtins
+import sys
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+NAME = 'DLC.STARTUP'
+START_TIME = time.perf_counter()
+ENABLED = False
+ORIGINAL_IMPORT = builtins.__import__
+# seconds spent importing each top level package, without the packages it imported
+IMPORT_TIMES: Dict[str, float] = {}
+# time of the nested imports of every import in progress
+IMPORT_STACK: List[float] = []
+PHASES: List[Tuple[str, float]] = []
+REPORTED_PACKAGES = 12
+
+
+def install() -> None:
+    global ENABLED
+
+    # looked up in sys.argv, the imports to time happen before the arguments are parsed
+    if ENABLED or '--startup-profile' not in sys.argv:
+        return
+    ENABLED = True
+    builtins.__import__ = timed_import
+
+
+def timed_import(name: str, globals: Any = None, locals: Any = None, fromlist: Any = (), level: int = 0) -> Any:
+    # relative imports stay inside the importing package, its time already covers them
+    if level or name in sys.modules or threading.current_thread() is not threading.main_thread():
+        return ORIGINAL_IMPORT(name, globals, locals, fromlist, level)
+    start = time.perf_counter()
+    IMPORT_STACK.append(0.0)
+    try:
+        return ORIGINAL_IMPORT(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = IMPORT_STACK.pop()
+        package = name.partition('.')[0]
+        IMPORT_TIMES[package] = IMPORT_TIMES.get(package, 0.0) + elapsed - nested
+        if IMPORT_STACK:
+            IMPORT_STACK[-1] += elapsed
+
+
+def mark(phase: str) -> None:
+    if ENABLED:
+        PHASES.append((phase, time.perf_counter()))
+
+
+def report() -> None:
+    from modules.utilities.status import update_status
+
+    if not ENABLED:
+        return
+    builtins.__import__ = ORIGINAL_IMPORT
+    previous = START_TIME
+    for phase, timestamp in PHASES:
+        update_status(f'{phase:<20}{(timestamp - previous) * 1000:>9.0f} ms', NAME)
+        previous = timestamp
+    update_status(f'{"ready":<20}{(time.perf_counter() - START_TIME) * 1000:>9.0f} ms total', NAME)
+    update_status(f'Slowest imports ({sum(IMPORT_TIMES.values()) * 1000:.0f} ms in total):', NAME)
+    for package, seconds in sorted(IMPORT_TIMES.items(), key=lambda item: item[1], reverse=True)[:REPORTED_PACKAGES]:
+        update_status(f'  {package:<18}{seconds * 1000:>9.0f} ms', NAME)
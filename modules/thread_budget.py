@@ -0,0 +1,95 @@
+import os
+from typing import List, Optional
+
+import cv2
+
+import modules.globals
+from modules.utilities.status import update_status
+
+NAME = 'DLC.THREAD-BUDGET'
+# thread pools of the BLAS and OpenMP runtimes numpy, torch and onnxruntime may be built with
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+THREAD_BUDGET = None
+
+
+class ThreadBudget:
+    """How the cores of one process are split between frame workers and the thread pools they call.
+
+    Frame workers run whole frames in parallel, so every pool below them gets the cores a single
+    worker owns: onnxruntime intra-op threads, OpenCV and BLAS. With a GPU provider the models do
+    not run on the CPU and their pools get one thread each.
+    """
+
+    def __init__(self, cores: int, workers: int, intra_op_threads: int, opencv_threads: int, blas_threads: int):
+        self.cores = cores
+        self.workers = workers
+        self.intra_op_threads = intra_op_threads
+        self.opencv_threads = opencv_threads
+        self.blas_threads = blas_threads
+
+    def describe(self) -> str:
+        return f'{self.cores} cores: {self.workers} frame workers x {self.intra_op_threads} onnxruntime threads, {self.opencv_threads} OpenCV threads, {self.blas_threads} BLAS threads'
+
+
+def get_available_cores() -> List[int]:
+    # the affinity mask, not the machine, is what a pinned or containerised process may use
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_thread_budget(processes: int = 1, workers: Optional[int] = None, providers: Optional[List[str]] = None) -> ThreadBudget:
+    cores = max(1, len(get_available_cores()) // max(1, processes))
+    workers = max(1, workers or modules.globals.execution_threads)
+    providers = providers or modules.globals.execution_providers
+    if providers and providers[0] != 'CPUExecutionProvider':
+        budget = ThreadBudget(cores, workers, 1, 1, 1)
+    else:
+        # more workers than cores only adds context switches between frames
+        workers = min(workers, cores)
+        worker_cores = max(1, cores // workers)
+        budget = ThreadBudget(cores, workers, worker_cores, worker_cores, worker_cores)
+    if modules.globals.session_threads:
+        budget.intra_op_threads = modules.globals.session_threads
+    return budget
+
+
+def apply_thread_budget(budget: ThreadBudget) -> ThreadBudget:
+    global THREAD_BUDGET
+
+    if budget.workers != modules.globals.execution_threads:
+        update_status(f'Reducing execution threads from {modules.globals.execution_threads} to {budget.workers}, one per available core.', NAME)
+    modules.globals.execution_threads = budget.workers
+    cv2.setNumThreads(budget.opencv_threads)
+    for variable in BLAS_THREAD_VARIABLES:
+        # read when torch is imported, which happens lazily after this; numpy has loaded its BLAS already
+        os.environ[variable] = str(budget.blas_threads)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(budget.blas_threads)
+    except ImportError:
+        pass
+    THREAD_BUDGET = budget
+    update_status(budget.describe(), NAME)
+    return budget
+
+
+def get_thread_budget() -> ThreadBudget:
+    global THREAD_BUDGET
+
+    if THREAD_BUDGET is None:
+        # entry points other than core (the model converter, benchmarks) keep the global settings
+        THREAD_BUDGET = plan_thread_budget()
+    return THREAD_BUDGET
+
+
+def pin_worker_process(index: int, processes: int) -> bool:
+    """Restrict worker process `index` of `processes` to its own share of the available cores."""
+    cores = get_available_cores()
+    if not hasattr(os, 'sched_setaffinity') or processes < 2 or len(cores) < processes:
+        return False
+    share = len(cores) // processes
+    pinned_cores = cores[index * share:(index + 1) * share] if index < processes - 1 else cores[index * share:]
+    os.sched_setaffinity(0, pinned_cores)
+    update_status(f'Worker process {index} pinned to cores {pinned_cores[0]}-{pinned_cores[-1]}.', NAME)
+    return True
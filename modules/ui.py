@@ -11,6 +11,8 @@ import modules.globals
 import modules.metadata
 from modules.face_analyser import (
     get_one_face,
+    get_source_face,
+    FaceTracker,
     get_unique_faces_from_target_image,
     get_unique_faces_from_target_video,
     add_blank_map,
@@ -18,6 +20,7 @@ from modules.face_analyser import (
     simplify_maps,
 )
 from modules.capturer import get_video_frame, get_video_frame_total
+from modules.frame_context import FrameContext
 from modules.processors.frame.core import get_frame_processors_modules
 from modules.utilities import (
     is_image,
@@ -504,7 +507,7 @@ def update_popup_source(
         return map
     else:
         cv2_img = cv2.imread(source_path)
-        face = get_one_face(cv2_img)
+        face = get_one_face(cv2_img, 'detect+embed')
 
         if face:
             x_min, y_min, x_max, y_max = face["bbox"]
@@ -766,7 +769,7 @@ def update_preview(frame_number: int = 0) -> None:
                 modules.globals.frame_processors
         ):
             temp_frame = frame_processor.process_frame(
-                get_one_face(cv2.imread(modules.globals.source_path)), temp_frame
+                get_source_face(), temp_frame
             )
         image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
         image = ImageOps.contain(
@@ -879,6 +882,11 @@ def create_webcam_preview(camera_index: int):
 
     frame_processors = get_frame_processors_modules(modules.globals.frame_processors)
     source_image = None
+    face_tracker = None
+    if modules.globals.detect_interval > 1:
+        # simple map assignment needs embeddings, the tracker carries them between detections
+        profile = "detect+embed" if modules.globals.map_faces and not modules.globals.many_faces else "detect"
+        face_tracker = FaceTracker(modules.globals.detect_interval, profile)
     prev_time = time.time()
     fps_update_interval = 0.5
     frame_count = 0
@@ -904,24 +912,27 @@ def create_webcam_preview(camera_index: int):
                 temp_frame, PREVIEW.winfo_width(), PREVIEW.winfo_height()
             )
 
+        # one context per frame, so the enhancer reuses the faces the swapper found
+        context = FrameContext(face_tracker.track(temp_frame) if face_tracker else None)
+
         if not modules.globals.map_faces:
             if source_image is None and modules.globals.source_path:
-                source_image = get_one_face(cv2.imread(modules.globals.source_path))
+                source_image = get_source_face()
 
             for frame_processor in frame_processors:
                 if frame_processor.NAME == "DLC.FACE-ENHANCER":
                     if modules.globals.fp_ui["face_enhancer"]:
-                        temp_frame = frame_processor.process_frame(None, temp_frame)
+                        temp_frame = frame_processor.process_frame(None, temp_frame, context)
                 else:
-                    temp_frame = frame_processor.process_frame(source_image, temp_frame)
+                    temp_frame = frame_processor.process_frame(source_image, temp_frame, context)
         else:
             modules.globals.target_path = None
             for frame_processor in frame_processors:
                 if frame_processor.NAME == "DLC.FACE-ENHANCER":
                     if modules.globals.fp_ui["face_enhancer"]:
-                        temp_frame = frame_processor.process_frame_v2(temp_frame)
+                        temp_frame = frame_processor.process_frame_v2(temp_frame, "", context)
                 else:
-                    temp_frame = frame_processor.process_frame_v2(temp_frame)
+                    temp_frame = frame_processor.process_frame_v2(temp_frame, "", context)
 
         # Calculate and display FPS
         current_time = time.time()
@@ -955,6 +966,8 @@ def create_webcam_preview(camera_index: int):
             break
 
     cap.release()
+    if face_tracker:
+        face_tracker.report()
     PREVIEW.withdraw()
 
 
@@ -1120,7 +1133,7 @@ def update_webcam_source(
         return map
     else:
         cv2_img = cv2.imread(source_path)
-        face = get_one_face(cv2_img)
+        face = get_one_face(cv2_img, 'detect+embed')
 
         if face:
             x_min, y_min, x_max, y_max = face["bbox"]
@@ -1172,7 +1185,7 @@ def update_webcam_target(
         return map
     else:
         cv2_img = cv2.imread(target_path)
-        face = get_one_face(cv2_img)
+        face = get_one_face(cv2_img, 'detect+embed')
 
         if face:
             x_min, y_min, x_max, y_max = face["bbox"]
@@ -1,17 +1,21 @@
 # This file is intentionally left blank to mark the directory as a Python package.
+import json
 import os
 import tempfile
 import shutil
 import cv2
 from glob import glob
 import subprocess
-from typing import List  # Add this import
+from typing import List, Tuple  # Add this import
 import urllib.request  # Add this import
 from tqdm import tqdm  # Add this import
 from modules.utilities.ffmpeg_utils import run_ffmpeg  # Update import
 import modules  # Ensure the modules package is imported
 from modules.utilities.status import update_status  # Import update_status
 
+# model variants modules.model_converter can write, fp32 is the released model itself
+MODEL_PRECISIONS = ["fp32", "fp16", "int8-dynamic", "int8-static"]
+
 def get_temp_directory_path():
     return os.path.join(tempfile.gettempdir(), "deep_live_cam_temp")
 
@@ -160,6 +164,66 @@ def detect_fps(target_path: str) -> float:
         pass
     return 30.0
 
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    """Detect the displayed (rotation-aware) resolution of a video file."""
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=width,height:stream_tags=rotate:stream_side_data=rotation",
+        "-of",
+        "json",
+        target_path,
+    ]
+    stream = json.loads(subprocess.check_output(command).decode())["streams"][0]
+    width, height = int(stream["width"]), int(stream["height"])
+    rotation = stream.get("tags", {}).get("rotate", 0)
+    for side_data in stream.get("side_data_list", []):
+        rotation = side_data.get("rotation", rotation)
+    if abs(int(rotation)) % 180 == 90:
+        width, height = height, width
+    return width, height
+
+def detect_duration(target_path: str) -> Tuple[float, float]:
+    """Detect the start time and duration of a video file in seconds."""
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=start_time,duration",
+        "-of",
+        "json",
+        target_path,
+    ]
+    output = json.loads(subprocess.check_output(command).decode())["format"]
+    return float(output.get("start_time", 0.0)), float(output["duration"])
+
+def detect_keyframe_times(target_path: str) -> List[float]:
+    """Detect the keyframe timestamps of the first video stream, relative to the file start."""
+    command = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=p=0",
+        target_path,
+    ]
+    start_time, _ = detect_duration(target_path)
+    keyframe_times = []
+    for line in subprocess.check_output(command).decode().splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            keyframe_times.append(float(pts_time) - start_time)
+    return sorted(keyframe_times)
+
 def create_video(target_path: str, fps: float = 30.0) -> None:
     temp_output_path = get_temp_output_path(target_path)
     temp_directory_path = get_temp_directory_path(target_path)
@@ -227,6 +291,16 @@ def conditional_download(download_directory_path: str, urls: List[str]) -> None:
             ) as progress:
                 urllib.request.urlretrieve(url, download_file_path, reporthook=lambda count, block_size, total_size: progress.update(block_size))  # type: ignore[attr-defined]
 
+def get_model_variant_path(model_path: str, precision: str) -> str:
+    """Path of a precision variant written by modules.model_converter, e.g. inswapper_128.int8_static.onnx.
+
+    The dot keeps converted variants apart from released models such as inswapper_128_fp16.onnx.
+    """
+    if precision == "fp32":
+        return model_path
+    stem, extension = os.path.splitext(model_path)
+    return f"{stem}.{precision.replace('-', '_')}{extension}"
+
 def extract_frames(target_path: str, output_dir: str) -> None:
     os.makedirs(output_dir, exist_ok=True)
     update_status(f"Extracting frames from {target_path} to {output_dir}", "DLC.CORE")
@@ -257,8 +331,13 @@ __all__ = [
     "normalize_output_path",
     "has_image_extension",
     "detect_fps",
+    "detect_resolution",
+    "detect_duration",
+    "detect_keyframe_times",
     "create_video",
     "restore_audio",
     "conditional_download",  # Add conditional_download to the list
+    "get_model_variant_path",
+    "MODEL_PRECISIONS",
 ]
 
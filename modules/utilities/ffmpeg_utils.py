@@ -1,20 +1,114 @@
 import subprocess
+import tempfile
+from io import BufferedReader
+from typing import Any, Iterator, List, Optional, Tuple, cast
+
+import numpy
+
 from modules.utilities.status import update_status  # Import update_status
 import modules.globals
 
-def run_ffmpeg(args: list[str]) -> bool:
+
+def get_ffmpeg_commands(hwaccel: bool = True) -> List[str]:
     commands = [
         "ffmpeg",
         "-hide_banner",
-        "-hwaccel",
-        "auto",
-        "-loglevel",
-        modules.globals.log_level,
     ]
+    if hwaccel:
+        commands.extend(["-hwaccel", "auto"])
+    commands.extend(["-loglevel", modules.globals.log_level])
+    return commands
+
+
+def run_ffmpeg(args: list[str]) -> bool:
+    commands = get_ffmpeg_commands()
     commands.extend(args)
     try:
         subprocess.check_output(commands, stderr=subprocess.STDOUT)
         return True
     except subprocess.CalledProcessError as e:
         update_status(f"FFmpeg error: {e.output.decode()}", "DLC.FFMPEG")
-        return False
\ No newline at end of file
+        return False
+
+
+class FFmpegFrameReader:
+    """Decode a video into raw BGR frames through an ffmpeg pipe."""
+
+    def __init__(self, target_path: str, resolution: Tuple[int, int], input_args: Optional[List[str]] = None, output_args: Optional[List[str]] = None):
+        self.width, self.height = resolution
+        self.frame_size = self.width * self.height * 3
+        commands = get_ffmpeg_commands()
+        commands.extend(input_args or [])
+        commands.extend(["-i", target_path])
+        commands.extend(output_args or [])
+        commands.extend(["-an", "-sn", "-f", "rawvideo", "-pix_fmt", "bgr24", "-"])
+        self.process = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=self.frame_size)
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            frame = numpy.empty((self.height, self.width, 3), dtype=numpy.uint8)
+            if not self.read_into(frame):
+                return
+            yield frame
+
+    def read_into(self, frame: Any) -> bool:
+        buffer = memoryview(frame).cast("B")
+        # a binary pipe with a buffer size, which Popen opens as a BufferedReader
+        stdout = cast(BufferedReader, self.process.stdout)
+        offset = 0
+        while offset < self.frame_size:
+            count = stdout.readinto(buffer[offset:])
+            if not count:
+                return False
+            offset += count
+        return True
+
+    def close(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.wait()
+
+
+class FFmpegFrameWriter:
+    """Encode raw BGR frames piped into ffmpeg, optionally muxing audio from a second input."""
+
+    def __init__(self, output_path: str, resolution: Tuple[int, int], fps: float, audio_path: Optional[str] = None):
+        width, height = resolution
+        commands = get_ffmpeg_commands(hwaccel=False)
+        commands.extend([
+            "-f", "rawvideo",
+            "-pix_fmt", "bgr24",
+            "-s", f"{width}x{height}",
+            "-r", str(fps),
+            "-i", "-",
+        ])
+        if audio_path:
+            commands.extend(["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0?"])
+        commands.extend([
+            "-c:v", modules.globals.video_encoder,
+            "-crf", str(modules.globals.video_quality),
+            "-pix_fmt", "yuv420p",
+            "-vf", "colorspace=bt709:iall=bt601-6-625:fast=1",
+            "-y", output_path,
+        ])
+        # stderr goes to a file so a chatty encoder can never block the pipe
+        self.log_file = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(commands, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.log_file)
+
+    def write(self, frame: Any) -> None:
+        self.process.stdin.write(numpy.ascontiguousarray(frame).data)
+
+    def close(self) -> bool:
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        return_code = self.process.wait()
+        self.log_file.seek(0)
+        log = self.log_file.read().decode(errors="ignore").strip()
+        self.log_file.close()
+        if return_code != 0:
+            update_status(f"FFmpeg error: {log}", "DLC.FFMPEG")
+            return False
+        return True
@@ -0,0 +1,178 @@
+import math
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Any, Dict, List, Optional, Tuple
+
+from tqdm import tqdm
+
+import modules.globals
+from modules.capturer import get_video_frame_total
+from modules.face_analyser import FaceIndex, get_source_face, save_source_profile
+from modules.job_manifest import JobManifest
+from modules.processors.frame.core import get_frame_processors_modules, process_video_stream
+from modules.thread_budget import apply_thread_budget, pin_worker_process, plan_thread_budget
+from modules.utilities import create_temp, detect_duration, detect_fps, detect_keyframe_times, get_temp_directory_path
+from modules.utilities.ffmpeg_utils import run_ffmpeg
+from modules.utilities.status import update_status
+
+NAME = 'DLC.SEGMENTS'
+# the map faces index is plain arrays, cheap to send to the workers
+WORKER_SETTING_TYPES = (str, int, float, bool, list, dict, tuple, type(None), FaceIndex)
+# settings that only make sense in the parent process
+WORKER_SETTING_EXCLUDES = ('camera_input_combobox', 'webcam_preview_running')
+# length of the work units a video job is split into, the progress a crash cannot lose
+RESUME_SEGMENT_SECONDS = 60.0
+
+
+def get_worker_settings() -> Dict[str, Any]:
+    return {
+        name: value for name, value in vars(modules.globals).items()
+        if not name.startswith('_') and name not in WORKER_SETTING_EXCLUDES and isinstance(value, WORKER_SETTING_TYPES)
+    }
+
+
+def init_segment_worker(settings: Dict[str, Any], worker_counter: Any, workers: int) -> None:
+    for name, value in settings.items():
+        setattr(modules.globals, name, value)
+    modules.globals.headless = True
+    with worker_counter.get_lock():
+        index = worker_counter.value
+        worker_counter.value += 1
+    pinned = modules.globals.pin_workers and pin_worker_process(index, workers)
+    # a pinned worker owns every core it sees, the others share the machine with their siblings
+    apply_thread_budget(plan_thread_budget(1 if pinned else workers))
+
+
+def plan_segments(keyframe_times: List[float], duration: float, count: int) -> List[Tuple[float, Optional[float]]]:
+    """Split the timeline into up to `count` parts that each start on a keyframe."""
+    boundaries = [0.0]
+    for index in range(1, count):
+        ideal_time = duration * index / count
+        keyframe_time = min(keyframe_times, key=lambda time: abs(time - ideal_time), default=0.0)
+        if keyframe_time > boundaries[-1]:
+            boundaries.append(keyframe_time)
+    # the last segment reads to the end of the stream instead of trusting the probed duration
+    ends: List[Optional[float]] = list(boundaries[1:])
+    ends.append(None)
+    return list(zip(boundaries, ends))
+
+
+def get_segment_path(target_path: str, index: int) -> str:
+    return os.path.join(get_temp_directory_path(target_path), f'segment_{index:04d}.mp4')
+
+
+def process_segment(target_path: str, segment_path: str, segment: Tuple[float, Optional[float]], fps: float, resolution: Tuple[int, int], source_fps: float) -> bool:
+    for frame_processor in get_frame_processors_modules(modules.globals.frame_processors):
+        if not frame_processor.pre_start():
+            return False
+    return process_video_stream(get_source_face(), target_path, segment_path, fps, resolution, segment=segment, source_fps=source_fps)
+
+
+def stop_segment_workers(executor: ProcessPoolExecutor) -> None:
+    """Drop the queued segments and kill the running ones, so a fallback does not wait for them."""
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+
+def concat_segments(segment_paths: List[str], target_path: str, output_path: str) -> bool:
+    list_path = os.path.join(get_temp_directory_path(target_path), 'segments.txt')
+    with open(list_path, 'w', encoding='utf-8') as file:
+        for segment_path in segment_paths:
+            escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+            file.write(f"file '{escaped_path}'\n")
+    args = ['-f', 'concat', '-safe', '0', '-i', list_path]
+    if modules.globals.keep_audio:
+        args.extend(['-i', target_path, '-map', '0:v:0', '-map', '1:a:0?'])
+    args.extend(['-c:v', 'copy', '-y', output_path])
+    return run_ffmpeg(args)
+
+
+def get_segments(target_path: str, manifest: JobManifest) -> List[Tuple[float, Optional[float]]]:
+    segments = manifest.get('segments')
+    if segments:
+        return [tuple(segment) for segment in segments]
+    _, duration = detect_duration(target_path)
+    count = max(modules.globals.segments, math.ceil(duration / RESUME_SEGMENT_SECONDS))
+    keyframe_times = detect_keyframe_times(target_path) if count > 1 else []
+    segments = plan_segments(keyframe_times, duration, count)
+    manifest.set('segments', segments)
+    return segments
+
+
+def process_segments_in_order(source_face: Any, target_path: str, segment_paths: List[str], segments: List[Tuple[float, Optional[float]]], pending_indices: List[int], fps: float, resolution: Tuple[int, int], source_fps: float, manifest: JobManifest) -> bool:
+    """Process the pending segments one after another in this process, with its own frame workers."""
+    video_frame_total = get_video_frame_total(target_path)
+    for index in pending_indices:
+        start, end = segments[index]
+        frame_total = round((end - start) * source_fps) if end is not None else video_frame_total - round(start * source_fps)
+        update_status(f'Processing segment {index + 1} of {len(segments)}...', NAME)
+        if not process_video_stream(source_face, target_path, segment_paths[index], fps, resolution, max(0, frame_total), segments[index], source_fps):
+            update_status(f'Segment {index} failed.', NAME)
+            return False
+        manifest.mark_done('segments', str(index))
+    return True
+
+
+def process_video_segments(source_face: Any, target_path: str, output_path: str, fps: float, resolution: Tuple[int, int], manifest: JobManifest) -> bool:
+    try:
+        segments = get_segments(target_path, manifest)
+        # segment boundaries are in source frames, whatever fps the output is written at
+        source_fps = detect_fps(target_path)
+    except Exception as e:
+        update_status(f'Error detecting keyframes: {e}', NAME)
+        return False
+    create_temp(target_path)
+    segment_paths = [get_segment_path(target_path, index) for index in range(len(segments))]
+    pending_indices = [
+        index for index in range(len(segments))
+        if not (manifest.is_done('segments', str(index)) and os.path.isfile(segment_paths[index]))
+    ]
+    workers = max(1, min(modules.globals.segments, len(pending_indices)))
+    update_status(f'Processing {len(pending_indices)} of {len(segments)} keyframe aligned segments with {workers} workers...', NAME)
+    if workers == 1:
+        if not process_segments_in_order(source_face, target_path, segment_paths, segments, pending_indices, fps, resolution, source_fps, manifest):
+            return False
+        update_status('Stitching segments...', NAME)
+        return concat_segments(segment_paths, target_path, output_path)
+
+    settings = get_worker_settings()
+    settings['execution_threads'] = max(1, modules.globals.execution_threads // workers)
+    # segments are worker processes already
+    settings['worker_backend'] = 'thread'
+    if source_face is not None:
+        # workers load the analysed source face instead of detecting it again
+        profile_path = os.path.join(get_temp_directory_path(target_path), 'source_profile.npz')
+        save_source_profile(source_face, profile_path)
+        settings['source_profile'] = profile_path
+        settings['source_path'] = None
+
+    context = multiprocessing.get_context('spawn')
+    worker_counter = context.Value('i', 0)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_segment_worker, initargs=(settings, worker_counter, workers))
+    try:
+        futures = {
+            executor.submit(process_segment, target_path, segment_paths[index], segments[index], fps, resolution, source_fps): index
+            for index in pending_indices
+        }
+        with tqdm(total=len(segments), initial=len(segments) - len(pending_indices), desc='Processing', unit='segment', dynamic_ncols=True) as progress:
+            for future in as_completed(futures):
+                try:
+                    done = future.result()
+                except Exception as e:
+                    update_status(f'Error in segment {futures[future]}: {e}', NAME)
+                    done = False
+                if not done:
+                    update_status(f'Segment {futures[future]} failed.', NAME)
+                    stop_segment_workers(executor)
+                    return False
+                manifest.mark_done('segments', str(futures[future]))
+                progress.update(1)
+    except BaseException:
+        stop_segment_workers(executor)
+        raise
+    executor.shutdown()
+    update_status('Stitching segments...', NAME)
+    return concat_segments(segment_paths, target_path, output_path)
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+from modules import startup_profile
+
+# before modules.core, so the imports it pulls in are timed
+startup_profile.install()
+
 from modules import core
 
 if __name__ == '__main__':